@@ -0,0 +1,154 @@
+"""Runs an unmodified strategy over stored candles on a virtual clock.
+
+    series = series_from_cache('candles', [('ETH-USDT-SWAP', '1m')])
+    result = Backtester(lambda: SupertrendStrategy(config, debug=False), series, warmup_bars=100).run()
+    print(result.summary())
+
+Every bar goes through the live stack (queue, dispatcher, subscriptions, simulated fills), which
+costs ~70-90us a bar: 11-14k bars/s for Supertrend or Tutci on one 1m series here, about 40s per
+year of 1m bars. For signal-only sweeps over long histories, supertrend_series and tutci_series
+compute the whole history at once instead.
+
+Each bar is published once, when it closes: UPDATE subscriptions are called once per bar rather
+than for every intra-bar update as they are live, so forming-bar logic is only exercised at bar
+granularity.
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable
+
+import numpy as np
+import pandas as pd
+
+from Backtest.exchange import SeriesKey, SimulatedExchange
+from Exchange.candle_cache import CandleCache
+from Strategy.StrategyBase import StrategyBase
+from Structures.common import InstrumentInfo
+from Tools.AlertManager import NullAlertManager
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """Event loop whose clock jumps to the next timer whenever every task is waiting,
+    so asyncio.sleep, wait_for and the subscription timers cost no wall time."""
+
+    def __init__(self, start: float = 0.):
+        super().__init__()
+        self._virtual_time = start
+        # timers fire when `when < time() + resolution`, which must stay above the float spacing of epoch seconds
+        self._clock_resolution = 1e-6
+        self._select = self._selector.select
+        self._selector.select = self._virtual_select
+
+    def time(self) -> float:
+        return self._virtual_time
+
+    def _virtual_select(self, timeout=None):
+        if timeout is None:
+            raise RuntimeError('Backtest deadlock: every task is waiting and no timer is scheduled')
+        self._virtual_time += timeout
+        return self._select(0)
+
+
+def series_from_cache(directory: str, keys: Iterable[SeriesKey]) -> Dict[SeriesKey, np.ndarray]:
+    cache = CandleCache(directory)
+    return {key: np.array(cache.load(*key)) for key in keys}
+
+
+@dataclass
+class BacktestResult:
+    equity: pd.Series
+    trades: pd.DataFrame
+    bar_timings_s: np.ndarray
+    elapsed_s: float
+    balance: float
+    # exceptions raised by the strategy's handlers and subscription callbacks, which are logged and skipped
+    errors: int = 0
+
+    def summary(self) -> Dict[str, float]:
+        equity = self.equity.values
+        drawdown = 1 - equity / np.maximum.accumulate(np.maximum(equity, self.balance))
+        timings_us = self.bar_timings_s * 1e6
+        return {
+            'bars': len(equity),
+            'elapsed_s': round(self.elapsed_s, 3),
+            'bars_per_s': round(len(equity) / self.elapsed_s),
+            'bar_us_p50': round(float(np.percentile(timings_us, 50)), 1) if len(timings_us) else None,
+            'bar_us_p99': round(float(np.percentile(timings_us, 99)), 1) if len(timings_us) else None,
+            'bar_us_max': round(float(timings_us.max()), 1) if len(timings_us) else None,
+            'return': round(float(equity[-1] / self.balance - 1), 5) if len(equity) else None,
+            'max_drawdown': round(float(drawdown.max()), 5) if len(equity) else None,
+            'trades': len(self.trades),
+            'fees': round(float(self.trades['fee'].sum()), 5) if len(self.trades) else 0.,
+            'errors': self.errors,
+        }
+
+
+class Backtester:
+    """Builds the strategy inside the backtest loop, swaps its connection for a SimulatedExchange
+    and runs StrategyBase.run until every stored bar has been published."""
+
+    def __init__(self, make_strategy: Callable[[], StrategyBase], series: Dict[SeriesKey, np.ndarray],
+                 warmup_bars: int = 0, balance: float = 10_000., fee_rate: float = 0.0005, slippage: float = 0.0002,
+                 instruments: Dict[str, InstrumentInfo] = None, quiet: bool = True):
+        self.make_strategy = make_strategy
+        self.series = series
+        self.exchange_params = dict(warmup_bars=warmup_bars, balance=balance, fee_rate=fee_rate,
+                                    slippage=slippage, instruments=instruments)
+        self.quiet = quiet
+        self.strategy: StrategyBase = None
+        self.exchange: SimulatedExchange = None
+
+    def run(self) -> BacktestResult:
+        first_ms = min(int(records['timestamp_ms'][0]) for records in self.series.values())
+        loop = VirtualTimeLoop(first_ms / 1000)
+        if self.quiet:
+            logging.disable(logging.WARNING)
+        started = time.perf_counter()
+        try:
+            loop.run_until_complete(self._run())
+        finally:
+            if self.quiet:
+                logging.disable(logging.NOTSET)
+            loop.close()
+        return self._result(time.perf_counter() - started)
+
+    async def _run(self):
+        self.strategy = strategy = self.make_strategy()
+        self.exchange = exchange = SimulatedExchange(strategy.queue, self.series, **self.exchange_params)
+        # history requests at startup must only see the warm-up bars
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(exchange.start_ms / 1000 - loop.time())
+
+        strategy.connection = exchange
+        strategy.alert_manager = NullAlertManager()
+        # a monitor log line every few virtual seconds would cost more than the strategy
+        strategy.monitor_interval = None
+        strategy.latency_dump_interval = None
+        strategy.metrics_enabled = False
+        strategy.stall_threshold = None
+        run_task = asyncio.create_task(strategy.run())
+        finished_task = asyncio.create_task(exchange.finished.wait())
+        try:
+            await asyncio.wait([run_task, finished_task], return_when=asyncio.FIRST_COMPLETED)
+            if run_task.done():
+                # a strategy that fails to start ends the backtest
+                run_task.result()
+        finally:
+            await strategy.exit()
+            pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def _result(self, elapsed_s: float) -> BacktestResult:
+        exchange = self.exchange
+        equity = pd.Series(exchange.equity_curve(), index=pd.to_datetime(exchange.timeline, unit='ms'), name='equity')
+        trades = pd.DataFrame(exchange.trades,
+                              columns=['timestamp_ms', 'inst_id', 'action', 'size', 'price', 'fee', 'pnl'])
+        trades.insert(0, 'datetime', pd.to_datetime(trades['timestamp_ms'], unit='ms'))
+        errors = (sum(stats.errors for stats in self.strategy.handler_stats.values())
+                  + sum(subscription.errors for subscription in self.strategy.subscriptions))
+        return BacktestResult(equity=equity, trades=trades, bar_timings_s=np.array(exchange.bar_timings_s),
+                              elapsed_s=elapsed_s, balance=exchange.balance, errors=errors)
@@ -0,0 +1,289 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from Exchange.Okx import timeframe_ms
+from Exchange.candle_cache import CandleCache
+from Exchange.rate_limit import RateLimiter
+from Structures.private import *
+from Structures.public import *
+from Structures.trade import *
+from Tools.logger import Logger
+from Tools.queues import ChannelQueues
+
+logger = Logger(__name__).logger
+
+SeriesKey = Tuple[str, str]
+
+
+class SimulatedExchange:
+    """Stands in for OkxConnection in a backtest.
+
+    Bars of every (inst_id, timeframe) series are published on the public queue when they
+    close on the event-loop clock, the first `warmup_bars` of each series are only served as
+    history. Market orders fill at the last published close plus slippage and the fill,
+    positions and account updates go through the private queue like the live ones.
+    """
+
+    def __init__(self, queue: ChannelQueues, series: Dict[SeriesKey, np.ndarray], warmup_bars: int = 0,
+                 balance: float = 10_000., fee_rate: float = 0.0005, slippage: float = 0.0002,
+                 instruments: Dict[str, InstrumentInfo] = None):
+        self.debug = False
+        self.queue = queue
+        self.rate_limiter = RateLimiter({})
+        self.series = series
+        self.warmup_bars = warmup_bars
+        self.balance = balance
+        self.fee_rate = fee_rate
+        self.slippage = slippage
+        self.instruments = instruments or {}
+
+        self._close_ms: Dict[SeriesKey, np.ndarray] = {}
+        for key, records in series.items():
+            bar_ms = timeframe_ms(key[1])
+            if bar_ms is None:
+                raise ValueError(f'Unsupported backtest timeframe: {key[1]}')
+            self._close_ms[key] = records['timestamp_ms'] + bar_ms
+
+        keys = list(series)
+        closes = [self._close_ms[key][warmup_bars:] for key in keys]
+        self.timeline = np.unique(np.concatenate(closes))
+        if warmup_bars:
+            self.start_ms = int(min(self._close_ms[key][warmup_bars - 1] for key in keys))
+        else:
+            self.start_ms = int(min(series[key]['timestamp_ms'][0] for key in keys))
+
+        # every bar to publish as (close_ms, series, row), ordered by close time then series
+        key_index = np.concatenate([np.full(len(close), i) for i, close in enumerate(closes)])
+        rows = np.concatenate([np.arange(warmup_bars, warmup_bars + len(close)) for close in closes])
+        close_ms = np.concatenate(closes)
+        order = np.lexsort((key_index, close_ms))
+        self._events = list(zip(close_ms[order].tolist(), key_index[order].tolist(), rows[order].tolist()))
+        self._keys = keys
+
+        # marks for the equity curve: the shortest timeframe of each instrument
+        self._mark_keys: Dict[str, SeriesKey] = {}
+        for key in sorted(keys, key=lambda key: timeframe_ms(key[1])):
+            self._mark_keys.setdefault(key[0], key)
+        self.inst_ids: List[str] = list(self._mark_keys)
+
+        self.prices: Dict[str, float] = {}
+        for key in keys:
+            if warmup_bars:
+                self.prices[key[0]] = float(series[key]['close'][warmup_bars - 1])
+        self.step = -1
+        self.cash = balance
+        self.positions: Dict[str, List[float]] = {}
+        self.inst_types: Dict[str, InstrumentType] = {}
+        self.fills: List[Tuple[int, int, float, float, float]] = []
+        self.trades: List[Dict] = []
+        self.bar_timings_s: List[float] = []
+
+        self.finished = asyncio.Event()
+        self.feed_task: asyncio.Task = None
+
+    # FEED
+    async def run(self):
+        # the snapshots OKX pushes on subscribing to the positions and account channels
+        await self.queue.private.put(self._positions_snapshot())
+        await self.queue.private.put(self._account_snapshot(datetime.fromtimestamp(self._now_ms() // 1000)))
+        self.feed_task = asyncio.create_task(self._feed())
+
+    async def exit(self):
+        if self.feed_task is not None and not self.feed_task.done():
+            self.feed_task.cancel()
+
+    def _now_ms(self) -> int:
+        return round(asyncio.get_running_loop().time() * 1000)
+
+    async def _feed(self):
+        loop = asyncio.get_running_loop()
+        # row by row from the (memory-mapped) records: a bulk .tolist() would copy every series per run
+        series = [self.series[key] for key in self._keys]
+        current_ms = None
+        started = None
+        try:
+            for close_ms, k, row in self._events:
+                if close_ms != current_ms:
+                    # the loop only gets here once everything triggered by the previous bar is idle
+                    await asyncio.sleep(close_ms / 1000 - loop.time())
+                    now = time.perf_counter()
+                    if started is not None:
+                        self.bar_timings_s.append(now - started)
+                    started = now
+                    current_ms = close_ms
+                    self.step += 1
+
+                inst_id, timeframe = self._keys[k]
+                ts, o, h, l, c, v = series[k][row].item()
+                self.prices[inst_id] = c
+                self.queue.public.put_nowait(RawCandle(inst_id, timeframe, ts, o, h, l, c, v))
+
+            # one more bar interval for the orders and timers triggered by the last bar
+            await asyncio.sleep(min(timeframe_ms(key[1]) for key in self._keys) / 1000)
+            if started is not None:
+                self.bar_timings_s.append(time.perf_counter() - started)
+        finally:
+            self.finished.set()
+
+    # PUBLIC DATA
+    async def get_history_candles(self, ticker: str, tf: str, num_bars: int) -> List[Candle]:
+        key = (ticker, tf)
+        if key not in self.series:
+            logger.error(f'No backtest candles for {ticker} {tf}')
+            return []
+        end = int(np.searchsorted(self._close_ms[key], self._now_ms(), side='right'))
+        return CandleCache.to_candles(self.series[key][max(end - num_bars, 0):end], ticker, tf)
+
+    async def get_instrument_info(self, inst_type: InstrumentType, uly: str = None, inst_id: str = None):
+        ticker = inst_id or (f'{uly}-SWAP' if inst_type == InstrumentType.SWAP else uly)
+        if ticker in self.instruments:
+            return self.instruments[ticker]
+        return InstrumentInfo(inst_type=inst_type, inst_id=ticker,
+                              contract_value=1. if inst_type == InstrumentType.SWAP else None,
+                              min_size=0., tick_size=None)
+
+    def _contract_value(self, ticker: str) -> float:
+        info = self.instruments.get(ticker)
+        return info.contract_value if info is not None and info.contract_value else 1.
+
+    # TRADING
+    async def place_order(self, order: Order) -> OrderResponse:
+        order_response, events = self._fill(order)
+        for event in events:
+            await self.queue.private.put(event)
+        return order_response
+
+    async def place_multiple_orders(self, orders: List[Order]) -> List[OrderResponse]:
+        return [await self.place_order(order) for order in orders]
+
+    async def submit_order(self, order: Order) -> OrderResponse:
+        return await self.place_order(order)
+
+    async def cancel_order(self, order_cancel: OrderCancel) -> OrderResponse:
+        return OrderResponse(status=OrderStatus.ERROR, order_id=order_cancel.order_id, op='cancel-order',
+                             msg='Market orders fill immediately in a backtest')
+
+    def _fill(self, order: Order) -> Tuple[OrderResponse, List]:
+        price = self.prices.get(order.ticker)
+        if price is None or order.ticker not in self._mark_keys:
+            return OrderResponse(status=OrderStatus.ERROR, order_id=order.id, op='order',
+                                 msg=f'No backtest prices for {order.ticker}'), []
+        if order.order_type != OrderType.MARKET or order.size <= 0:
+            return OrderResponse(status=OrderStatus.ERROR, order_id=order.id, op='order',
+                                 msg='Only market orders with a positive size are simulated'), []
+
+        if order.ticker.endswith('-SWAP'):
+            inst_type = InstrumentType.SWAP
+        else:
+            inst_type = InstrumentType.SPOT if order.trading_mode == TradingMode.CASH else InstrumentType.MARGIN
+        self.inst_types[order.ticker] = inst_type
+
+        buy = order.action == Action.BUY
+        fill_price = price * (1 + self.slippage if buy else 1 - self.slippage)
+        if order.target_ccy == TargetCcy.QUOTE_CCY:
+            qty = order.size / fill_price
+        else:
+            qty = order.size * self._contract_value(order.ticker)
+        signed = qty if buy else -qty
+        fee = qty * fill_price * self.fee_rate
+
+        pos, avg_px = self.positions.get(order.ticker, (0., 0.))
+        pnl = 0.
+        if pos and (pos > 0) != buy:
+            pnl = (fill_price - avg_px) * min(qty, abs(pos)) * (1 if pos > 0 else -1)
+        new_pos = pos + signed
+        if abs(new_pos) < 1e-12:
+            new_pos, avg_px = 0., 0.
+        elif not pos or (pos > 0) != (new_pos > 0):
+            avg_px = fill_price
+        elif (pos > 0) == buy:
+            avg_px = (avg_px * pos + fill_price * signed) / new_pos
+        self.positions[order.ticker] = [new_pos, avg_px]
+        self.cash -= signed * fill_price + fee
+
+        now_ms = self._now_ms()
+        self.fills.append((max(self.step, 0), self.inst_ids.index(order.ticker), signed, fill_price, fee))
+        self.trades.append({
+            'timestamp_ms': now_ms,
+            'inst_id': order.ticker,
+            'action': order.action.value,
+            'size': qty,
+            'price': fill_price,
+            'fee': fee,
+            'pnl': pnl,
+        })
+
+        fill_time = datetime.fromtimestamp(now_ms // 1000)
+        fill_order = FillOrder(
+            id=order.id,
+            ticker=order.ticker,
+            inst_type=inst_type,
+            posSide=None,
+            action=order.action,
+            size=order.size,
+            fill_price=fill_price,
+            fill_time=fill_time,
+            state=FillStatus.FILLED,
+            leverage=None,
+            fee=-fee,
+            pnl=pnl,
+            create_time=fill_time,
+        )
+        order_response = OrderResponse(status=OrderStatus.OK, order_id=order.id, op='order')
+        return order_response, [fill_order, self._positions_snapshot(), self._account_snapshot(fill_time)]
+
+    def _positions_snapshot(self) -> Positions:
+        positions = Positions()
+        for ticker, (pos, avg_px) in self.positions.items():
+            inst_type = self.inst_types[ticker]
+            if inst_type == InstrumentType.SPOT:
+                continue
+            price = self.prices[ticker]
+            positions.append(Position(
+                side=Side(float(pos)),
+                margin_ccy=ticker.split('-')[1],
+                instrument_type=inst_type,
+                instrument_id=ticker,
+                pos_size=pos / self._contract_value(ticker),
+                pos_ccy=ticker.split('-')[0] if inst_type == InstrumentType.MARGIN else '',
+                notional_usd=abs(pos) * price,
+                upl=(price - avg_px) * pos,
+            ))
+        return positions
+
+    def _account_snapshot(self, dt: datetime) -> Account:
+        # cash already paid for every position, so derivatives count back in at their mark
+        quote_equity = self.cash
+        coins = {}
+        for ticker, (pos, _) in self.positions.items():
+            if self.inst_types[ticker] == InstrumentType.SPOT:
+                ccy = ticker.split('-')[0]
+                coins[ccy] = CoinBalance(ccy=ccy, equity=pos, equity_usd=pos * self.prices[ticker])
+            else:
+                quote_equity += pos * self.prices[ticker]
+        coins['USDT'] = CoinBalance(ccy='USDT', equity=quote_equity, equity_usd=quote_equity)
+        total_usd = sum(coin.equity_usd for coin in coins.values())
+        return Account(coins=coins, datetime=dt, total_usd=total_usd, in_coins_usd=total_usd - quote_equity)
+
+    # RESULTS
+    def equity_curve(self) -> np.ndarray:
+        """Equity after each step of the timeline, marked at the latest close of every instrument."""
+        n_steps = len(self.timeline)
+        marks = np.zeros((n_steps, len(self.inst_ids)))
+        for i, inst_id in enumerate(self.inst_ids):
+            key = self._mark_keys[inst_id]
+            last = np.searchsorted(self._close_ms[key], self.timeline, side='right') - 1
+            marks[:, i] = np.where(last >= 0, self.series[key]['close'][last.clip(0)], 0.)
+
+        qty = np.zeros((n_steps, len(self.inst_ids)))
+        cash = np.zeros(n_steps)
+        if self.fills:
+            steps, insts, signed, price, fee = map(np.array, zip(*self.fills))
+            steps = steps.astype(int).clip(max=n_steps - 1)
+            np.add.at(qty, (steps, insts.astype(int)), signed)
+            np.add.at(cash, steps, -signed * price - fee)
+        return self.balance + cash.cumsum() + (qty.cumsum(axis=0) * marks).sum(axis=1)
@@ -0,0 +1,108 @@
+"""Grid or random search over strategy config values, one backtest per combination on a process pool.
+
+    space = {'supertrend.atr_period': [7, 10, 14], 'supertrend.mult': [2, 3, 4]}
+    table = Sweep(SupertrendStrategy, config, series, warmup_bars=100).run(grid(space))
+
+Parameters are dotted paths into the strategy config. The candles are written once to
+a CandleCache directory and every worker memory-maps the same files, so they are
+neither pickled per job nor copied per process.
+"""
+import copy
+import itertools
+import os
+import random
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Sequence, Tuple, Type, Union
+
+import numpy as np
+import pandas as pd
+
+from Backtest.engine import Backtester
+from Backtest.exchange import SeriesKey
+from Exchange.candle_cache import CandleCache
+from Strategy.StrategyBase import StrategyBase
+
+
+def grid(space: Dict[str, Sequence]) -> List[Dict[str, Any]]:
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*space.values())]
+
+
+def random_search(space: Dict[str, Union[Sequence, Tuple[float, float]]], n: int, seed: int = None) -> List[Dict]:
+    """`n` combinations; lists are sampled from, (low, high) tuples are drawn uniformly (integers if both bounds are)."""
+    rng = random.Random(seed)
+
+    def draw(values):
+        if isinstance(values, tuple):
+            low, high = values
+            return rng.randint(low, high) if isinstance(low, int) and isinstance(high, int) else rng.uniform(low, high)
+        return rng.choice(values)
+
+    return [{name: draw(values) for name, values in space.items()} for _ in range(n)]
+
+
+def apply_params(config: Dict, params: Dict[str, Any]) -> Dict:
+    config = copy.deepcopy(config)
+    for path, value in params.items():
+        *sections, key = path.split('.')
+        section = config
+        for name in sections:
+            section = section[name]
+        section[key] = value
+    return config
+
+
+# per-process state, set once by the pool initializer
+_worker: Dict[str, Any] = {}
+
+
+def _init_worker(strategy_cls: Type[StrategyBase], config: Dict, cache_dir: str, keys: List[SeriesKey],
+                 backtest_kwargs: Dict):
+    cache = CandleCache(cache_dir)
+    _worker.update(
+        strategy_cls=strategy_cls,
+        config=config,
+        series={key: cache.load(*key) for key in keys},
+        backtest_kwargs=backtest_kwargs,
+    )
+
+
+def _run_one(params: Dict[str, Any]) -> Dict[str, Any]:
+    config = apply_params(_worker['config'], params)
+    strategy_cls = _worker['strategy_cls']
+    try:
+        result = Backtester(lambda: strategy_cls(config), _worker['series'], **_worker['backtest_kwargs']).run()
+    except Exception as e:
+        return {**params, 'error': repr(e)}
+    return {**params, **result.summary()}
+
+
+class Sweep:
+    def __init__(self, strategy_cls: Type[StrategyBase], config: Dict, series: Dict[SeriesKey, np.ndarray],
+                 processes: int = None, **backtest_kwargs):
+        self.strategy_cls = strategy_cls
+        self.config = config
+        self.series = series
+        self.processes = processes or os.cpu_count()
+        self.backtest_kwargs = backtest_kwargs
+
+    def run(self, combinations: List[Dict[str, Any]], rank_by: str = 'return', ascending: bool = False) -> pd.DataFrame:
+        """Backtests every combination and returns them ranked by a BacktestResult.summary() column."""
+        with tempfile.TemporaryDirectory(prefix='sweep_') as cache_dir:
+            cache = CandleCache(cache_dir)
+            for (inst_id, tf), records in self.series.items():
+                cache.write_records(inst_id, tf, records)
+
+            initargs = (self.strategy_cls, self.config, cache_dir, list(self.series), self.backtest_kwargs)
+            # a few chunks per worker keeps the pipes quiet without leaving cores idle at the end
+            chunksize = max(1, len(combinations) // (self.processes * 4))
+            with ProcessPoolExecutor(self.processes, initializer=_init_worker, initargs=initargs) as pool:
+                rows = list(pool.map(_run_one, combinations, chunksize=chunksize))
+
+        table = pd.DataFrame(rows)
+        if rank_by in table:
+            table = table.sort_values(rank_by, ascending=ascending, na_position='last')
+        table = table.reset_index(drop=True)
+        table.index = pd.RangeIndex(1, len(table) + 1, name='rank')
+        return table
@@ -0,0 +1,81 @@
+"""Backtest throughput of the bundled strategies on random-walk candles, and a check that they trade.
+
+Every strategy must finish without handler errors, and the spot Markowitz strategy, which sizes its
+orders from the account snapshot, must place trades; the script exits with status 1 otherwise.
+
+Run from the repository root: python -m Benchmarks.backtest --bars 5000
+"""
+import argparse
+import sys
+from typing import Dict, List
+
+import numpy as np
+
+from Backtest.engine import Backtester
+from Backtest.exchange import SeriesKey
+from Exchange.candle_cache import CandleCache
+from Strategy.markowitz_spot import MarkowitzStrategy
+from Strategy.supertrend import SupertrendStrategy
+from Strategy.tutci import TutciStrategy
+
+START_MS = 1672531200000
+WARMUP_BARS = 100
+
+CONFIG = {
+    'api_key': '',
+    'secret_key': '',
+    'passphrase': '',
+    'channels_public': [],
+    'channels_private': [],
+    'okx_connection': {'public_ws_url': '', 'private_ws_url': '', 'trade_ws_url': '', 'rest_url': ''},
+    'telegram': {'token': '0:backtest', 'chat_id': 0},
+    'supertrend': {'trade_amount': 1, 'trade_ticker': 'ETH-USDT-SWAP', 'timeframe': '1m',
+                   'atr_period': 10, 'mult': 3, 'ema_leng': 50},
+    'tutci': {'trade_amount': 1, 'trade_ticker': 'ETH-USDT-SWAP', 'timeframe': '1m',
+              'enter_length': 20, 'exit_length': 10},
+    'markowitz': {'timeframe': '1m', 'tickers': ['BTC', 'ETH', 'SOL'], 'candle_history_length': 20,
+                  'ewma_halflife': 10, 'rebalance_interval': 600, 'trade_amount': 1000},
+}
+
+
+def random_walk(inst_id: str, bars: int, price: float, rng: np.random.Generator) -> Dict[SeriesKey, np.ndarray]:
+    close = price * np.exp(np.cumsum(rng.normal(0, .001, bars)))
+    open = np.r_[price, close[:-1]]
+    records = np.zeros(bars, dtype=CandleCache.DTYPE)
+    records['timestamp_ms'] = START_MS + np.arange(bars) * 60_000
+    records['open'] = open
+    records['close'] = close
+    records['high'] = np.maximum(open, close) * (1 + np.abs(rng.normal(0, .0005, bars)))
+    records['low'] = np.minimum(open, close) * (1 - np.abs(rng.normal(0, .0005, bars)))
+    records['volume'] = 1
+    return {(inst_id, '1m'): records}
+
+
+def main(bars: int, seed: int) -> List[str]:
+    rng = np.random.default_rng(seed)
+    swap = random_walk('ETH-USDT-SWAP', bars, 1800., rng)
+    spot = {}
+    for ccy, price in zip(CONFIG['markowitz']['tickers'], (20_000., 1800., 20.)):
+        spot.update(random_walk(f'{ccy}-USDT', bars, price, rng))
+
+    failures = []
+    for strategy_cls, series in ((SupertrendStrategy, swap), (TutciStrategy, swap), (MarkowitzStrategy, spot)):
+        name = f'{strategy_cls.__module__}.{strategy_cls.__name__}'
+        summary = Backtester(lambda: strategy_cls(CONFIG), series, warmup_bars=WARMUP_BARS).run().summary()
+        print(f'{name}: {summary}')
+        if summary['errors']:
+            failures.append(f"{name} raised {summary['errors']} errors")
+        if strategy_cls is MarkowitzStrategy and not summary['trades']:
+            failures.append(f'{name} placed no trades')
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bars', type=int, default=5000, help='1m bars per instrument')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    failures = main(args.bars, args.seed)
+    for failure in failures:
+        print(f'FAILED: {failure}')
+    sys.exit(1 if failures else 0)
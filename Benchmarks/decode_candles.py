@@ -0,0 +1,63 @@
+"""Messages per second of the public candle path: old json + Candle dataclass vs PublicDecoder.
+
+Run from the repository root: python -m Benchmarks.decode_candles
+"""
+import json
+import random
+import time
+
+from Exchange.Okx import OkxConnection
+from Exchange.decoders import JSON_BACKEND, PublicDecoder
+from Structures.candle_store import CandleBuffer
+
+
+def make_messages(n, rows=1):
+    messages = []
+    price = 1800.
+    for i in range(n):
+        data = []
+        for j in range(rows):
+            price += random.gauss(0, 1)
+            data.append([str(1672531200000 + (i * rows + j) * 60000), f'{price:.2f}', f'{price + 1:.2f}',
+                         f'{price - 1:.2f}', f'{price:.2f}', '12.5', '22500.1', '22500.1', '0'])
+        messages.append(json.dumps({'arg': {'channel': 'candle1m', 'instId': 'ETH-USDT-SWAP'}, 'data': data}))
+    return messages
+
+
+def old_path(messages):
+    for message in messages:
+        OkxConnection._candle_from_json(None, json.loads(message))
+
+
+def decoder_path(messages):
+    decoder = PublicDecoder()
+    for message in messages:
+        decoder.decode(message)
+
+
+def columnar_path(messages):
+    decoder = PublicDecoder()
+    buffer = CandleBuffer('ETH-USDT-SWAP', '1m', 1000)
+    for message in messages:
+        for row in decoder.decode_rows(message)[2]:
+            buffer.update_row(*row)
+
+
+def bench(fn, messages, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(messages)
+        best = min(best, time.perf_counter() - started)
+    return len(messages) / best
+
+
+if __name__ == '__main__':
+    for rows in (1, 100):
+        messages = make_messages(20000 // rows, rows)
+        print(f'rows per message: {rows}, json backend: {JSON_BACKEND}')
+        rates = {name: bench(fn, messages) for name, fn in [('json + Candle', old_path),
+                                                            ('PublicDecoder', decoder_path),
+                                                            ('PublicDecoder -> CandleBuffer', columnar_path)]}
+        for name, rate in rates.items():
+            print(f'  {name:<32} {rate:>12,.0f} msg/s  x{rate / rates["json + Candle"]:.2f}')
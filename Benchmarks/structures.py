@@ -0,0 +1,75 @@
+"""Bytes per object and construction rate for a million candles.
+
+Run from the repository root: python -m Benchmarks.structures
+"""
+import gc
+import time
+import tracemalloc
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from Structures.candle_store import CandleBuffer
+from Structures.public import Candle, RawCandle
+
+N = 1_000_000
+TS = 1672531200000
+
+
+@dataclass
+class LegacyCandle:
+    inst_id: Optional[str] = None
+    timestamp_ms: Optional[int] = None
+    datetime: Optional[datetime] = None
+    timeframe: Optional[str] = None
+    open: Optional[float] = None
+    high: Optional[float] = None
+    low: Optional[float] = None
+    close: Optional[float] = None
+    volume: Optional[float] = None
+
+
+def build_legacy(n):
+    return [LegacyCandle(inst_id='ETH-USDT', timeframe='1m', timestamp_ms=TS + i * 60000,
+                         datetime=datetime.fromtimestamp((TS + i * 60000) // 1000),
+                         open=1. * i, high=2. * i, low=.5 * i, close=1.5 * i, volume=3. * i) for i in range(n)]
+
+
+def build_slotted(n):
+    return [Candle(inst_id='ETH-USDT', timeframe='1m', timestamp_ms=TS + i * 60000,
+                   open=1. * i, high=2. * i, low=.5 * i, close=1.5 * i, volume=3. * i) for i in range(n)]
+
+
+def build_raw(n):
+    return [RawCandle('ETH-USDT', '1m', TS + i * 60000, 1. * i, 2. * i, .5 * i, 1.5 * i, 3. * i) for i in range(n)]
+
+
+def build_columnar(n):
+    buffer = CandleBuffer('ETH-USDT', '1m', n)
+    for i in range(n):
+        buffer.update_row(TS + i * 60000, 1. * i, 2. * i, .5 * i, 1.5 * i, 3. * i)
+    return buffer
+
+
+def measure(build, n=N):
+    gc.collect()
+    started = time.perf_counter()
+    objs = build(n)
+    elapsed = time.perf_counter() - started
+    del objs
+    gc.collect()
+
+    tracemalloc.start()
+    objs = build(n)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objs
+    return size / n, n / elapsed
+
+
+if __name__ == '__main__':
+    print(f'{"structure":<24} {"bytes/candle":>12} {"candles/s":>14}')
+    for name, build in [('dataclass (old Candle)', build_legacy), ('slotted Candle', build_slotted),
+                        ('RawCandle', build_raw), ('CandleBuffer row', build_columnar)]:
+        per_object, rate = measure(build)
+        print(f'{name:<24} {per_object:>12.0f} {rate:>14,.0f}')
@@ -0,0 +1,117 @@
+"""Tick-to-order latency and throughput of the StrategyBase stack against the local OKX simulator.
+
+The simulator runs in a child process so that it does not share the strategy's event loop;
+it timestamps every candle it sends and every order it receives.
+
+Run from the repository root: python -m Benchmarks.tick_to_order --rate 200 --seconds 20
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+
+import aiohttp
+
+from Exchange.simulator import OkxSimulator, RandomWalkFeed
+from Strategy.StrategyBase import EventKind, StrategyBase, StrategyEvent
+from Structures.public import *
+from Structures.trade import *
+from Tools.AlertManager import NullAlertManager
+from Tools.latency import tracer
+
+INST_ID = 'ETH-USDT-SWAP'
+
+CONFIG = {
+    'api_key': 'simulator',
+    'secret_key': 'simulator',
+    'passphrase': 'simulator',
+    'channels_public': [{'channel': 'candle1m', 'instId': INST_ID}],
+    'channels_private': [{'channel': 'account'},
+                         {'channel': 'positions', 'instType': 'ANY'},
+                         {'channel': 'orders', 'instType': 'ANY'}],
+    # OKX allows 60 orders per 2s, which would cap the measured throughput
+    'okx_connection': {'rate_limits': {}},
+    'telegram': {'token': '0:simulator', 'chat_id': 0},
+}
+
+
+class PingStrategy(StrategyBase):
+    """Places one market order for every forming-bar update it is woken for."""
+
+    def __init__(self, config):
+        super().__init__(config, 'Ping', debug=False)
+        self.alert_manager = NullAlertManager()
+        self.subscribe(self.ping, on=(EventKind.UPDATE,))
+
+    async def ping(self, event: StrategyEvent):
+        for inst_id in event.inst_ids:
+            order = Order(action=Action.BUY, size=1, ticker=inst_id,
+                          trading_mode=TradingMode.CROSS, order_type=OrderType.MARKET)
+            await self.connection.order_batcher.submit(order)
+
+    async def candle_handler(self, candle: Candle):
+        pass
+
+    async def account_handler(self, account):
+        pass
+
+    async def positions_handler(self, positions):
+        pass
+
+    async def fill_order_handler(self, fill_order):
+        pass
+
+    async def order_response_handler(self, order_response):
+        pass
+
+
+def run_simulator(rate: float, ports):
+    async def main():
+        simulator = OkxSimulator(rate=rate)
+        simulator.add_feed(RandomWalkFeed(INST_ID, '1m', price=1800., history_bars=300, seed=1))
+        await simulator.start()
+        ports.send((simulator.ws_port, simulator.rest_port))
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+async def bench(rate: float, seconds: float):
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=run_simulator, args=(rate, sender), daemon=True)
+    process.start()
+    ws_port, rest_port = receiver.recv()
+
+    config = OkxSimulator(ws_port=ws_port, rest_port=rest_port).patch_config(CONFIG)
+    strategy = PingStrategy(config)
+    run_task = asyncio.create_task(strategy.run())
+    await asyncio.sleep(seconds)
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{config['okx_connection']['rest_url']}/sim/stats") as response:
+            stats = await response.json()
+    await strategy.exit()
+    run_task.cancel()
+    process.terminate()
+
+    print(f'rate: {rate}/s, {seconds}s')
+    print(json.dumps(stats, indent=2))
+    print(f'queues: {strategy.queue.metrics()}')
+    for name, handler_stats in strategy.handler_stats.items():
+        print(f'{name:>14}: {handler_stats.count} calls, mean {handler_stats.mean_s * 1e6:.1f}us, '
+              f'max {handler_stats.max_s * 1e6:.1f}us')
+    print('stages:')
+    for stage, summary in tracer.summary().items():
+        print(f'{stage:>14}: {summary}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', type=float, default=200., help='candle updates per second, 0 for unpaced')
+    parser.add_argument('--seconds', type=float, default=10.)
+    parser.add_argument('--quiet', action='store_true', help='no per-order log lines')
+    args = parser.parse_args()
+    if args.quiet:
+        logging.getLogger('Exchange.Okx').setLevel(logging.ERROR)
+    asyncio.run(bench(args.rate, args.seconds))
@@ -5,7 +5,8 @@ import hmac
 import json
 import random
 import time
-from typing import Dict, Any
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
 from urllib.parse import urlencode
 
 import aiohttp as aiohttp
@@ -14,10 +15,48 @@ import websockets
 from Structures.private import *
 from Structures.public import *
 from Structures.trade import *
+from Exchange.candle_cache import CandleCache
+from Exchange.decoders import PublicDecoder
+from Exchange.multiplexer import RequestMultiplexer
+from Exchange.order_batcher import OrderBatcher
+from Exchange.rate_limit import RateLimiter
+from Tools.latency import tracer
 from Tools.logger import Logger
+from Tools.metrics import registry
+from Tools.queues import ChannelQueues
 
 logger = Logger(__name__).logger
 
+WS_MESSAGES = registry.counter('tradebot_ws_messages_total', 'Websocket messages received', ('ws', 'channel'))
+WS_RECONNECTS = registry.counter('tradebot_ws_reconnects_total', 'Reconnects of the public, private and trade websockets')
+ORDER_ROUND_TRIP = registry.histogram('tradebot_order_round_trip_seconds', 'Trade websocket request to its response',
+                                      ('op',))
+ORDER_ERRORS = registry.counter('tradebot_order_errors_total', 'Orders the exchange rejected or did not answer',
+                                ('op',))
+ORDER_FILL = registry.histogram('tradebot_order_fill_seconds', 'Order sent to its fill on the orders channel',
+                                buckets=(.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 300.))
+REST_REQUESTS = registry.counter('tradebot_rest_requests_total', 'REST requests by endpoint and HTTP status',
+                                 ('path', 'status'))
+REST_SECONDS = registry.histogram('tradebot_rest_request_seconds', 'REST request duration', ('path',))
+
+
+BATCH_ORDERS_LIMIT = 20
+# `code` of the response made up for a trade request that got no answer in time
+TIMEOUT_CODE = 'timeout'
+ORDERS_AWAITING_FILL_LIMIT = 10_000
+HISTORY_CANDLES_LIMIT = 100
+HISTORY_CANDLES_CONCURRENCY = 4
+TIMEFRAME_UNIT_MS = {'m': 60_000, 'H': 3_600_000, 'D': 86_400_000, 'W': 604_800_000}
+
+
+def timeframe_ms(tf: str) -> Optional[int]:
+    """Bar length of an OKX timeframe such as '15m', '4H' or '1Dutc'; None for months."""
+    tf = tf.replace('utc', '')
+    unit_ms = TIMEFRAME_UNIT_MS.get(tf[-1:])
+    if unit_ms is None or not tf[:-1].isdigit():
+        return None
+    return int(tf[:-1]) * unit_ms
+
 
 class Method(Enum):
     GET = 'GET'
@@ -25,6 +64,14 @@ class Method(Enum):
     SET = 'SET'
 
 
+def response_status(code: str) -> OrderStatus:
+    if code == '0':
+        return OrderStatus.OK
+    if code == TIMEOUT_CODE:
+        return OrderStatus.TIMEOUT
+    return OrderStatus.ERROR
+
+
 async def handle_rest_response(result: aiohttp.ClientResponse) -> Dict:
     if result.status != 200:
         error_msg = await result.text()
@@ -35,7 +82,7 @@ async def handle_rest_response(result: aiohttp.ClientResponse) -> Dict:
 
 
 class OkxConnection:
-    def __init__(self, config, queue, debug=True):
+    def __init__(self, config, queue: ChannelQueues, debug=True):
         self.debug = debug
 
         self.reconnect_interval = 3600
@@ -55,25 +102,64 @@ class OkxConnection:
         self.public_ws: websockets.WebSocketServerProtocol = None
         self.private_ws: websockets.WebSocketServerProtocol = None
         self.trade_ws: websockets.WebSocketServerProtocol = None
+        self.trade_mux: RequestMultiplexer = None
+        self.trade_timeout = self.config['okx_connection'].get('trade_timeout', 5)
+        self.order_batcher = OrderBatcher(self)
+        self.rate_limiter = RateLimiter(self.config['okx_connection'].get('rate_limits'))
         self.rest_session: aiohttp.ClientSession = None
 
+        self.public_decoder = PublicDecoder()
+        cache_dir = self.config['okx_connection'].get('candle_cache_dir')
+        self.candle_cache = CandleCache(cache_dir) if cache_dir else None
+
         self.listening_tasks = []
         self.reconnect_task = None
+        self.closing = False
+        # clOrdId -> perf_counter when sent, until filled or cancelled
+        self._awaiting_fill: OrderedDict = OrderedDict()
 
     # WS LISTENERS
     async def _listen_to_public_ws(self):
         while True:
             message = await self.public_ws.recv()
-            msg_json = json.loads(message)
-            obj = self._object_from_json_public(msg_json)
-            self.queue.put_nowait(obj)
+            received = time.perf_counter_ns()
+            try:
+                candles = self.public_decoder.decode(message)
+            except Exception as e:
+                logger.error(f'Public processing object error: \n{message}\n{e}', )
+                continue
+            decoded = time.perf_counter_ns()
+            WS_MESSAGES.labels('public', f'candle{candles[0].timeframe}' if candles else 'event').inc()
+            for candle in candles:
+                self.queue.public.put_nowait(candle)
+            if tracer.enabled:
+                tracer.on_public(candles, received, decoded, time.perf_counter_ns())
 
     async def _listen_to_private_ws(self):
         while True:
             message = await self.private_ws.recv()
             msg_json = json.loads(message)
+            WS_MESSAGES.labels('private', msg_json.get('arg', {}).get('channel', 'event')).inc()
             obj = self._object_from_json_private(msg_json)
-            self.queue.put_nowait(obj)
+            if isinstance(obj, FillOrder):
+                self._observe_fill(obj)
+            if obj is not None:
+                await self.queue.private.put(obj)
+
+    def _sent_orders(self, orders: List[Order]):
+        now = time.perf_counter()
+        for order in orders:
+            self._awaiting_fill[order.id] = now
+        while len(self._awaiting_fill) > ORDERS_AWAITING_FILL_LIMIT:
+            self._awaiting_fill.popitem(last=False)
+
+    def _observe_fill(self, fill_order: FillOrder):
+        if fill_order.state in (FillStatus.FILLED, FillStatus.PARTIALLY_FILLED):
+            sent = self._awaiting_fill.get(fill_order.id)
+            if sent is not None:
+                ORDER_FILL.observe(time.perf_counter() - sent)
+        if fill_order.state in (FillStatus.FILLED, FillStatus.CANCELED):
+            self._awaiting_fill.pop(fill_order.id, None)
 
     # OBJECT CONVERTERS
     def _object_from_json_public(self, msg: Dict) -> Any:
@@ -120,7 +206,6 @@ class OkxConnection:
             candle = Candle(
                 inst_id=inst_id,
                 timeframe=timeframe,
-                datetime=datetime.fromtimestamp(int(data[0]) // 1000),
                 timestamp_ms=int(data[0]),
                 open=float(data[1]),
                 high=float(data[2]),
@@ -134,9 +219,15 @@ class OkxConnection:
             return candles
         return candles[0]
 
-    def _positions_from_json(self, msg: Dict) -> List[Position]:
+    def _candles_from_json(self, msg: Dict, **params) -> List[Candle]:
+        if not msg.get('data'):
+            return []
+        candles = self._candle_from_json(msg, **params)
+        return candles if isinstance(candles, list) else [candles]
+
+    def _positions_from_json(self, msg: Dict) -> Positions:
         # print(f'Position: \n{msg}')
-        positions = []
+        positions = Positions()
         for data in msg['data']:
             pos = Position(
                 side=Side(float(data['pos'])) if InstrumentType(data['instType']) == InstrumentType.SWAP else Side(data['posSide']),
@@ -169,25 +260,25 @@ class OkxConnection:
         return Account(coins=coins, datetime=dt, total_usd=total_usd, in_coins_usd=total_usd - usdt)
 
     def _order_response_from_json(self, msg: Dict) -> OrderResponse:
+        data = msg.get('data') or [{}]
         return OrderResponse(
             op=msg['op'],
             order_id=msg['id'],
-            status=OrderStatus.OK if msg['code'] == '0' else OrderStatus.ERROR,
-            msg=msg['data'][0]['sMsg'],
+            status=response_status(msg['code']),
+            msg=data[0].get('sMsg') or msg.get('msg', ''),
         )
 
-    def _multiple_order_response_from_json(self, msg: Dict) -> List[OrderResponse]:
-        order_responses = []
+    def _multiple_order_response_from_json(self, msg: Dict) -> Dict[str, OrderResponse]:
+        order_responses = {}
         op = msg['op']
-        id = msg['id']
-        for d in msg['data']:
+        for d in msg.get('data') or []:
             order_response = OrderResponse(
                 op=op,
-                order_id=id,
-                status=OrderStatus.OK if msg['code'] == '0' else OrderStatus.ERROR,
-                # data=msg['data']
+                order_id=d['clOrdId'],
+                status=OrderStatus.OK if d.get('sCode') == '0' else OrderStatus.ERROR,
+                msg=d.get('sMsg', ''),
             )
-            order_responses.append(order_response)
+            order_responses[d['clOrdId']] = order_response
         return order_responses
 
     def _fill_order_from_json(self, msg: Dict) -> FillOrder:
@@ -222,63 +313,45 @@ class OkxConnection:
         return instrument_info
 
     # OBJECT TO JSON CONVERTERS
-    def _order_to_json(self, order: Order) -> json:  # TODO: long/short or buy/sell account setting
+    def _order_to_arg(self, order: Order) -> Dict:  # TODO: long/short or buy/sell account setting
         pos_side_map = {Side.LONG: 'long', Side.SHORT: 'short'}
         action_map = {Action.BUY: 'buy', Action.SELL: 'sell'}
         tdMode_map = {TradingMode.CROSS: 'cross', TradingMode.ISOLATED: 'isolated', TradingMode.CASH: 'cash'}
         ordType_map = {OrderType.MARKET: 'market', OrderType.LIMIT: 'limit'}
         tgtCcy_map = {TargetCcy.BASE_CCY: 'base_ccy', TargetCcy.QUOTE_CCY: 'quote_ccy'}
 
+        arg = {
+            "side": action_map[order.action],
+            "sz": order.size,
+            "instId": order.ticker,
+            "tdMode": tdMode_map[order.trading_mode],
+            "ordType": ordType_map[order.order_type],
+            "clOrdId": order.id,
+
+            "tgtCcy": tgtCcy_map[order.target_ccy] if order.target_ccy else None,
+            'ccy': order.margin_ccy,
+        }
+        return {k: v for k, v in arg.items() if v is not None}
+
+    def _order_to_json(self, order: Order) -> json:
         msg = {
             "id": order.id,
             "op": "order",
-            "args": [
-                {
-                    "side": action_map[order.action],
-                    "sz": order.size,
-                    "instId": order.ticker,
-                    "tdMode": tdMode_map[order.trading_mode],
-                    "ordType": ordType_map[order.order_type],
-                    "clOrdId": order.id,
-
-                    "tgtCcy": tgtCcy_map[order.target_ccy] if order.target_ccy else None,
-                    'ccy': order.margin_ccy,
-                }
-            ]
+            "args": [self._order_to_arg(order)]
         }
-        for k, v in msg.items():
-            if v is None:
-                msg.pop(k)
-
         return json.dumps(msg, separators=(",", ":"))
 
-    def _multiple_orders_to_json(self, orders: List[Order]):
-        pos_side_map = {Side.LONG: 'long', Side.SHORT: 'short'}
-        action_map = {Action.BUY: 'buy', Action.SELL: 'sell'}
-        tdMode_map = {TradingMode.CROSS: 'cross', TradingMode.ISOLATED: 'isolated', TradingMode.CASH: 'cash'}
-        ordType_map = {OrderType.MARKET: 'market', OrderType.LIMIT: 'limit'}
-        tgtCcy_map = {TargetCcy.BASE_CCY: 'base_ccy', TargetCcy.QUOTE_CCY: 'quote_ccy'}
-        args = []
-        for order in orders:
-            arg = {
-                "side": action_map[order.action],
-                "instId": order.ticker,
-                "tdMode": tdMode_map[order.trading_mode],
-                "ordType": ordType_map[order.order_type],
-                "sz": order.size,
-                "tgtCcy": tgtCcy_map[order.target_ccy],
-            }
-            args.append(arg)
+    def _multiple_orders_to_json(self, orders: List[Order], msg_id: str):
         msg = {
-            "id": id_generator(),
+            "id": msg_id,
             "op": "batch-orders",
-            "args": args
+            "args": [self._order_to_arg(order) for order in orders]
         }
         return json.dumps(msg, separators=(",", ":"))
 
-    def _order_cancel_to_json(self, order_cancel: OrderCancel):
+    def _order_cancel_to_json(self, order_cancel: OrderCancel, msg_id: str):
         msg = {
-            "id": id_generator(),
+            "id": msg_id,
             "op": "cancel-order",
             "args": [
                 {
@@ -290,44 +363,159 @@ class OkxConnection:
         return json.dumps(msg, separators=(",", ":"))
 
     # TRADE API
+    async def _trade_request(self, msg_id: str, op: str, payload: str, cost: int = 1, inst_ids=()) -> Dict:
+        await self.rate_limiter.acquire(op, cost=cost)
+        traced = tracer.enabled and inst_ids
+        if traced:
+            tracer.on_send(msg_id, inst_ids)
+        started = time.perf_counter()
+        try:
+            response = await self.trade_mux.request(msg_id, payload)
+            if traced:
+                tracer.on_ack(msg_id)
+            return response
+        except asyncio.TimeoutError:
+            return {'id': msg_id, 'op': op, 'code': TIMEOUT_CODE, 'msg': f'No response in {self.trade_mux.timeout}s',
+                    'data': []}
+        except (ConnectionError, RuntimeError, websockets.ConnectionClosed) as e:
+            # the trade reader is down or the request could not be sent, nothing reached the exchange
+            return {'id': msg_id, 'op': op, 'code': '-1', 'msg': f'Trade request failed: {e!r}', 'data': []}
+        finally:
+            ORDER_ROUND_TRIP.labels(op).observe(time.perf_counter() - started)
+            if traced:
+                # a no-op once acknowledged; timeouts and failures must not land in the ack stages
+                tracer.discard(msg_id)
+
     async def place_order(self, order: Order) -> OrderResponse:
         if self.debug:
             order.size = 0
-        logger.warning(f'Placing order: {order}')
-        await self.trade_ws.send(self._order_to_json(order))
-        response = await self.trade_ws.recv()
-        response = json.loads(response)
+        logger.warning('Placing order: %s', order)
+        self._sent_orders([order])
+        response = await self._trade_request(order.id, 'order', self._order_to_json(order), inst_ids=(order.ticker,))
         order_response = self._order_response_from_json(response)
         if order_response.status == OrderStatus.OK:
-            logger.warning(f'Order placed: {order_response}')
+            logger.warning('Order placed: %s', order_response)
+        elif order_response.status == OrderStatus.TIMEOUT:
+            ORDER_ERRORS.labels('order').inc()
+            logger.error('Order outcome unknown: %s', order_response)
         else:
-            logger.error(f'Order not placed: {order_response}')
+            ORDER_ERRORS.labels('order').inc()
+            self._awaiting_fill.pop(order.id, None)
+            logger.error('Order not placed: %s', order_response)
         return order_response
 
-    async def place_multiple_orders(self, orders: List[Order]):
-        if not self.debug:
-            await self.trade_ws.send(self._multiple_orders_to_json(orders))
-            response = await self.trade_ws.recv()
-            response = json.loads(response)
-            orders_response = self._multiple_order_response_from_json(response)
-            return orders_response
-        logger.debug(f'Placing multiple order: {orders}')
+    async def place_multiple_orders(self, orders: List[Order]) -> List[OrderResponse]:
+        if self.debug:
+            for order in orders:
+                order.size = 0
+        logger.warning('Placing multiple orders: %s', orders)
+
+        async def place_batch(batch):
+            msg_id = id_generator()
+            self._sent_orders(batch)
+            response = await self._trade_request(msg_id, 'batch-orders', self._multiple_orders_to_json(batch, msg_id),
+                                                 cost=len(batch), inst_ids={order.ticker for order in batch})
+            order_responses = self._multiple_order_response_from_json(response)
+            return [
+                order_responses.get(order.id) or OrderResponse(
+                    status=OrderStatus.TIMEOUT if response.get('code') == TIMEOUT_CODE else OrderStatus.ERROR,
+                    order_id=order.id, op='batch-orders', msg=response.get('msg', ''))
+                for order in batch
+            ]
 
-    async def cancel_order(self, order_cancel: OrderCancel):
-        await self.trade_ws.send(self._order_cancel_to_json(order_cancel))
+        batches = [orders[i:i + BATCH_ORDERS_LIMIT] for i in range(0, len(orders), BATCH_ORDERS_LIMIT)]
+        orders_response = [r for batch in await asyncio.gather(*map(place_batch, batches)) for r in batch]
+        for order_response in orders_response:
+            if order_response.status == OrderStatus.TIMEOUT:
+                ORDER_ERRORS.labels('batch-orders').inc()
+                logger.error('Order outcome unknown: %s', order_response)
+            elif order_response.status != OrderStatus.OK:
+                ORDER_ERRORS.labels('batch-orders').inc()
+                self._awaiting_fill.pop(order_response.order_id, None)
+                logger.error('Order not placed: %s', order_response)
+        return orders_response
+
+    def submit_order(self, order: Order) -> 'asyncio.Future[OrderResponse]':
+        """Queues the order for the batch sent at the end of the current event-loop tick."""
+        return self.order_batcher.submit(order)
+
+    async def cancel_order(self, order_cancel: OrderCancel) -> OrderResponse:
+        msg_id = id_generator()
+        response = await self._trade_request(msg_id, 'cancel-order', self._order_cancel_to_json(order_cancel, msg_id))
+        return self._order_response_from_json(response)
 
     # ACC API
     async def set_leverage(self, inst_id: str, leverage: int, margin_mode: TradingMode):
         await self._rest_set_leverage(instId=inst_id, lever=leverage, mgnMode=margin_mode)
 
-    async def get_history_candles(self, ticker: str, tf: str, num_bars: int):
-        candles = []
-        for i in range((num_bars // 100) + 1):
-            msg = await self._rest_get_history_candles(instId=ticker, bar=tf)
-            candle = self._candle_from_json(msg, instId=ticker, timeframe=tf)
-            candles.extend(candle[::-1])
+    async def get_history_candles(self, ticker: str, tf: str, num_bars: int) -> List[Candle]:
+        if self.candle_cache is None:
+            return await self._fetch_history_candles(ticker, tf, num_bars)
+
+        bar_ms = timeframe_ms(tf)
+        now = int(time.time() * 1000)
+        cached = self.candle_cache.to_candles(self.candle_cache.load(ticker, tf)[-num_bars:], ticker, tf)
+        missing = None
+        if cached and bar_ms is not None:
+            missing = (now - cached[-1].timestamp_ms) // bar_ms
+        synced = missing is not None and missing <= num_bars <= len(cached) + missing
+
+        if synced:
+            # only the tail after the last cached bar, the rest is served from disk
+            fetched = await self._fetch_history_candles(ticker, tf, missing)
+            candles = {candle.timestamp_ms: candle for candle in cached}
+            candles.update((candle.timestamp_ms, candle) for candle in fetched)
+            candles = [candles[ts] for ts in sorted(candles)]
+        else:
+            # cold, too short or too stale to be contiguous with the tail: start over
+            candles = await self._fetch_history_candles(ticker, tf, num_bars)
+
+        if bar_ms is None:
+            closed = candles[:-1]
+        else:
+            closed = [candle for candle in candles if candle.timestamp_ms + bar_ms <= now]
+        if synced:
+            self.candle_cache.append(ticker, tf, closed)
+        elif closed:
+            self.candle_cache.write(ticker, tf, closed)
         return candles[-num_bars:]
 
+    async def _fetch_history_candles(self, ticker: str, tf: str, num_bars: int) -> List[Candle]:
+        bar_ms = timeframe_ms(tf)
+        candles = {}
+        if bar_ms is not None:
+            # disjoint [after - page, after) windows can be fetched at the same time
+            semaphore = asyncio.Semaphore(HISTORY_CANDLES_CONCURRENCY)
+            newest = int(time.time() * 1000) + 1
+            page_ms = HISTORY_CANDLES_LIMIT * bar_ms
+
+            async def fetch(page):
+                async with semaphore:
+                    return await self._get_history_candles_page(ticker, tf, after=newest - page * page_ms)
+
+            pages = await asyncio.gather(*(fetch(page) for page in range(-(-num_bars // HISTORY_CANDLES_LIMIT))))
+            for page in pages:
+                candles.update((candle.timestamp_ms, candle) for candle in page)
+
+        # walk the cursor back for months or when the windows came back short (gaps, young instruments)
+        while len(candles) < num_bars:
+            page = await self._get_history_candles_page(ticker, tf, after=min(candles) if candles else None)
+            new = [candle for candle in page if candle.timestamp_ms not in candles]
+            if not new:
+                break
+            candles.update((candle.timestamp_ms, candle) for candle in new)
+
+        return [candles[ts] for ts in sorted(candles)][-num_bars:]
+
+    async def _get_history_candles_page(self, ticker: str, tf: str, after: int = None) -> List[Candle]:
+        params = {'instId': ticker, 'bar': tf, 'limit': HISTORY_CANDLES_LIMIT}
+        if after is not None:
+            params['after'] = after
+        msg = await self._rest_get_history_candles(**params)
+        if msg.get('code') != '0':
+            raise RuntimeError(f'History candles error for {ticker} {tf}: {msg.get("msg")}')
+        return self._candles_from_json(msg, instId=ticker, timeframe=tf)
+
     async def get_instrument_info(self, inst_type: InstrumentType, uly: str = None, inst_id: str = None):
         msg = None
         if inst_type == InstrumentType.SPOT:
@@ -342,7 +530,7 @@ class OkxConnection:
     # REST API
     async def _rest_place_order(self, **params):
         if self.debug:
-            logger.warning(f'Placing order: {params}')
+            logger.warning('Placing order: %s', params)
             return
         return await self._signed_rest_request(
             Method.POST, "/api/v5/trade/order", params=params
@@ -372,16 +560,26 @@ class OkxConnection:
         }
 
     async def _signed_rest_request(self, method: Method, path: str, params: Dict[str, Any]) -> Dict:
+        await self.rate_limiter.acquire(path)
         headers = self._get_headers(method, path, params)
-        if method == Method.GET:
-            path = path + "?" + urlencode(params)
+        endpoint = path
+        status = 'exception'
+        started = time.perf_counter()
+        try:
+            if method == Method.GET:
+                path = path + "?" + urlencode(params)
 
-            async with self.rest_session.get(f"{self.rest_url}{path}", headers=headers, data={}) as result:
-                return await handle_rest_response(result)
+                async with self.rest_session.get(f"{self.rest_url}{path}", headers=headers, data={}) as result:
+                    status = result.status
+                    return await handle_rest_response(result)
 
-        elif method == Method.POST:
-            async with self.rest_session.post(f"{self.rest_url}{path}", headers=headers, json=params) as result:
-                return await handle_rest_response(result)
+            elif method == Method.POST:
+                async with self.rest_session.post(f"{self.rest_url}{path}", headers=headers, json=params) as result:
+                    status = result.status
+                    return await handle_rest_response(result)
+        finally:
+            REST_REQUESTS.labels(endpoint, status).inc()
+            REST_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
 
     def _get_signature(self, method: Method, path: str, params: Dict, timestamp: str):
         if params:
@@ -453,9 +651,30 @@ class OkxConnection:
     async def _setup_trade(self):
         self.trade_ws = await websockets.connect(self.trade_ws_url, ping_interval=20)
         await self._login(self.trade_ws, 'TRADE')
+        self.trade_mux = RequestMultiplexer(self.trade_ws, timeout=self.trade_timeout, on_closed=self._trade_closed)
         logger.warning(f'Trade setup done')
 
+    def _trade_closed(self):
+        if self.closing or (self.reconnect_task is not None and not self.reconnect_task.done()):
+            return
+        self.reconnect_task = asyncio.create_task(self._reconnect_trade())
+
+    async def _reconnect_trade(self):
+        delay = 1
+        while True:
+            WS_RECONNECTS.inc()
+            try:
+                await self._setup_trade()
+                break
+            except Exception as e:
+                logger.error(f'Trade reconnect failed, retrying in {delay}s: {e!r}')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+        self.listening_tasks = [task for task in self.listening_tasks if not task.done()]
+        self.listening_tasks.append(self.trade_mux.start())
+
     async def _reconnect(self):
+        WS_RECONNECTS.inc()
         try:
             for task in self.listening_tasks:
                 if task is not None and not task.done():
@@ -480,15 +699,18 @@ class OkxConnection:
         self.listening_tasks = [
             asyncio.create_task(self._listen_to_public_ws()),
             asyncio.create_task(self._listen_to_private_ws()),
+            self.trade_mux.start(),
         ]
 
     async def run(self):
         await self._setup()
 
     async def exit(self):
+        self.closing = True
+        await self.order_batcher.close()
         await self.rest_session.close()
         for ws in [self.public_ws, self.private_ws, self.trade_ws]:
             await ws.close()
         for task in [*self.listening_tasks, self.reconnect_task]:
-            if not task.done():
+            if task is not None and not task.done():
                 task.cancel()
@@ -0,0 +1,72 @@
+import os
+from typing import Iterable, List
+
+import numpy as np
+
+from Structures.public import Candle
+
+
+class CandleCache:
+    """Append-only binary candle columns per (inst_id, timeframe), read back memory-mapped.
+
+    Only closed bars are written, so a cached bar never changes and a restart
+    only has to fetch the tail after the last cached timestamp.
+    """
+    DTYPE = np.dtype([
+        ('timestamp_ms', '<i8'),
+        ('open', '<f8'),
+        ('high', '<f8'),
+        ('low', '<f8'),
+        ('close', '<f8'),
+        ('volume', '<f8'),
+    ])
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, inst_id: str, tf: str) -> str:
+        return os.path.join(self.directory, f'{inst_id}_{tf}.bin')
+
+    def load(self, inst_id: str, tf: str) -> np.ndarray:
+        path = self.path(inst_id, tf)
+        if not os.path.exists(path) or os.path.getsize(path) < self.DTYPE.itemsize:
+            return np.empty(0, dtype=self.DTYPE)
+        # a crash mid-append can leave a partial record at the end, ignore it
+        count = os.path.getsize(path) // self.DTYPE.itemsize
+        return np.memmap(path, dtype=self.DTYPE, mode='r', shape=(count,))
+
+    @classmethod
+    def to_records(cls, candles: Iterable[Candle]) -> np.ndarray:
+        return np.array([(c.timestamp_ms, c.open, c.high, c.low, c.close, c.volume) for c in candles],
+                        dtype=cls.DTYPE)
+
+    def append(self, inst_id: str, tf: str, candles: List[Candle]):
+        cached = self.load(inst_id, tf)
+        last_ts = int(cached['timestamp_ms'][-1]) if len(cached) else None
+        count = len(cached)
+        del cached
+
+        new = [c for c in candles if last_ts is None or c.timestamp_ms > last_ts]
+        if not new:
+            return
+        path = self.path(inst_id, tf)
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+            f.seek(count * self.DTYPE.itemsize)
+            f.truncate()
+            self.to_records(new).tofile(f)
+
+    def write(self, inst_id: str, tf: str, candles: List[Candle]):
+        self.write_records(inst_id, tf, self.to_records(candles))
+
+    def write_records(self, inst_id: str, tf: str, records: np.ndarray):
+        path = self.path(inst_id, tf)
+        tmp_path = f'{path}.tmp'
+        np.asarray(records, dtype=self.DTYPE).tofile(tmp_path)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def to_candles(records: np.ndarray, inst_id: str, tf: str) -> List[Candle]:
+        return [Candle(inst_id=inst_id, timeframe=tf, timestamp_ms=int(ts),
+                       open=float(o), high=float(h), low=float(l), close=float(c), volume=float(v))
+                for ts, o, h, l, c, v in records.tolist()]
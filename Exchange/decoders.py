@@ -0,0 +1,63 @@
+import json
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from Structures.public import RawCandle
+from Tools.logger import Logger
+
+logger = Logger(__name__).logger
+
+try:
+    import orjson
+
+    json_loads: Callable[[Any], Any] = orjson.loads
+    JSON_BACKEND = 'orjson'
+except ImportError:
+    try:
+        import ujson
+
+        json_loads = ujson.loads
+        JSON_BACKEND = 'ujson'
+    except ImportError:
+        json_loads = json.loads
+        JSON_BACKEND = 'json'
+
+
+CandleRow = Tuple[int, float, float, float, float, float]
+
+
+def parse_candle_rows(rows: List[List[str]]) -> List[CandleRow]:
+    return [(int(row[0]), float(row[1]), float(row[2]), float(row[3]), float(row[4]), float(row[5]))
+            for row in rows]
+
+
+class PublicDecoder:
+    """Decodes public websocket frames without building Candle dataclasses or datetimes."""
+
+    def __init__(self, loads: Callable[[Any], Any] = json_loads):
+        self.loads = loads
+        self._channels: Dict[Tuple[str, str], Tuple[str, str]] = {}
+
+    def _candle_channel(self, arg: Dict) -> Optional[Tuple[str, str]]:
+        key = (arg.get('channel', ''), arg.get('instId'))
+        channel = self._channels.get(key)
+        if channel is None and key[0].startswith('candle'):
+            channel = self._channels[key] = (key[1], key[0][len('candle'):])
+        return channel
+
+    def decode_rows(self, message) -> Tuple[Optional[str], Optional[str], List[CandleRow]]:
+        msg = self.loads(message)
+        rows = msg.get('data')
+        if rows is None:
+            if msg.get('event') == 'error':
+                logger.error(f'Public stream error: {msg}')
+            return None, None, []
+
+        channel = self._candle_channel(msg['arg'])
+        if channel is None:
+            logger.error(f'Unknown message PUBLIC: {msg}')
+            return None, None, []
+        return channel[0], channel[1], parse_candle_rows(rows)
+
+    def decode(self, message) -> List[RawCandle]:
+        inst_id, timeframe, rows = self.decode_rows(message)
+        return [RawCandle(inst_id, timeframe, *row) for row in rows]
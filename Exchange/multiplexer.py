@@ -0,0 +1,79 @@
+import asyncio
+from typing import Callable, Dict, Optional
+
+import websockets
+
+from Exchange.decoders import json_loads
+from Tools.logger import Logger
+
+logger = Logger(__name__).logger
+
+
+class RequestMultiplexer:
+    """Single reader for a request/response websocket; replies are matched to requests by their `id`.
+
+    `on_closed` is called when the connection drops, after the pending requests have been failed.
+    """
+
+    def __init__(self, ws, timeout: float = 5., on_closed: Callable[[], None] = None):
+        self.ws = ws
+        self.timeout = timeout
+        self.on_closed = on_closed
+        self._pending: Dict[str, asyncio.Future] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    def start(self) -> asyncio.Task:
+        self.task = asyncio.create_task(self._read())
+        return self.task
+
+    async def _read(self):
+        try:
+            while True:
+                message = await self.ws.recv()
+                # a frame that cannot be matched only loses its own request, which then times out
+                try:
+                    msg = json_loads(message)
+                    msg_id = msg.get('id')
+                except Exception as e:
+                    logger.error(f'Undecodable trade message: {message!r}: {e!r}')
+                    continue
+                future = self._pending.pop(msg_id, None)
+                if future is None:
+                    logger.warning(f'Unmatched trade message: {msg}')
+                elif not future.done():
+                    future.set_result(msg)
+        except asyncio.CancelledError:
+            self._fail_pending(ConnectionError('Trade connection closed'))
+            raise
+        except websockets.ConnectionClosed as e:
+            if isinstance(e, websockets.ConnectionClosedOK):
+                logger.info('Trade connection closed')
+            else:
+                logger.error(f'Trade connection lost: {e!r}')
+            self._fail_pending(ConnectionError('Trade connection closed'))
+            if self.on_closed is not None:
+                self.on_closed()
+
+    def _fail_pending(self, e: Exception):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(e)
+        self._pending.clear()
+
+    async def request(self, msg_id: str, payload: str, timeout: float = None) -> Dict:
+        if msg_id in self._pending:
+            raise RuntimeError(f'Request id already in flight: {msg_id}')
+        if self.task is None or self.task.done():
+            raise ConnectionError('Trade reader is not running')
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[msg_id] = future
+        try:
+            await self.ws.send(payload)
+            return await asyncio.wait_for(future, timeout or self.timeout)
+        finally:
+            self._pending.pop(msg_id, None)
@@ -0,0 +1,61 @@
+import asyncio
+from typing import List, Set, Tuple
+
+from Structures.trade import Order, OrderResponse
+
+
+class OrderBatcher:
+    """Collects orders submitted during one event-loop tick and places them together.
+
+    A single order goes out as a plain `order` op; more are handed to
+    `place_multiple_orders`, which packs them into batch-orders frames.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._orders: List[Tuple[Order, asyncio.Future]] = []
+        self._flush_scheduled = False
+        self._tasks: Set[asyncio.Task] = set()
+
+    def submit(self, order: Order) -> 'asyncio.Future[OrderResponse]':
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._orders.append((order, future))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            loop.call_soon(self._flush)
+        return future
+
+    def _flush(self):
+        orders, self._orders = self._orders, []
+        self._flush_scheduled = False
+        if orders:
+            task = asyncio.create_task(self._place(orders))
+            self._tasks.add(task)
+            task.add_done_callback(self._placed)
+
+    def _placed(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled():
+            task.exception()
+
+    async def close(self):
+        """Sends whatever is still collected and waits for the placements in flight."""
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _place(self, orders: List[Tuple[Order, asyncio.Future]]):
+        try:
+            if len(orders) == 1:
+                responses = [await self.connection.place_order(orders[0][0])]
+            else:
+                responses = await self.connection.place_multiple_orders([order for order, _ in orders])
+        except Exception as e:
+            for _, future in orders:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), response in zip(orders, responses):
+            if not future.done():
+                future.set_result(response)
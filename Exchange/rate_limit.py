@@ -0,0 +1,130 @@
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+
+# https://www.okx.com/docs-v5/en/ : (requests, per seconds), shared between REST and websocket where OKX shares them
+OKX_RATE_LIMITS: Dict[str, Tuple[int, float]] = {
+    'order': (60, 2),
+    'batch-orders': (300, 2),
+    'cancel-order': (60, 2),
+    'set-leverage': (20, 2),
+    'instruments': (20, 2),
+    'history-candles': (20, 2),
+}
+
+# endpoint or websocket op -> bucket of the limit it counts against
+OKX_ENDPOINTS: Dict[str, str] = {
+    'order': 'order',
+    '/api/v5/trade/order': 'order',
+    'batch-orders': 'batch-orders',
+    '/api/v5/trade/batch-orders': 'batch-orders',
+    'cancel-order': 'cancel-order',
+    '/api/v5/trade/cancel-order': 'cancel-order',
+    '/api/v5/account/set-leverage': 'set-leverage',
+    '/api/v5/public/instruments': 'instruments',
+    '/api/v5/market/history-candles': 'history-candles',
+}
+
+
+class TokenBucket:
+    """Token bucket whose waiters are served in arrival order."""
+
+    def __init__(self, name: str, limit: int, interval: float):
+        self.name = name
+        self.capacity = limit
+        self.rate = limit / interval
+        self.tokens = float(limit)
+        self._updated = time.monotonic()
+        self._waiters: Deque[Tuple[float, asyncio.Future]] = deque()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+        self.calls = 0
+        self.throttled = 0
+        self.wait_total_s = 0.
+        self.wait_max_s = 0.
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, cost: float = 1):
+        cost = min(cost, self.capacity)
+        self.calls += 1
+        self._refill()
+        if not self._waiters and self.tokens >= cost:
+            self.tokens -= cost
+            return
+
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        waiter = (cost, future)
+        self._waiters.append(waiter)
+        self._schedule()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                # leave the queue at once, a dead waiter at its head would hold up everyone behind it
+                self._waiters.remove(waiter)
+            else:
+                # granted just before the cancellation
+                self.tokens += cost
+            self._reschedule()
+            raise
+
+        waited = time.monotonic() - started
+        self.throttled += 1
+        self.wait_total_s += waited
+        self.wait_max_s = max(self.wait_max_s, waited)
+
+    def _schedule(self):
+        if self._wakeup is not None or not self._waiters:
+            return
+        cost = self._waiters[0][0]
+        delay = max(cost - self.tokens, 0) / self.rate
+        self._wakeup = asyncio.get_running_loop().call_later(delay, self._wake)
+
+    def _reschedule(self):
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+        self._wake()
+
+    def _wake(self):
+        self._wakeup = None
+        self._refill()
+        while self._waiters:
+            cost, future = self._waiters[0]
+            if self.tokens < cost:
+                break
+            self._waiters.popleft()
+            self.tokens -= cost
+            future.set_result(None)
+        self._schedule()
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            'calls': self.calls,
+            'throttled': self.throttled,
+            'waiting': len(self._waiters),
+            'wait_total_s': round(self.wait_total_s, 3),
+            'wait_max_s': round(self.wait_max_s, 3),
+        }
+
+
+class RateLimiter:
+    def __init__(self, limits: Dict[str, Tuple[int, float]] = None, endpoints: Dict[str, str] = None):
+        limits = OKX_RATE_LIMITS if limits is None else limits
+        self.endpoints = OKX_ENDPOINTS if endpoints is None else endpoints
+        self.buckets = {name: TokenBucket(name, limit, interval) for name, (limit, interval) in limits.items()}
+
+    async def acquire(self, endpoint: str, cost: float = 1):
+        bucket = self.buckets.get(self.endpoints.get(endpoint, endpoint))
+        if bucket is None:
+            return
+        await bucket.acquire(cost)
+
+    def metrics(self) -> Dict[str, Dict[str, float]]:
+        return {name: bucket.metrics() for name, bucket in self.buckets.items()}
@@ -0,0 +1,550 @@
+"""Local stand-in for the part of the OKX v5 API that OkxConnection uses.
+
+Serves the public candle channels, login and the private account/positions/orders
+channels, the trade `order`/`batch-orders`/`cancel-order` ops and the REST
+history-candles/instruments/set-leverage endpoints. Market orders fill at the last
+published close. Nothing is authenticated.
+
+Run standalone with: python -m Exchange.simulator --feed ETH-USDT-SWAP:1m --rate 100
+or replay a CandleCache directory: python -m Exchange.simulator --cache candles --replay ETH-USDT-SWAP:1m
+"""
+import argparse
+import asyncio
+import bisect
+import copy
+import json
+import random
+import time
+from abc import abstractmethod
+from collections import defaultdict, deque
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import websockets
+from aiohttp import web
+
+from Exchange.Okx import timeframe_ms
+from Exchange.candle_cache import CandleCache
+from Exchange.decoders import CandleRow
+from Structures.public import Candle
+from Tools.logger import Logger
+
+logger = Logger(__name__).logger
+
+PUBLIC_PATH = '/ws/v5/public'
+PRIVATE_PATH = '/ws/v5/private'
+HISTORY_CANDLES_MAX_LIMIT = 100
+
+
+def _row_to_json(row: CandleRow, confirm: bool) -> List[str]:
+    ts, o, h, l, c, v = row
+    return [str(ts), str(o), str(h), str(l), str(c), str(v), str(v * c), str(v * c), '1' if confirm else '0']
+
+
+class CandleFeed:
+    """Candle updates for one (inst_id, timeframe) channel; closed bars are kept for the REST history."""
+
+    def __init__(self, inst_id: str, timeframe: str):
+        self.inst_id = inst_id
+        self.timeframe = timeframe
+        self.history: List[CandleRow] = []
+        self._history_ts: List[int] = []
+        self.forming: Optional[CandleRow] = None
+
+    @property
+    def channel(self) -> str:
+        return f'candle{self.timeframe}'
+
+    def _close_bar(self, row: CandleRow):
+        self.history.append(row)
+        self._history_ts.append(row[0])
+
+    @abstractmethod
+    def _next_row(self) -> Optional[CandleRow]:
+        pass
+
+    def next_update(self) -> Optional[CandleRow]:
+        row = self._next_row()
+        if row is None:
+            return None
+        if self.forming is not None and row[0] != self.forming[0]:
+            self._close_bar(self.forming)
+        self.forming = row
+        return row
+
+    def rows_before(self, after: Optional[int], limit: int) -> List[Tuple[CandleRow, bool]]:
+        """Newest-first bars older than `after`, as the history-candles endpoint pages them."""
+        with_forming = self.forming is not None and (after is None or self.forming[0] < after)
+        end = len(self.history) if after is None else bisect.bisect_left(self._history_ts, after)
+        rows = [(row, True) for row in self.history[max(end - limit + with_forming, 0):end]]
+        if with_forming:
+            rows.append((self.forming, False))
+        return rows[::-1]
+
+
+class RandomWalkFeed(CandleFeed):
+    """Geometric random walk with `updates_per_bar` forming-bar updates per bar.
+
+    Bar timestamps advance with the updates, not the wall clock, so a fast rate
+    produces many bars per real minute.
+    """
+
+    def __init__(self, inst_id: str, timeframe: str, price: float = 100., volatility: float = 0.001,
+                 updates_per_bar: int = 10, history_bars: int = 1000, seed: int = None, start_ms: int = None):
+        super().__init__(inst_id, timeframe)
+        self.bar_ms = timeframe_ms(timeframe)
+        if self.bar_ms is None:
+            raise ValueError(f'Unsupported timeframe for a random walk: {timeframe}')
+        self.volatility = volatility
+        self.updates_per_bar = updates_per_bar
+        self._random = random.Random(seed)
+        self._price = price
+        self._updates = 0
+
+        if start_ms is None:
+            now = int(time.time() * 1000)
+            start_ms = now - now % self.bar_ms
+        self._ts = start_ms - history_bars * self.bar_ms
+        for _ in range(history_bars * updates_per_bar):
+            self.next_update()
+        if self.forming is not None:
+            self._close_bar(self.forming)
+            self.forming = None
+
+    def _next_row(self) -> CandleRow:
+        if self._updates == self.updates_per_bar:
+            self._updates = 0
+            self._ts += self.bar_ms
+        price = self._price
+        self._price *= 1 + self._random.gauss(0, self.volatility)
+        volume = round(self._random.expovariate(1.), 4)
+        if self._updates == 0:
+            row = (self._ts, price, max(price, self._price), min(price, self._price), self._price, volume)
+        else:
+            ts, o, h, l, _, v = self.forming
+            row = (ts, o, max(h, self._price), min(l, self._price), self._price, round(v + volume, 4))
+        self._updates += 1
+        return row
+
+
+class ReplayFeed(CandleFeed):
+    """Replays recorded bars, one message per bar, after serving the first `history_bars` as history."""
+
+    def __init__(self, inst_id: str, timeframe: str, candles: List[Candle], history_bars: int = 0):
+        super().__init__(inst_id, timeframe)
+        rows = [(c.timestamp_ms, c.open, c.high, c.low, c.close, c.volume) for c in candles]
+        for row in rows[:history_bars]:
+            self._close_bar(row)
+        self._rows = iter(rows[history_bars:])
+
+    @classmethod
+    def from_cache(cls, cache: CandleCache, inst_id: str, timeframe: str, history_bars: int = 0) -> 'ReplayFeed':
+        candles = [Candle(inst_id, ts, timeframe, o, h, l, c, v)
+                   for ts, o, h, l, c, v in cache.load(inst_id, timeframe).tolist()]
+        return cls(inst_id, timeframe, candles, history_bars)
+
+    def _next_row(self) -> Optional[CandleRow]:
+        return next(self._rows, None)
+
+
+class SimulatorStats:
+    """Message counters and tick-to-order latency: time from the last candle sent for an
+    instrument to an order for it arriving. perf_counter is system-wide on Linux, so the
+    figure is valid when the strategy runs in another process on the same box."""
+
+    def __init__(self, max_samples: int = 100_000):
+        self.started = time.perf_counter()
+        self.public_sent = 0
+        self.private_sent = 0
+        self.orders = 0
+        self.rejected = 0
+        self.tick_to_order_s = deque(maxlen=max_samples)
+
+    def summary(self) -> Dict[str, float]:
+        elapsed = time.perf_counter() - self.started
+        summary = {
+            'elapsed_s': round(elapsed, 3),
+            'public_sent': self.public_sent,
+            'public_per_s': round(self.public_sent / elapsed, 1),
+            'private_sent': self.private_sent,
+            'orders': self.orders,
+            'orders_per_s': round(self.orders / elapsed, 1),
+            'rejected': self.rejected,
+        }
+        if self.tick_to_order_s:
+            latency_ms = np.array(self.tick_to_order_s) * 1000
+            p50, p90, p99 = np.percentile(latency_ms, [50, 90, 99])
+            summary.update(tick_to_order_ms={'count': len(latency_ms), 'p50': round(p50, 3), 'p90': round(p90, 3),
+                                             'p99': round(p99, 3), 'max': round(latency_ms.max(), 3)})
+        return summary
+
+
+class OkxSimulator:
+    def __init__(self, host: str = '127.0.0.1', ws_port: int = 0, rest_port: int = 0, rate: float = 10.,
+                 balance: float = 10_000., fee_rate: float = 0.0005):
+        self.host = host
+        self.ws_port = ws_port
+        self.rest_port = rest_port
+        self.rate = rate
+        self.fee_rate = fee_rate
+        self.stats = SimulatorStats()
+
+        self.feeds: Dict[Tuple[str, str], CandleFeed] = {}
+        self.instruments: Dict[str, Dict[str, str]] = {}
+        self.leverage: Dict[str, str] = {}
+        self.last_prices: Dict[str, float] = {}
+        self._last_tick: Dict[str, float] = {}
+
+        self.cash = balance
+        self.coins: Dict[str, float] = defaultdict(float)
+        self.positions: Dict[Tuple[str, str], List[float]] = {}
+
+        self._public_subscribers: Dict[Tuple[str, str], Set] = defaultdict(set)
+        self._private_subscribers: Dict[str, Set] = defaultdict(set)
+        self._publishers: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._ws_server = None
+        self._rest_runner: web.AppRunner = None
+        self._order_seq = 0
+
+    # SETUP
+    def add_feed(self, feed: CandleFeed):
+        self.feeds[(feed.channel, feed.inst_id)] = feed
+        self.add_instrument(feed.inst_id)
+        if feed.history:
+            self.last_prices[feed.inst_id] = feed.history[-1][4]
+
+    def add_instrument(self, inst_id: str, ct_val: float = 1., min_sz: float = 0.01, tick_sz: float = 0.01):
+        inst_type = 'SWAP' if inst_id.endswith('-SWAP') else 'SPOT'
+        self.instruments.setdefault(inst_id, {
+            'instType': inst_type,
+            'instId': inst_id,
+            'uly': inst_id[:-len('-SWAP')] if inst_type == 'SWAP' else '',
+            'ctVal': str(ct_val) if inst_type == 'SWAP' else '',
+            'minSz': str(min_sz),
+            'tickSz': str(tick_sz),
+        })
+
+    def patch_config(self, config: Dict) -> Dict:
+        """Copy of `config` with the OKX urls pointed at this simulator."""
+        config = copy.deepcopy(config)
+        config['okx_connection'].update(
+            public_ws_url=f'ws://{self.host}:{self.ws_port}{PUBLIC_PATH}',
+            private_ws_url=f'ws://{self.host}:{self.ws_port}{PRIVATE_PATH}',
+            trade_ws_url=f'ws://{self.host}:{self.ws_port}{PRIVATE_PATH}',
+            rest_url=f'http://{self.host}:{self.rest_port}',
+        )
+        return config
+
+    async def start(self):
+        self._ws_server = await websockets.serve(self._handle_ws, self.host, self.ws_port)
+        self.ws_port = self._ws_server.sockets[0].getsockname()[1]
+
+        app = web.Application()
+        app.router.add_get('/api/v5/market/history-candles', self._rest_history_candles)
+        app.router.add_get('/api/v5/public/instruments', self._rest_instruments)
+        app.router.add_post('/api/v5/account/set-leverage', self._rest_set_leverage)
+        app.router.add_get('/sim/stats', self._rest_stats)
+        self._rest_runner = web.AppRunner(app)
+        await self._rest_runner.setup()
+        site = web.TCPSite(self._rest_runner, self.host, self.rest_port)
+        await site.start()
+        self.rest_port = site._server.sockets[0].getsockname()[1]
+        logger.warning(f'OKX simulator on ws://{self.host}:{self.ws_port} and http://{self.host}:{self.rest_port}')
+
+    async def stop(self):
+        for task in self._publishers.values():
+            task.cancel()
+        self._ws_server.close()
+        await self._ws_server.wait_closed()
+        await self._rest_runner.cleanup()
+
+    # WEBSOCKET
+    async def _handle_ws(self, ws):
+        try:
+            if ws.path == PUBLIC_PATH:
+                await self._handle_public(ws)
+            elif ws.path == PRIVATE_PATH:
+                await self._handle_private(ws)
+            else:
+                await ws.close(code=1008, reason=f'Unknown path {ws.path}')
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for subscribers in [*self._public_subscribers.values(), *self._private_subscribers.values()]:
+                subscribers.discard(ws)
+
+    async def _send(self, ws, msg: Dict):
+        await ws.send(json.dumps(msg, separators=(',', ':')))
+
+    async def _handle_public(self, ws):
+        async for message in ws:
+            msg = json.loads(message)
+            if msg.get('op') != 'subscribe':
+                await self._send(ws, {'event': 'error', 'code': '60012', 'msg': f'Invalid request: {message}'})
+                continue
+            for arg in msg.get('args', []):
+                key = (arg.get('channel'), arg.get('instId'))
+                feed = self.feeds.get(key)
+                if feed is None:
+                    await self._send(ws, {'event': 'error', 'code': '60018', 'msg': f"Doesn't exist: {arg}"})
+                    continue
+                self._public_subscribers[key].add(ws)
+                await self._send(ws, {'event': 'subscribe', 'arg': arg})
+                if key not in self._publishers:
+                    self._publishers[key] = asyncio.create_task(self._publish(feed))
+
+    async def _publish(self, feed: CandleFeed):
+        """Sends `rate` updates per second for the feed, or as fast as the loop allows when rate is 0."""
+        key = (feed.channel, feed.inst_id)
+        arg = {'channel': feed.channel, 'instId': feed.inst_id}
+        loop = asyncio.get_running_loop()
+        next_send = loop.time()
+        while True:
+            row = feed.next_update()
+            if row is None:
+                logger.warning(f'Feed exhausted: {key}')
+                return
+            message = json.dumps({'arg': arg, 'data': [_row_to_json(row, False)]}, separators=(',', ':'))
+            self.last_prices[feed.inst_id] = row[4]
+            subscribers = self._public_subscribers[key]
+            self._last_tick[feed.inst_id] = time.perf_counter()
+            websockets.broadcast(subscribers, message)
+            self.stats.public_sent += len(subscribers)
+
+            if self.rate:
+                next_send += 1 / self.rate
+                await asyncio.sleep(max(next_send - loop.time(), 0))
+            else:
+                await asyncio.sleep(0)
+
+    async def _handle_private(self, ws):
+        logged_in = False
+        async for message in ws:
+            msg = json.loads(message)
+            op = msg.get('op')
+            if op == 'login':
+                logged_in = True
+                await self._send(ws, {'event': 'login', 'code': '0', 'msg': ''})
+            elif not logged_in:
+                await self._send(ws, {'event': 'error', 'code': '60011', 'msg': 'Please log in'})
+            elif op == 'subscribe':
+                args = msg.get('args', [])
+                for arg in args:
+                    self._private_subscribers[arg.get('channel')].add(ws)
+                    await self._send(ws, {'event': 'subscribe', 'arg': arg})
+                # snapshots go out after every ack, OkxConnection reads one ack per channel first
+                for arg in args:
+                    if arg.get('channel') == 'account':
+                        await self._push(ws, 'account', [self._account_data()])
+                    elif arg.get('channel') == 'positions':
+                        await self._push(ws, 'positions', self._positions_data())
+            elif op in ('order', 'batch-orders'):
+                await self._handle_orders(ws, msg)
+            elif op == 'cancel-order':
+                data = [{'ordId': arg.get('ordId', ''), 'clOrdId': arg.get('clOrdId', ''), 'sCode': '51400',
+                         'sMsg': 'Order cancellation failed as the order has been filled, canceled or does not exist'}
+                        for arg in msg.get('args', [])]
+                await self._send(ws, {'id': msg.get('id'), 'op': op, 'code': '1', 'msg': '', 'data': data})
+            else:
+                await self._send(ws, {'id': msg.get('id'), 'event': 'error', 'code': '60012',
+                                      'msg': f'Invalid request: {message}'})
+
+    async def _push(self, ws, channel: str, data: List[Dict]):
+        await self._send(ws, {'arg': {'channel': channel}, 'data': data})
+        self.stats.private_sent += 1
+
+    async def _broadcast_private(self, channel: str, data: List[Dict]):
+        for ws in list(self._private_subscribers[channel]):
+            await self._push(ws, channel, data)
+
+    # TRADING
+    async def _handle_orders(self, ws, msg: Dict):
+        received = time.perf_counter()
+        acks, fills = [], []
+        for arg in msg.get('args', []):
+            self.stats.orders += 1
+            tick = self._last_tick.get(arg.get('instId'))
+            if tick is not None:
+                self.stats.tick_to_order_s.append(received - tick)
+            ack, fill = self._fill(arg)
+            acks.append(ack)
+            if fill is not None:
+                fills.append(fill)
+
+        failed = sum(ack['sCode'] != '0' for ack in acks)
+        code = '0' if not failed else '1' if msg['op'] == 'order' or failed == len(acks) else '2'
+        await self._send(ws, {'id': msg.get('id'), 'op': msg['op'], 'code': code, 'msg': '', 'data': acks})
+        for fill in fills:
+            await self._broadcast_private('orders', [fill])
+        if fills:
+            await self._broadcast_private('positions', self._positions_data())
+            await self._broadcast_private('account', [self._account_data()])
+
+    def _fill(self, arg: Dict) -> Tuple[Dict, Optional[Dict]]:
+        self._order_seq += 1
+        ord_id = str(self._order_seq)
+        ack = {'clOrdId': arg.get('clOrdId', ''), 'ordId': ord_id, 'tag': '', 'sCode': '0', 'sMsg': ''}
+        inst_id = arg.get('instId')
+        price = self.last_prices.get(inst_id)
+        if price is None or inst_id not in self.instruments:
+            self.stats.rejected += 1
+            ack.update(ordId='', sCode='51001', sMsg=f"Instrument ID doesn't exist: {inst_id}")
+            return ack, None
+        if arg.get('ordType', 'market') != 'market':
+            self.stats.rejected += 1
+            ack.update(ordId='', sCode='51000', sMsg='Only market orders are simulated')
+            return ack, None
+
+        size = float(arg['sz'])
+        inst_type = self.instruments[inst_id]['instType']
+        if inst_type == 'SPOT':
+            # OKX sizes spot market buys in the quote currency unless told otherwise
+            tgt_ccy = arg.get('tgtCcy') or ('quote_ccy' if arg['side'] == 'buy' else 'base_ccy')
+            if tgt_ccy == 'quote_ccy':
+                size = size / price
+            if arg.get('tdMode', 'cash') != 'cash':
+                inst_type = 'MARGIN'
+        signed = size if arg['side'] == 'buy' else -size
+        notional = size * price * float(self.instruments[inst_id]['ctVal'] or 1)
+        fee = notional * self.fee_rate
+        self.cash -= fee
+        pnl = 0.
+
+        if inst_type == 'SPOT':
+            base, quote = inst_id.split('-')[:2]
+            self.coins[base] += signed
+            self.cash -= signed * price
+        else:
+            pos, avg_px = self.positions.get((inst_type, inst_id), (0., 0.))
+            ct_val = float(self.instruments[inst_id]['ctVal'] or 1)
+            if pos and (pos > 0) != (signed > 0):
+                closed = min(abs(signed), abs(pos)) * (1 if pos > 0 else -1)
+                pnl = (price - avg_px) * closed * ct_val
+                self.cash += pnl
+            new_pos = pos + signed
+            if not new_pos:
+                avg_px = 0.
+            elif not pos or (pos > 0) != (new_pos > 0):
+                avg_px = price
+            elif (pos > 0) == (signed > 0):
+                avg_px = (avg_px * pos + price * signed) / new_pos
+            self.positions[(inst_type, inst_id)] = [new_pos, avg_px]
+
+        now_ms = str(int(time.time() * 1000))
+        fill = {
+            'instType': inst_type,
+            'instId': inst_id,
+            'clOrdId': arg.get('clOrdId', ''),
+            'ordId': ord_id,
+            'posSide': arg.get('posSide', 'net'),
+            'side': arg['side'],
+            'sz': arg['sz'],
+            'fillPx': str(price),
+            'fillSz': str(size),
+            'fillTime': now_ms,
+            'state': 'filled',
+            'lever': self.leverage.get(inst_id, '1'),
+            'fee': str(-fee),
+            'pnl': str(pnl),
+            'cTime': now_ms,
+        }
+        return ack, fill
+
+    def _positions_data(self) -> List[Dict]:
+        data = []
+        for (inst_type, inst_id), (pos, avg_px) in self.positions.items():
+            if not pos:
+                continue
+            price = self.last_prices[inst_id]
+            ct_val = float(self.instruments[inst_id]['ctVal'] or 1)
+            data.append({
+                'instType': inst_type,
+                'instId': inst_id,
+                'pos': str(pos),
+                'posSide': 'net',
+                'ccy': 'USDT',
+                'posCcy': inst_id.split('-')[0] if inst_type == 'MARGIN' else '',
+                'avgPx': str(avg_px),
+                'notionalUsd': str(abs(pos) * ct_val * price),
+                'upl': str((price - avg_px) * pos * ct_val),
+            })
+        return data
+
+    def _account_data(self) -> Dict:
+        upl = sum(float(position['upl']) for position in self._positions_data())
+        details = [{'ccy': 'USDT', 'eq': str(self.cash + upl), 'eqUsd': str(self.cash + upl)}]
+        for ccy, amount in self.coins.items():
+            price = next((p for inst_id, p in self.last_prices.items() if inst_id.startswith(f'{ccy}-')), 0.)
+            details.append({'ccy': ccy, 'eq': str(amount), 'eqUsd': str(amount * price)})
+        return {'uTime': str(int(time.time() * 1000)), 'details': details}
+
+    # REST
+    @staticmethod
+    def _rest_ok(data: List) -> web.Response:
+        return web.json_response({'code': '0', 'msg': '', 'data': data})
+
+    async def _rest_history_candles(self, request: web.Request) -> web.Response:
+        params = request.query
+        feed = self.feeds.get((f"candle{params.get('bar', '1m')}", params.get('instId')))
+        if feed is None:
+            return self._rest_ok([])
+        limit = min(int(params.get('limit', HISTORY_CANDLES_MAX_LIMIT)), HISTORY_CANDLES_MAX_LIMIT)
+        after = int(params['after']) if 'after' in params else None
+        return self._rest_ok([_row_to_json(row, confirm) for row, confirm in feed.rows_before(after, limit)])
+
+    async def _rest_instruments(self, request: web.Request) -> web.Response:
+        params = request.query
+        inst_id = params.get('instId') or params.get('inst_id')
+        data = [info for info in self.instruments.values()
+                if info['instType'] == params.get('instType')
+                and (inst_id is None or info['instId'] == inst_id)
+                and (params.get('uly') is None or info['uly'] == params.get('uly'))]
+        return self._rest_ok(data)
+
+    async def _rest_set_leverage(self, request: web.Request) -> web.Response:
+        params = await request.json()
+        self.leverage[params.get('instId')] = str(params.get('lever'))
+        return self._rest_ok([{'instId': params.get('instId'), 'lever': str(params.get('lever')),
+                               'mgnMode': params.get('mgnMode'), 'posSide': params.get('posSide', '')}])
+
+    async def _rest_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats.summary())
+
+
+async def serve(feeds: List[CandleFeed], host: str, ws_port: int, rest_port: int, rate: float):
+    simulator = OkxSimulator(host=host, ws_port=ws_port, rest_port=rest_port, rate=rate)
+    for feed in feeds:
+        simulator.add_feed(feed)
+    await simulator.start()
+    try:
+        while True:
+            await asyncio.sleep(10)
+            logger.info(f'Simulator stats: {simulator.stats.summary()}')
+    finally:
+        await simulator.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local OKX v5 stand-in')
+    parser.add_argument('--feed', action='append', default=[], help='INST_ID:TIMEFRAME random walk, repeatable')
+    parser.add_argument('--replay', action='append', default=[],
+                        help='INST_ID:TIMEFRAME replayed from the --cache directory, repeatable')
+    parser.add_argument('--cache', default='candles', help='CandleCache directory for --replay')
+    parser.add_argument('--history-bars', type=int, default=0, help='replayed bars served as history first')
+    parser.add_argument('--rate', type=float, default=10., help='updates per second per feed, 0 for unpaced')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--ws-port', type=int, default=8765)
+    parser.add_argument('--rest-port', type=int, default=8766)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    feeds = []
+    for spec in args.replay:
+        inst_id, timeframe = spec.split(':')
+        cache = CandleCache(args.cache)
+        if not len(cache.load(inst_id, timeframe)):
+            parser.error(f'no cached {spec} bars in {args.cache}')
+        feeds.append(ReplayFeed.from_cache(cache, inst_id, timeframe, args.history_bars))
+    feeds += [RandomWalkFeed(*spec.split(':'), seed=args.seed)
+              for spec in args.feed or ([] if args.replay else ['ETH-USDT-SWAP:1m'])]
+    asyncio.run(serve(feeds, args.host, args.ws_port, args.rest_port, args.rate))
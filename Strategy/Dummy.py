@@ -1,7 +1,7 @@
 import asyncio
 
 from Tools.AlertManager import AlertManager
-from Strategy.StrategyBase import StrategyBase
+from Strategy.StrategyBase import StrategyBase, StrategyEvent
 from Structures.public import *
 from Structures.private import *
 from Structures.trade import *
@@ -15,38 +15,23 @@ class DummyStrategy(StrategyBase):
         self.name = 'Dummy'
         self.timeframe_min = 60
         self.alert_manager = AlertManager(config)
-        self.candle_history = None
         self.candle_history_length = 10
-        self.current_candle_start = None
+        self.subscribe(self.place_dummy_order, on=(), interval=10)
 
 
-    async def trader(self):
-        while True:
-            await asyncio.sleep(10)
-            order = Order(
-                action=Action.BUY,
-                size=0,
-                ticker='ETH-USDT',
-                trading_mode=TradingMode.CROSS,
-                order_type=OrderType.MARKET,
-            )
-            await self.connection.place_order(order)
+    async def place_dummy_order(self, event: StrategyEvent):
+        order = Order(
+            action=Action.BUY,
+            size=0,
+            ticker='ETH-USDT',
+            trading_mode=TradingMode.CROSS,
+            order_type=OrderType.MARKET,
+        )
+        await self.connection.place_order(order)
 
 
-    def update_candle_history(self, candle):
-        if self.candle_history is None or len(self.candle_history) == 0:
-            raise RuntimeError(f'Empty candle history')
-
-        if self.candle_history[-1].datetime == candle.datetime:
-            self.candle_history[-1] = candle
-
-        elif self.candle_history[-1].datetime != candle.datetime:
-            self.candle_history.append(candle)
-            if len(self.candle_history) > self.candle_history_length:
-                self.candle_history.popleft()
-
     async def candle_handler(self, candle: Candle):
-        self.update_candle_history(candle)
+        self.candle_store.buffer(candle.inst_id, candle.timeframe, self.candle_history_length).update(candle)
     #
     # async def account_handler(self, account):
     #     # self.alert_manager.send_message(account, title='account')
@@ -1,72 +1,405 @@
 import asyncio
+import inspect
+import json
 import logging
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Callable, FrozenSet, Tuple
 
 from abc import abstractmethod
 
 from Tools.AlertManager import AlertManager
 from Exchange.Okx import OkxConnection
+from Structures.candle_store import CandleStore
 from Structures.public import *
 from Structures.private import *
 from Structures.trade import *
-from Tools.logger import Logger
+from Tools.latency import tracer
+from Tools.logger import Logger, sample
+from Tools.metrics import Family, HistogramValue, registry, serve, start_loop_lag_monitor
+from Tools import profiler
+from Tools.queues import ChannelQueues
 
 logger = Logger(__name__).logger
 
+HANDLER_SECONDS = registry.histogram('tradebot_handler_seconds', 'Time in a queue event handler', ('strategy', 'handler'))
+HANDLER_ERRORS = registry.counter('tradebot_handler_errors_total', 'Queue event handlers that raised',
+                                  ('strategy', 'handler'))
+EVALUATION_SECONDS = registry.histogram('tradebot_strategy_evaluation_seconds', 'Time in a strategy callback',
+                                        ('strategy', 'callback'))
+
+
+class EventKind(Enum):
+    CLOSE = 'CLOSE'
+    UPDATE = 'UPDATE'
+    TIMER = 'TIMER'
+
+    def __repr__(self):
+        return repr(self.value)
+
+
+@dataclass
+class StrategyEvent:
+    kind: EventKind
+    inst_ids: FrozenSet[str]
+    candles: Dict[str, Candle]
+
+
+@dataclass
+class HandlerStats:
+    count: int = 0
+    errors: int = 0
+    total_s: float = 0.
+    max_s: float = 0.
+
+    def add(self, elapsed: float):
+        self.count += 1
+        self.total_s += elapsed
+        self.max_s = max(self.max_s, elapsed)
+
+    @property
+    def mean_s(self):
+        return self.total_s / self.count if self.count else 0.
+
+
+class Subscription:
+    """Coalescing trigger for a strategy callback.
+
+    Candle pushes only mark instruments as pending; the worker calls the
+    callback once per wakeup with everything that changed meanwhile, so a
+    slow callback never builds a backlog.
+    """
+
+    def __init__(self, callback, kinds, throttle=0., interval=None, inst_ids=None, evaluation: HistogramValue = None):
+        self.callback = callback
+        self.name = getattr(callback, '__name__', repr(callback))
+        self.evaluation = evaluation
+        self.kinds = set(kinds)
+        self.throttle = throttle
+        self.interval = interval
+        self.inst_ids = set(inst_ids) if inst_ids else None
+        if interval:
+            self.kinds.add(EventKind.TIMER)
+
+        self.pushes = 0
+        self.calls = 0
+        self.errors = 0
+        self._pending: Dict[str, Candle] = {}
+        self._pending_kind: Optional[EventKind] = None
+        self._wakeup = asyncio.Event()
+
+    def __repr__(self):
+        return f'Subscription({self.name}, {self.kinds})'
+
+    def push(self, kind: EventKind, candle: Candle):
+        if kind not in self.kinds:
+            return
+        if self.inst_ids is not None and candle.inst_id not in self.inst_ids:
+            return
+        self.pushes += 1
+        self._pending[candle.inst_id] = candle
+        if self._pending_kind != EventKind.CLOSE:
+            self._pending_kind = kind
+        self._wakeup.set()
+
+    def _take(self) -> StrategyEvent:
+        event = StrategyEvent(kind=self._pending_kind, inst_ids=frozenset(self._pending), candles=self._pending)
+        self._pending = {}
+        self._pending_kind = None
+        self._wakeup.clear()
+        return event
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        next_timer = loop.time() if self.interval else None
+        last_call = float('-inf')
+        while True:
+            if not self._wakeup.is_set():
+                timeout = None if next_timer is None else max(next_timer - loop.time(), 0)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            # the timer is checked on every pass, so a steady stream of pushes cannot starve it
+            if next_timer is not None and loop.time() >= next_timer:
+                next_timer += self.interval
+                last_call = loop.time()
+                await self._call(StrategyEvent(kind=EventKind.TIMER, inst_ids=frozenset(), candles={}))
+
+            if self._wakeup.is_set():
+                wait = last_call + self.throttle - loop.time()
+                if self._pending_kind == EventKind.UPDATE and wait > 0:
+                    await asyncio.sleep(wait)
+                last_call = loop.time()
+                await self._call(self._take())
+
+    async def _call(self, event: StrategyEvent):
+        self.calls += 1
+        if tracer.enabled and event.inst_ids:
+            tracer.on_signal(event.inst_ids)
+        started = time.perf_counter()
+        task = asyncio.current_task()
+        profiler.handlers[task] = self.name
+        try:
+            await self.callback(event)
+        except Exception as e:
+            self.errors += 1
+            logger.exception(f'Error in {self}: {e}')
+        finally:
+            profiler.handlers.pop(task, None)
+        if self.evaluation is not None:
+            self.evaluation.observe(time.perf_counter() - started)
+
+
+def collect_latency() -> List[Family]:
+    """The tick-to-order stage histograms of the latency tracer as summaries."""
+    samples = []
+    for stage, histogram in tracer.stages.items():
+        if not histogram.count:
+            continue
+        labels = {'stage': stage}
+        for quantile in (.5, .9, .99, .999):
+            samples.append(('', {**labels, 'quantile': str(quantile)}, histogram.percentile(quantile * 100) / 1e9))
+        samples.append(('_sum', labels, histogram.total / 1e9))
+        samples.append(('_count', labels, histogram.count))
+    return [('tradebot_tick_latency_seconds', 'summary', 'Tick-to-order latency by pipeline stage', samples)]
+
 
 class StrategyBase:
     def __init__(self, config, name, debug=True):
         self.name = name
-        self.queue = asyncio.Queue()
+        self.queue = ChannelQueues(
+            public_maxsize=config['okx_connection'].get('public_queue_size', 1000),
+            private_maxsize=config['okx_connection'].get('private_queue_size', 1000),
+        )
         self.connection = OkxConnection(config, self.queue, debug)
         self.alert_manager = AlertManager(config)
+        for logger_name, every in config.get('log_sampling', {}).items():
+            sample(logger_name, every)
+        self.candle_store = CandleStore()
         self.tasks = []
         self.parallel_tasks = []
         self.sequent_tasks = []
         self.trader_task = None
+        self.monitor_interval = 10
+        latency = config.get('latency', {})
+        tracer.enabled = latency.get('enabled', True)
+        self.latency_dump_interval = latency.get('dump_interval', 60)
+        self.latency_dump_path = latency.get('dump_path')
+        metrics = config.get('metrics', {})
+        self.metrics_enabled = metrics.get('enabled', True)
+        self.metrics_host = metrics.get('host', '127.0.0.1')
+        self.metrics_port = metrics.get('port', 9108)
+        self.loop_lag_interval = metrics.get('loop_lag_interval', .5)
+        # event-loop stalls longer than this are logged with the stack that caused them
+        self.stall_threshold = config.get('profiling', {}).get('stall_threshold', .1)
+        self.subscriptions: List[Subscription] = []
+        self._last_candles: Dict[Tuple[str, str], Candle] = {}
 
-    async def listen_to_queue(self):
-        while True:
+        self.handlers: Dict[type, Callable] = {}
+        self.handler_stats: Dict[str, HandlerStats] = defaultdict(HandlerStats)
+        self.register_handler(Candle, self._on_candle)
+        self.register_handler(RawCandle, self._on_candle)
+        self.register_handler(Account, self.account_handler)
+        self.register_handler(Positions, self.positions_handler)
+        self.register_handler(FillOrder, self.fill_order_handler)
+        self.register_handler(OrderResponse, self.order_response_handler)
+
+    def register_handler(self, obj_type: type, handler: Callable):
+        self.handlers[obj_type] = handler
+
+    def _find_handler(self, obj_type: type) -> Optional[Callable]:
+        for cls in obj_type.__mro__:
+            handler = self.handlers.get(cls)
+            if handler is not None:
+                return handler
+        return None
+
+    @staticmethod
+    def _collapse(batch: List) -> List:
+        objs = []
+        for obj in batch:
+            if type(obj) is list:
+                objs.extend(obj)
+            elif obj is not None:
+                objs.append(obj)
+
+        # only the last update of a bar matters, earlier ones are superseded
+        last_update = {}
+        for i, obj in enumerate(objs):
+            if isinstance(obj, (Candle, RawCandle)):
+                last_update[(obj.inst_id, obj.timeframe, obj.timestamp_ms)] = i
+        return [obj for i, obj in enumerate(objs)
+                if not isinstance(obj, (Candle, RawCandle)) or last_update[(obj.inst_id, obj.timeframe, obj.timestamp_ms)] == i]
+
+    async def dispatch(self, batch: List, dequeued: int = None):
+        task = asyncio.current_task()
+        for obj in self._collapse(batch):
+            name = type(obj).__name__
+            handler = self._find_handler(type(obj))
+            if handler is None:
+                logger.warning(f'No handler for {name}')
+                continue
+
+            stats = self.handler_stats[name]
+            started = time.perf_counter()
+            profiler.handlers[task] = f'{self.name}.{name}'
             try:
-                obj = await self.queue.get()
-                # public
-                if isinstance(obj, Candle):
-                    await self.candle_handler(obj)
-                # private
-                elif isinstance(obj, Account):
-                    await self.account_handler(obj)
-                elif isinstance(obj, FillOrder):
-                    await self.fill_order_handler(obj)
-                # trade
-                elif isinstance(obj, OrderResponse):
-                    await self.order_response_handler(obj)
-                elif isinstance(obj, list) and len(obj) > 0 and isinstance(obj[0], Position):
-                    await self.positions_handler(obj)
+                result = handler(obj)
+                if inspect.isawaitable(result):
+                    await result
             except Exception as e:
-                logger.fatal(f'Error while processing que: {e}')
+                stats.errors += 1
+                HANDLER_ERRORS.labels(self.name, name).inc()
+                logger.exception(f'Error while handling {name}: {e}')
+            finally:
+                profiler.handlers.pop(task, None)
+            elapsed = time.perf_counter() - started
+            stats.add(elapsed)
+            HANDLER_SECONDS.labels(self.name, name).observe(elapsed)
+            if dequeued is not None and isinstance(obj, (Candle, RawCandle)):
+                tracer.on_handled(obj.inst_id, dequeued, time.perf_counter_ns())
+
+    async def listen_to_queue(self):
+        while True:
+            batch = await self.queue.get_batch()
+            await self.dispatch(batch, time.perf_counter_ns() if tracer.enabled else None)
+
+    async def _on_candle(self, candle: Candle):
+        await self.candle_handler(candle)
+        self._publish_candle(candle)
+
+    def subscribe(self, callback, on=(EventKind.CLOSE,), throttle=0., interval=None, inst_ids=None) -> Subscription:
+        """Calls `callback(StrategyEvent)` on bar close, forming-bar updates (at most every `throttle` s) or every `interval` s."""
+        evaluation = EVALUATION_SECONDS.labels(self.name, getattr(callback, '__name__', repr(callback)))
+        subscription = Subscription(callback, on, throttle=throttle, interval=interval, inst_ids=inst_ids,
+                                    evaluation=evaluation)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def _publish_candle(self, candle: Candle):
+        key = (candle.inst_id, candle.timeframe)
+        last_candle = self._last_candles.get(key)
+        if last_candle is not None and candle.timestamp_ms < last_candle.timestamp_ms:
+            return
+        self._last_candles[key] = candle
+        for subscription in self.subscriptions:
+            if last_candle is not None and candle.timestamp_ms != last_candle.timestamp_ms:
+                subscription.push(EventKind.CLOSE, last_candle)
+            subscription.push(EventKind.UPDATE, candle)
+
+    async def fetch_warmup_history(self, ticker: str, tf: str, num_bars: int, min_bars: int,
+                                   timeout: float) -> List[Candle]:
+        """History to rebuild indicator state from: `num_bars` if they arrive within `timeout` seconds,
+        otherwise just the `min_bars` the indicators cannot do without."""
+        if num_bars <= min_bars:
+            return await self.connection.get_history_candles(ticker=ticker, tf=tf, num_bars=min_bars)
+        try:
+            return await asyncio.wait_for(
+                self.connection.get_history_candles(ticker=ticker, tf=tf, num_bars=num_bars), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f'{num_bars} bars of {ticker} {tf} took over {timeout}s, warming up from {min_bars}')
+            return await self.connection.get_history_candles(ticker=ticker, tf=tf, num_bars=min_bars)
 
     async def monitor_trader(self):
         while not self.trader_task.done():
-            await asyncio.sleep(10)
+            await asyncio.sleep(self.monitor_interval)
+            logger.debug('Queues: %s', self.queue.metrics())
+            logger.debug('Rate limits: %s', self.connection.rate_limiter.metrics())
+            logger.debug('Alerts: %s', self.alert_manager.metrics())
         logger.error(f'Trader stopped.')
 
+    async def dump_latency(self):
+        """Logs the tick-to-order stage histograms, and writes them with the per-instrument ones to a JSON file."""
+        while True:
+            await asyncio.sleep(self.latency_dump_interval)
+            logger.info('Latency: %s', tracer.summary())
+            if self.latency_dump_path:
+                summary = json.dumps(tracer.summary(per_instrument=True), indent=2)
+                await asyncio.to_thread(self._write_file, self.latency_dump_path, summary)
+
+    @staticmethod
+    def _write_file(path: str, text: str):
+        with open(path, 'w') as file:
+            file.write(text)
+
+    def collect_metrics(self) -> List[Family]:
+        """Queue, rate-limit, alert and account state for the metrics endpoint, read when it is scraped."""
+        strategy = {'strategy': self.name}
+        depth, max_depth, events = [], [], []
+        for queue_name, queue_metrics in self.queue.metrics().items():
+            labels = {**strategy, 'queue': queue_name}
+            depth.append(('', labels, queue_metrics['depth']))
+            max_depth.append(('', labels, queue_metrics['max_depth']))
+            events.extend(('', {**labels, 'event': event}, queue_metrics[event])
+                          for event in ('put', 'conflated', 'dropped', 'blocked') if event in queue_metrics)
+        families = [
+            ('tradebot_queue_depth', 'gauge', 'Events waiting in a strategy queue', depth),
+            ('tradebot_queue_max_depth', 'gauge', 'Deepest a strategy queue has been', max_depth),
+            ('tradebot_queue_events_total', 'counter', 'Events put, conflated, dropped or blocked by a strategy queue',
+             events),
+        ]
+
+        rate_limiter = getattr(self.connection, 'rate_limiter', None)
+        if rate_limiter is not None:
+            buckets = rate_limiter.metrics().items()
+            families.append(('tradebot_rate_limit_throttled_total', 'counter', 'Requests that waited for a token',
+                             [('', {**strategy, 'bucket': name}, bucket['throttled']) for name, bucket in buckets]))
+            families.append(('tradebot_rate_limit_wait_seconds_total', 'counter', 'Time requests waited for a token',
+                             [('', {**strategy, 'bucket': name}, bucket['wait_total_s']) for name, bucket in buckets]))
+
+        trade_mux = getattr(self.connection, 'trade_mux', None)
+        if trade_mux is not None:
+            families.append(('tradebot_trade_requests_in_flight', 'gauge', 'Trade requests awaiting a response',
+                             [('', strategy, trade_mux.in_flight)]))
+
+        alerts = self.alert_manager.metrics()
+        if alerts:
+            families.append(('tradebot_alerts_total', 'counter', 'Alerts queued, sent, dropped or failed',
+                             [('', {**strategy, 'event': event}, alerts[event])
+                              for event in ('queued', 'sent', 'dropped', 'errors')]))
+
+        account = getattr(self, 'account', None)
+        if account is not None:
+            families.append(('tradebot_account_equity_usd', 'gauge', 'Account equity in USD',
+                             [('', strategy, account.total_usd)]))
+        return families
+
     async def exit(self):
 
+        registry.unregister_collector(f'strategy:{self.name}')
         await self.connection.exit()
+        await self.alert_manager.close()
         for task in self.tasks:
             if not task.done():
                 task.cancel()
 
     async def run(self):
+        if self.stall_threshold:
+            profiler.start_watchdog(self.stall_threshold)
+        if self.metrics_enabled:
+            registry.register_collector(f'strategy:{self.name}', self.collect_metrics)
+            registry.register_collector('latency', collect_latency)
+            if self.metrics_port is not None:
+                await serve(self.metrics_host, self.metrics_port)
         await self.connection.run()
         for task in self.sequent_tasks:
             await task()
         for task in self.parallel_tasks:
-            self.tasks.append(asyncio.create_task(task()))
+            self.tasks.append(asyncio.create_task(task(), name=f'{self.name}.{task.__name__}'))
 
-        self.tasks.append(asyncio.create_task(self.listen_to_queue()))
+        # task names show up in stall reports and profiles
+        self.tasks.append(asyncio.create_task(self.listen_to_queue(), name=f'{self.name}.dispatch'))
 
-        self.trader_task = asyncio.create_task(self.trader())
-        self.tasks.append(asyncio.create_task(self.monitor_trader()))
+        self.trader_task = asyncio.create_task(self.trader(), name=f'{self.name}.trader')
+        if self.monitor_interval:
+            self.tasks.append(asyncio.create_task(self.monitor_trader(), name=f'{self.name}.monitor_trader'))
+        if tracer.enabled and self.latency_dump_interval:
+            self.tasks.append(asyncio.create_task(self.dump_latency(), name=f'{self.name}.dump_latency'))
+        if self.metrics_enabled and self.loop_lag_interval:
+            start_loop_lag_monitor(self.loop_lag_interval)
 
         self.alert_manager.send_message(f'Trader {self.name} started')
 
@@ -81,9 +414,9 @@ class StrategyBase:
     def add_sequent_task(self, task):
         self.sequent_tasks.append(task)
 
-    @abstractmethod
     async def trader(self):
-        pass
+        await asyncio.gather(*(asyncio.create_task(subscription.run(), name=f'{self.name}.{subscription.name}')
+                               for subscription in self.subscriptions))
 
     @abstractmethod
     async def candle_handler(self, obj):
@@ -1,14 +1,15 @@
 import asyncio
 from typing import Dict
 import numpy as np
-from Strategy.StrategyBase import StrategyBase
+from Strategy.StrategyBase import StrategyBase, StrategyEvent
 from Structures.public import *
 from Structures.private import *
 from Structures.trade import *
 from collections import deque
 import pandas as pd
 from pandas import DataFrame
-import cvxpy as cp
+from Strategy.moments import LEDOIT_WOLF, ReturnMoments
+from Strategy.portfolio import Budget, optimal_portfolio
 
 from Tools.logger import Logger
 
@@ -16,46 +17,31 @@ logger = Logger(__name__).logger
 
 
 def markovitz_portfolio(r, sigma, theta, can_short, tickers=None):
-    tickers = tickers or range(r.shape[0])
-    print(r, type(r), r.shape)
-    w = cp.Variable(r.shape)  # portfolio
-
-    ret = r.T @ w
-    risk = cp.quad_form(w, sigma)
-
-    if can_short:
-        constraints = [cp.norm(w, 1) <= 1]
-    else:
-        constraints = [cp.sum(w) == 1, w >= 0]
-
-    prob = cp.Problem(
-        cp.Maximize(ret - theta * risk),
-        constraints
-    )
-    prob.solve()
-    params = {
-        'risk': risk.value,
-        'return': ret.value,
-    }
-    return pd.Series(np.round(w.value, 3), index=tickers), params
+    budget = Budget.GROSS if can_short else Budget.LONG_ONLY
+    return optimal_portfolio(r, sigma, theta, budget, tickers=tickers, decimals=3)
 
 
 class MarkowitzStrategy(StrategyBase):
     def __init__(self, config, debug=True):
         super().__init__(config, __name__, debug)
 
-        self.trade_amount = 1000
-        self.theta = 100
-        self.leverage = 5
+        self.trade_amount = config['markowitz'].get('trade_amount', 1000)
+        self.theta = config['markowitz'].get('theta', 100)
+        self.leverage = config['markowitz'].get('leverage', 5)
         self.tf = config['markowitz']['timeframe']
         self.tickers: List[str] = config['markowitz']['tickers']
-        self.candle_history: Dict[deque[Candle]] = {}
         self.instruments_info = {}
-        self.candle_history_length = 3
+        self.candle_history_length = config['markowitz'].get('candle_history_length', 3)
         self.current_candle_start = None
         self.positions = None
         self.add_parallel_task(self.set_instrument_info)
-        self.add_parallel_task(self.trader)
+        # returns between closed bars only, the forming bar just sets the prices to trade at
+        halflife = config['markowitz'].get('ewma_halflife')
+        # Ledoit-Wolf needs a window of observations, an EWMA has none
+        shrinkage = config['markowitz'].get('shrinkage', None if halflife else LEDOIT_WOLF)
+        self.returns = ReturnMoments(self.tickers, window=None if halflife else self.candle_history_length - 1,
+                                     halflife=halflife, shrinkage=shrinkage)
+        self.subscribe(self.rebalance, on=(), interval=config['markowitz'].get('rebalance_interval', 60 * 30))
 
     async def set_instrument_info(self):
         for ticker in self.tickers:
@@ -64,11 +50,8 @@ class MarkowitzStrategy(StrategyBase):
                 uly=ticker.replace('-SWAP', '')
             )
 
-    def close_prices_df(self):
-        d = pd.DataFrame({k: [x.close for x in v] for k, v in self.candle_history.items() if k in self.tickers})
-        if d.shape[0] != self.candle_history_length:
-            return None
-        return d
+    def last_prices(self) -> pd.Series:
+        return pd.Series({ticker: float(self.candle_store.get(ticker, self.tf).close[-1]) for ticker in self.tickers})
 
     def close_all_positions(self):
         if self.positions is None:
@@ -84,6 +67,7 @@ class MarkowitzStrategy(StrategyBase):
             self.connection.place_order(order)
 
     async def open_portfolio(self, portfolio, prices):
+        orders = []
         for ticker, w in portfolio.items():
             if abs(w) > 0:
                 size = int(abs(self.leverage * w * self.trade_amount / (prices[ticker] * self.instruments_info[ticker].contract_value)))
@@ -95,53 +79,44 @@ class MarkowitzStrategy(StrategyBase):
                     order_type=OrderType.MARKET,
                 )
                 self.alert_manager.send_message(order)
-                await self.connection.place_order(order)
+                orders.append(order)
+        await asyncio.gather(*(self.connection.submit_order(order) for order in orders))
 
     async def trader(self):
         wait = True
         while wait:
-            df = self.close_prices_df()
-            print(df)
-            if df is not None:
+            if self.returns.ready:
                 wait = False
             await asyncio.sleep(5)
-        while True:
-            df = self.close_prices_df()
-            if df is not None:
-                # closing
-                self.close_all_positions()
-
-                df_ret = (df.diff() / df.shift())
-                prices = df.iloc[-1]
-                r = df_ret.mean(axis=0).values
-                sigma = df_ret.cov().values
-                portfolio, _ = markovitz_portfolio(r, sigma, self.theta, True, tickers=self.tickers)
-                portfolio = pd.Series(np.ones(len(self.tickers)) / len(self.tickers), index=self.tickers)
-                print(portfolio.abs().sum())
-                await self.open_portfolio(portfolio, prices)
-
-                # opening
-
-            await asyncio.sleep(60 * 30)  # 30 min
-
-    async def update_candle_history(self, candle):
-        ticker = candle.inst_id
-        if self.candle_history.get(ticker) is None:
-            self.candle_history[ticker] = deque(
-                await self.connection.get_history_candles(ticker=ticker, tf=self.tf,
-                                                          num_bars=self.candle_history_length - 1))
-            self.candle_history[ticker].append(candle)
+        await super().trader()
+
+    async def rebalance(self, event: StrategyEvent):
+        if self.returns.ready:
+            # closing
+            self.close_all_positions()
 
-        if self.candle_history[ticker][-1].datetime == candle.datetime:
-            self.candle_history[ticker][-1] = candle
+            prices = self.last_prices()
+            r = self.returns.mean()
+            sigma = self.returns.covariance()
+            portfolio, _ = markovitz_portfolio(r, sigma, self.theta, True, tickers=self.tickers)
+            portfolio = pd.Series(np.ones(len(self.tickers)) / len(self.tickers), index=self.tickers)
+            await self.open_portfolio(portfolio, prices)
 
-        elif self.candle_history[ticker][-1].datetime != candle.datetime:
-            self.candle_history[ticker].append(candle)
-            if len(self.candle_history[ticker]) > self.candle_history_length:
-                self.candle_history[ticker].popleft()
+            # opening
 
     async def candle_handler(self, candle: Candle):
-        await self.update_candle_history(candle)
+        ticker = candle.inst_id
+        candle_history = self.candle_store.get(ticker, candle.timeframe)
+        if candle_history is None:
+            candle_history = self.candle_store.buffer(ticker, candle.timeframe, self.candle_history_length)
+            history = await self.connection.get_history_candles(ticker=ticker, tf=self.tf,
+                                                                num_bars=self.candle_history_length + 1)
+            candle_history.extend(history)
+            # the last one may still be forming, it is added below once the next bar starts
+            for history_candle in history[:-1]:
+                self.returns.close(ticker, history_candle.timestamp_ms, history_candle.close)
+        if candle_history.update(candle) and len(candle_history) > 1:
+            self.returns.close(ticker, int(candle_history.timestamp_ms[-2]), float(candle_history.close[-2]))
 
     def account_handler(self, account: Account):
         self.account = account
@@ -151,9 +126,9 @@ class MarkowitzStrategy(StrategyBase):
 
     def order_response_handler(self, order_response: OrderResponse):
         self.alert_manager.send_message(order_response, title='order response')
-        logger.info(f'Gor order response: {order_response}')
+        logger.info('Gor order response: %s', order_response)
         pass
 
     def fill_order_handler(self, fill_order: FillOrder):
         self.alert_manager.send_message(fill_order, title='fill order')
-        logger.info(f'Gor fill order: {fill_order}')
+        logger.info('Gor fill order: %s', fill_order)
@@ -2,14 +2,15 @@ import asyncio
 from abc import ABC
 from typing import Dict
 import numpy as np
-from Strategy.StrategyBase import StrategyBase
+from Strategy.StrategyBase import StrategyBase, StrategyEvent
 from Structures.public import *
 from Structures.private import *
 from Structures.trade import *
 from collections import deque
 import pandas as pd
 from pandas import DataFrame
-import cvxpy as cp
+from Strategy.moments import LEDOIT_WOLF, ReturnMoments
+from Strategy.portfolio import Budget, optimal_portfolio
 
 from Tools.logger import Logger
 
@@ -17,29 +18,7 @@ logger = Logger(__name__).logger
 
 
 def markovitz_portfolio(r, sigma, theta, tickers=None):
-    tickers = tickers or range(r.shape[0])
-
-    if isinstance(r, pd.Series):
-        r = r.values
-    if isinstance(sigma, pd.Series):
-        sigma = sigma.values
-    w = cp.Variable(r.shape)
-
-    ret = r.T @ w
-    risk = cp.quad_form(w, sigma)
-
-    constraints = [cp.sum(w) == 1, w >= 0]
-
-    prob = cp.Problem(
-        cp.Maximize(ret - theta * risk),
-        constraints
-    )
-    prob.solve()
-    params = {
-        'risk': risk.value,
-        'return': ret.value,
-    }
-    return pd.Series(np.round(w.value, 7), index=tickers), params
+    return optimal_portfolio(r, sigma, theta, Budget.LONG_ONLY, tickers=tickers)
 
 
 class MarkowitzStrategy(StrategyBase):
@@ -47,16 +26,15 @@ class MarkowitzStrategy(StrategyBase):
         super().__init__(config, __name__, debug)
 
         self.min_balance = 8
-        self.trade_amount = 10
-        self.theta = 10
+        self.trade_amount = config['markowitz'].get('trade_amount', 10)
+        self.theta = config['markowitz'].get('theta', 10)
         self.quote_ccy = 'USDT'
 
         self.tf = config['markowitz']['timeframe']
         self.ccys: List[str] = config['markowitz']['tickers']
 
-        self.candle_history: Dict[str: deque[Candle]] = {}
         self.instruments_info = {}
-        self.candle_history_length = 30
+        self.candle_history_length = config['markowitz'].get('candle_history_length', 30)
         self.positions: List[Position] = None
         self.account: Account = None
 
@@ -65,6 +43,14 @@ class MarkowitzStrategy(StrategyBase):
         self.add_sequent_task(self.set_candles_history)
         self.add_sequent_task(self.set_instrument_info)
         self.add_parallel_task(self.monitor)
+        # returns between closed bars only, the forming bar just sets the prices to trade at
+        halflife = config['markowitz'].get('ewma_halflife')
+        # Ledoit-Wolf needs a window of observations, an EWMA has none
+        shrinkage = config['markowitz'].get('shrinkage', None if halflife else LEDOIT_WOLF)
+        self.returns = ReturnMoments([f'{ccy}-{self.quote_ccy}' for ccy in self.ccys],
+                                     window=None if halflife else self.candle_history_length - 1,
+                                     halflife=halflife, shrinkage=shrinkage)
+        self.subscribe(self.rebalance, on=(), interval=config['markowitz'].get('rebalance_interval', 60 * 30))
 
     async def monitor(self):
         while self.account is None and self.positions is None:
@@ -73,18 +59,23 @@ class MarkowitzStrategy(StrategyBase):
         logger.warning(f'Monitor started')
         while True:
             if self.account:
-                logger.info(f'{self.account}')
+                logger.info('%s', self.account)
             if self.positions:
-                logger.info(f'{self.positions}')
+                logger.info('%s', self.positions)
             if self.active_orders:
-                logger.warning(f'Active orders: {self.active_orders}')
+                logger.warning('Active orders: %s', self.active_orders)
             await asyncio.sleep(60 * 15)
 
     async def set_candles_history(self):
         for ccy in self.ccys:
-            self.candle_history[ccy] = deque(
-                await self.connection.get_history_candles(ticker=f'{ccy}-{self.quote_ccy}', tf=self.tf,
-                                                          num_bars=self.candle_history_length))
+            inst_id = f'{ccy}-{self.quote_ccy}'
+            # one closed bar more than the window has returns, plus the forming one
+            history = await self.connection.get_history_candles(ticker=inst_id, tf=self.tf,
+                                                                num_bars=self.candle_history_length + 1)
+            self.candle_store.buffer(inst_id, self.tf, self.candle_history_length).extend(history)
+            # the last one may still be forming, candle_handler adds it once the next bar starts
+            for candle in history[:-1]:
+                self.returns.close(inst_id, candle.timestamp_ms, candle.close)
 
     async def set_instrument_info(self):
         for ccy in self.ccys:
@@ -94,16 +85,23 @@ class MarkowitzStrategy(StrategyBase):
             )
         logger.warning(f'Min position: \n{self.instruments_info}')
 
-    def close_prices_to_df(self):
-        d = pd.DataFrame({ticker: [x.close for x in self.candle_history[ticker]] for ticker in self.ccys})
-        if d.shape[0] != self.candle_history_length:
-            return None
-        return d
+    def last_prices(self) -> pd.Series:
+        return pd.Series({ccy: float(self.candle_store.get(f'{ccy}-{self.quote_ccy}', self.tf).close[-1])
+                          for ccy in self.ccys})
+
+    def untrack_failed(self, order: Order, order_response: OrderResponse):
+        """Stops waiting for orders the exchange rejected; timed-out ones may still fill and stay tracked."""
+        if order_response.status == OrderStatus.TIMEOUT:
+            logger.error('No response for %s order, waiting for its fill: %s', order.action.value, order)
+        elif order_response.status != OrderStatus.OK:
+            if order in self.active_orders:
+                self.active_orders.remove(order)
+            logger.error(f'Invalid {order.action.value} order: {order}')
 
     async def wait_orders_fill(self):
         while len(self.active_orders):
             await asyncio.sleep(1)
-            logger.warning(f'Waiting for filling orders: {self.active_orders}')
+            logger.warning('Waiting for filling orders: %s', self.active_orders)
 
     async def rebuild_portfolio(self, portfolio, prices):
         portfolio_usd = portfolio * self.trade_amount
@@ -158,59 +156,48 @@ class MarkowitzStrategy(StrategyBase):
             if order is not None:
                 orders[order.action].append(order)
 
-        for order in orders[Action.SELL]:
-            order_response = await self.connection.place_order(order)
+        # tracked before sending so a fast fill is not missed
+        self.active_orders.extend(orders[Action.SELL])
+        order_responses = await asyncio.gather(*(self.connection.submit_order(order) for order in orders[Action.SELL]))
+        for order, order_response in zip(orders[Action.SELL], order_responses):
             if order_response.status == OrderStatus.OK:
-                self.active_orders.append(order)
-                logger.warning(f'placed SELL order: {order}')
+                logger.warning('placed SELL order: %s', order)
             else:
-                logger.error(f'Invalid SELL order: {order}')
+                self.untrack_failed(order, order_response)
 
         await self.wait_orders_fill()
 
-        for order in orders[Action.BUY]:
-            order_response = await self.connection.place_order(order)
+        # tracked before sending so a fast fill is not missed
+        self.active_orders.extend(orders[Action.BUY])
+        order_responses = await asyncio.gather(*(self.connection.submit_order(order) for order in orders[Action.BUY]))
+        for order, order_response in zip(orders[Action.BUY], order_responses):
             if order_response.status == OrderStatus.OK:
-                self.active_orders.append(order)
-                logger.warning(f'placed BUY order: {order}')
+                logger.warning('placed BUY order: %s', order)
             else:
-                logger.error(f'Invalid BUY order: {order}')
-
-    async def trader(self):
-        while True:
-            df = self.close_prices_to_df()
-            if df is not None:
-                # self.trade_amount = int(self.account.total_usd - self.account.in_coins_usd)
-                # logger.warning(f'Set trade ammount to {self.trade_amount}')
-                df_ret = (df.diff() / df.shift())
-                prices = df.iloc[-1]
-                r = df_ret.iloc[-1]
-                sigma = df_ret.cov()
-                portfolio, stats = markovitz_portfolio(r, sigma, self.theta, tickers=self.ccys)
-
-                logger.info(f'\nExpected return: \n{r}\nPortfolio: \n{portfolio}\nExpected stats: \n{stats}')
-                await self.rebuild_portfolio(portfolio, prices)
-
-            await asyncio.sleep(60 * 30)
-
-    async def update_candle_history(self, candle):
-        ccy = candle.inst_id.replace(f'-{self.quote_ccy}', '')
-        if ccy not in self.ccys:
-            return
-        if self.candle_history.get(ccy) is None:
-            raise RuntimeError(f'Empty candle history for ccy: {ccy}')
+                self.untrack_failed(order, order_response)
 
-        if self.candle_history[ccy][-1].datetime == candle.datetime:
-            self.candle_history[ccy][-1] = candle
+    async def rebalance(self, event: StrategyEvent):
+        if self.returns.ready:
+            # self.trade_amount = int(self.account.total_usd - self.account.in_coins_usd)
+            # logger.warning(f'Set trade ammount to {self.trade_amount}')
+            prices = self.last_prices()
+            r = pd.Series(self.returns.last(), index=self.ccys)
+            sigma = self.returns.covariance()
+            portfolio, stats = markovitz_portfolio(r, sigma, self.theta, tickers=self.ccys)
 
-        elif self.candle_history[ccy][-1].datetime != candle.datetime:
-            self.candle_history[ccy].append(candle)
-            if len(self.candle_history[ccy]) > self.candle_history_length:
-                self.candle_history[ccy].popleft()
+            logger.info('\nExpected return: \n%s\nPortfolio: \n%s\nExpected stats: \n%s', r, portfolio, stats)
+            await self.rebuild_portfolio(portfolio, prices)
 
     # HANDLERS
     async def candle_handler(self, candle: Candle):
-        await self.update_candle_history(candle)
+        ccy = candle.inst_id.replace(f'-{self.quote_ccy}', '')
+        if ccy not in self.ccys:
+            return
+        candle_history = self.candle_store.get(candle.inst_id, candle.timeframe)
+        if candle_history is None:
+            raise RuntimeError(f'Empty candle history for ccy: {ccy}')
+        if candle_history.update(candle) and len(candle_history) > 1:
+            self.returns.close(candle.inst_id, int(candle_history.timestamp_ms[-2]), float(candle_history.close[-2]))
 
     async def account_handler(self, account: Account):
         self.account = account
@@ -222,12 +209,16 @@ class MarkowitzStrategy(StrategyBase):
         self.positions = positions
 
     async def fill_order_handler(self, fill_order: FillOrder):
-        logger.info(f'Gor fill order: {fill_order}')
+        logger.info('Gor fill order: %s', fill_order)
         for order in self.active_orders:
             if order.id == fill_order.id:
                 order.fill_status = fill_order.state
                 if order.fill_status == FillStatus.FILLED:
                     self.active_orders.remove(order)
                     self.alert_manager.send_message(fill_order, title='filled order')
-                    logger.info(f'Filled order: {order}')
+                    logger.info('Filled order: %s', order)
+                elif order.fill_status == FillStatus.CANCELED:
+                    self.active_orders.remove(order)
+                    logger.error('Order canceled: %s', order)
+                break
 
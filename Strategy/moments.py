@@ -0,0 +1,179 @@
+"""Streaming mean and covariance of bar returns for the Markowitz inputs, O(N²) per bar.
+
+    returns = ReturnMoments(tickers, window=29, shrinkage='ledoit-wolf')
+    returns.close(inst_id, ts, close)   # once per closed bar and instrument
+    r, sigma = returns.mean(), returns.covariance()
+"""
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+
+LEDOIT_WOLF = 'ledoit-wolf'
+
+
+class RollingMoments:
+    """Mean and covariance of the last `window` vectors (Welford add/remove), or exponentially
+    weighted ones when `halflife` is given.
+
+    `shrinkage` pulls the covariance towards (trace / N) * I, either by a fixed intensity in [0, 1]
+    or by the Ledoit-Wolf estimate of it, which needs the window of observations.
+    """
+
+    def __init__(self, n_assets: int, window: int = None, halflife: float = None,
+                 shrinkage: Union[float, str, None] = None):
+        if (window is None) == (halflife is None):
+            raise ValueError('RollingMoments needs either a window or a halflife')
+        if halflife is not None and shrinkage == LEDOIT_WOLF:
+            raise ValueError('Ledoit-Wolf shrinkage needs a window of observations')
+        self.n_assets = n_assets
+        self.window = window
+        self.alpha = 1 - 0.5 ** (1 / halflife) if halflife is not None else None
+        self.shrinkage = shrinkage
+
+        self.count = 0
+        self.last = np.full(n_assets, np.nan)
+        self._mean = np.zeros(n_assets)
+        # sum of outer products of deviations (window) or the covariance itself (EWMA)
+        self._m2 = np.zeros((n_assets, n_assets))
+        self._observations = np.zeros((window, n_assets)) if window else None
+        self._head = 0
+        self._removes_since_resum = 0
+
+    @property
+    def ready(self) -> bool:
+        return self.count >= (self.window or 2)
+
+    def push(self, x: np.ndarray):
+        x = np.asarray(x, dtype=float)
+        self.last = x
+        if self.alpha is not None:
+            self._push_ewma(x)
+        else:
+            self._push_window(x)
+
+    def _push_ewma(self, x: np.ndarray):
+        self.count += 1
+        if self.count == 1:
+            self._mean = x.copy()
+            return
+        delta = x - self._mean
+        self._mean += self.alpha * delta
+        self._m2 = (1 - self.alpha) * (self._m2 + self.alpha * np.outer(delta, delta))
+
+    def _push_window(self, x: np.ndarray):
+        if self.count == self.window:
+            self._remove(self._observations[self._head])
+        self._observations[self._head] = x
+        self._head = (self._head + 1) % self.window
+
+        self.count += 1
+        delta = x - self._mean
+        self._mean += delta / self.count
+        self._m2 += np.outer(delta, x - self._mean)
+
+        # add/remove pairs accumulate rounding error, rebuild from the window every so often
+        if self._removes_since_resum >= 10 * self.window:
+            self._removes_since_resum = 0
+            self._mean = self._observations.mean(axis=0)
+            centered = self._observations - self._mean
+            self._m2 = centered.T @ centered
+
+    def _remove(self, y: np.ndarray):
+        self.count -= 1
+        self._removes_since_resum += 1
+        if not self.count:
+            self._mean[:] = 0
+            self._m2[:] = 0
+            return
+        delta = y - self._mean
+        self._mean -= delta / self.count
+        self._m2 -= np.outer(delta, y - self._mean)
+
+    def mean(self) -> np.ndarray:
+        return self._mean.copy()
+
+    def sample_covariance(self) -> np.ndarray:
+        if self.alpha is not None:
+            return self._m2.copy()
+        if self.count < 2:
+            return np.full((self.n_assets, self.n_assets), np.nan)
+        return self._m2 / (self.count - 1)
+
+    def shrinkage_intensity(self) -> float:
+        if self.shrinkage is None:
+            return 0.
+        if self.shrinkage != LEDOIT_WOLF:
+            return float(self.shrinkage)
+        if self.count < 2:
+            return 1.
+        # Ledoit & Wolf (2004): the estimation error of S against its distance from the scaled identity
+        centered = self._observations[:self.count] - self._mean
+        s = self._m2 / self.count
+        mu = np.trace(s) / self.n_assets
+        distance = ((s - mu * np.eye(self.n_assets)) ** 2).sum()
+        if distance <= 0:
+            return 0.
+        error = (((centered ** 2).sum(axis=1) ** 2).sum() - self.count * (s ** 2).sum()) / self.count ** 2
+        return float(min(max(error, 0.), distance) / distance)
+
+    def covariance(self) -> np.ndarray:
+        sigma = self.sample_covariance()
+        intensity = self.shrinkage_intensity()
+        if intensity:
+            target = np.trace(sigma) / self.n_assets * np.eye(self.n_assets)
+            sigma = intensity * target + (1 - intensity) * sigma
+        return sigma
+
+
+class ReturnMoments:
+    """RollingMoments of simple returns between consecutive bar closes of a fixed list of instruments.
+
+    A bar counts once every instrument has closed it; bars some instrument never closes are skipped.
+    """
+
+    def __init__(self, inst_ids: Sequence[str], window: int = None, halflife: float = None,
+                 shrinkage: Union[float, str, None] = None):
+        self.inst_ids: List[str] = list(inst_ids)
+        self._index: Dict[str, int] = {inst_id: i for i, inst_id in enumerate(self.inst_ids)}
+        self.moments = RollingMoments(len(self.inst_ids), window=window, halflife=halflife, shrinkage=shrinkage)
+        self.last_ts: Optional[int] = None
+        self._last_closes: Optional[np.ndarray] = None
+        self._pending: Dict[int, np.ndarray] = {}
+        self._pending_count: Dict[int, int] = {}
+
+    @property
+    def ready(self) -> bool:
+        return self.moments.ready
+
+    def close(self, inst_id: str, ts: int, close: float):
+        i = self._index.get(inst_id)
+        if i is None or (self.last_ts is not None and ts <= self.last_ts):
+            return
+        row = self._pending.get(ts)
+        if row is None:
+            row = self._pending[ts] = np.full(len(self.inst_ids), np.nan)
+            self._pending_count[ts] = 0
+        if np.isnan(row[i]):
+            self._pending_count[ts] += 1
+        row[i] = close
+        if self._pending_count[ts] == len(self.inst_ids):
+            self._complete(ts)
+
+    def _complete(self, ts: int):
+        closes = self._pending[ts]
+        for pending_ts in [pending_ts for pending_ts in self._pending if pending_ts <= ts]:
+            del self._pending[pending_ts]
+            del self._pending_count[pending_ts]
+        if self._last_closes is not None:
+            self.moments.push(closes / self._last_closes - 1)
+        self._last_closes = closes
+        self.last_ts = ts
+
+    def mean(self) -> np.ndarray:
+        return self.moments.mean()
+
+    def last(self) -> np.ndarray:
+        return self.moments.last.copy()
+
+    def covariance(self) -> np.ndarray:
+        return self.moments.covariance()
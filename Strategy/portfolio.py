@@ -0,0 +1,163 @@
+"""Mean-variance portfolios: maximise r'w - theta * w'Σw under a budget constraint.
+
+Each (number of assets, budget) shape is built once as a parameterised cvxpy problem and
+re-solved with warm start on every rebalance. Long-only, fully invested portfolios are
+solved by an active-set method on the KKT system first, cvxpy is only the fallback.
+"""
+import functools
+from enum import Enum
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    import cvxpy as cp
+except ImportError:
+    cp = None
+
+
+class Budget(Enum):
+    LONG_ONLY = 'long_only'  # sum(w) == 1, w >= 0
+    GROSS = 'gross'  # sum(|w|) <= 1, shorts allowed
+
+
+def risk_factor(sigma: np.ndarray) -> np.ndarray:
+    """F with F @ F.T == sigma, also for the singular covariances of short histories."""
+    try:
+        return np.linalg.cholesky(sigma)
+    except np.linalg.LinAlgError:
+        values, vectors = np.linalg.eigh(sigma)
+        return vectors * np.sqrt(values.clip(min=0))
+
+
+# smallest Cholesky pivot against the largest below which Σ counts as singular, i.e. condition number ~1e10
+MIN_PIVOT_RATIO = 1e-10
+
+
+def long_only_active_set(r: np.ndarray, sigma: np.ndarray, theta: float, active: np.ndarray = None,
+                         max_iter: int = None) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """Weights and active set for sum(w) == 1, w >= 0, starting from a previous active set.
+
+    On the active (non-zero) assets the optimum solves 2θΣ_AA w_A = r_A + ν1 with ν set by the budget.
+    Returns None when the KKT conditions cannot be met in `max_iter` steps or Σ is (close to) singular,
+    as the sample covariance of fewer returns than assets is.
+    """
+    n = len(r)
+    q = 2 * theta * sigma
+    # np.linalg.solve does not fail on a numerically singular Σ_AA, it returns an arbitrary solution.
+    # A tiny Cholesky pivot of Σ shows it is ill-conditioned, and no principal submatrix Σ_AA is better.
+    try:
+        pivots = np.diag(np.linalg.cholesky(q)) ** 2
+    except np.linalg.LinAlgError:
+        return None
+    if not pivots.min() > MIN_PIVOT_RATIO * pivots.max():
+        return None
+    active = np.ones(n, dtype=bool) if active is None or len(active) != n else active.copy()
+    w_tol = 1e-10
+    mu_tol = 1e-9 * (np.abs(r).max() + np.abs(q).max() + 1e-300)
+
+    for _ in range(max_iter or 2 * n + 10):
+        index = np.flatnonzero(active)
+        if not len(index):
+            return None
+        try:
+            x = np.linalg.solve(q[np.ix_(index, index)], np.column_stack([r[index], np.ones(len(index))]))
+        except np.linalg.LinAlgError:
+            return None
+        ones_weight = x[:, 1].sum()
+        if not np.isfinite(ones_weight) or abs(ones_weight) < 1e-300:
+            return None
+        nu = (1 - x[:, 0].sum()) / ones_weight
+        w_active = x[:, 0] + nu * x[:, 1]
+        if not np.isfinite(w_active).all():
+            return None
+        # stationarity on the active set, in case the solve was not accurate after all
+        residual = q[np.ix_(index, index)] @ w_active - r[index] - nu
+        if np.abs(residual).max() > 1e-8 * (np.abs(r[index]).max() + abs(nu) + 1e-300):
+            return None
+        if w_active.min() < -w_tol:
+            active[index[w_active < -w_tol]] = False
+            continue
+
+        w = np.zeros(n)
+        w[index] = w_active.clip(min=0)
+        # multipliers of the w >= 0 constraints, a negative one means the asset should be bought
+        mu = q @ w - r - nu
+        mu[active] = 0
+        worst = int(mu.argmin())
+        if mu[worst] >= -mu_tol:
+            return w / w.sum(), active
+        active[worst] = True
+    return None
+
+
+class PortfolioOptimizer:
+    """Solver for one shape of the problem, reused across rebalances.
+
+    Σ enters as the factor F = sqrt(θ)·chol(Σ), so that the risk term sum_squares(F'w) keeps
+    the problem DPP and cvxpy canonicalises it only once.
+    """
+
+    # OSQP warm-starts from the previous solution, its default tolerances let sum(|w|) overshoot by ~1e-3
+    SOLVER_OPTIONS = {'solver': 'OSQP', 'eps_abs': 1e-7, 'eps_rel': 1e-7}
+
+    def __init__(self, n_assets: int, budget: Budget = Budget.LONG_ONLY, solver_options: Dict = None):
+        self.n_assets = n_assets
+        self.budget = budget
+        self.solver_options = self.SOLVER_OPTIONS if solver_options is None else solver_options
+        self.solves = 0
+        self.fast_path_solves = 0
+        self._active: Optional[np.ndarray] = None
+        self._problem = None
+
+    def _build(self):
+        if cp is None:
+            raise ImportError('cvxpy is required for this portfolio shape')
+        self._r = cp.Parameter(self.n_assets)
+        self._factor = cp.Parameter((self.n_assets, self.n_assets))
+        self._w = cp.Variable(self.n_assets)
+        if self.budget == Budget.LONG_ONLY:
+            constraints = [cp.sum(self._w) == 1, self._w >= 0]
+        else:
+            constraints = [cp.norm(self._w, 1) <= 1]
+        objective = cp.Maximize(self._r @ self._w - cp.sum_squares(self._factor.T @ self._w))
+        self._problem = cp.Problem(objective, constraints)
+
+    def solve(self, r: np.ndarray, sigma: np.ndarray, theta: float) -> Tuple[np.ndarray, Dict[str, float]]:
+        r = np.asarray(r, dtype=float)
+        sigma = np.asarray(sigma, dtype=float)
+        self.solves += 1
+
+        w = None
+        if self.budget == Budget.LONG_ONLY:
+            solution = long_only_active_set(r, sigma, theta, self._active)
+            if solution is not None:
+                w, self._active = solution
+                self.fast_path_solves += 1
+        if w is None:
+            if self._problem is None:
+                self._build()
+            self._r.value = r
+            self._factor.value = np.sqrt(theta) * risk_factor(sigma)
+            self._problem.solve(warm_start=True, **self.solver_options)
+            w = self._w.value
+
+        return w, {'risk': float(w @ sigma @ w), 'return': float(r @ w)}
+
+
+@functools.lru_cache(maxsize=None)
+def get_optimizer(n_assets: int, budget: Budget) -> PortfolioOptimizer:
+    return PortfolioOptimizer(n_assets, budget)
+
+
+def optimal_portfolio(r, sigma, theta: float, budget: Budget = Budget.LONG_ONLY, tickers: Sequence = None,
+                      decimals: int = 7) -> Tuple[pd.Series, Dict[str, float]]:
+    if isinstance(r, pd.Series):
+        r = r.values
+    if isinstance(sigma, (pd.Series, pd.DataFrame)):
+        sigma = sigma.values
+    r = np.asarray(r, dtype=float)
+    tickers = tickers or range(r.shape[0])
+    w, stats = get_optimizer(r.shape[0], budget).solve(r, sigma, theta)
+    return pd.Series(np.round(w, decimals), index=tickers), stats
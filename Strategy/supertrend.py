@@ -1,6 +1,9 @@
 import asyncio
+import math
+from typing import Dict
+
 import numpy as np
-from Strategy.StrategyBase import StrategyBase
+from Strategy.StrategyBase import StrategyBase, EventKind, StrategyEvent
 from Structures.public import *
 from Structures.private import *
 from Structures.trade import *
@@ -8,6 +11,7 @@ from collections import deque
 import pandas as pd
 from pandas import DataFrame
 
+from Tools.jit import kernel_args, njit
 from Tools.logger import Logger
 
 logger = Logger(__name__).logger
@@ -25,6 +29,8 @@ class EmaTrend:
     def __init__(self, leng):
         self.leng = leng
         self.trend = None
+        self._closes = deque(maxlen=leng + 1)
+        self._bar_ts = None
 
     def calculate(self, df: pd.DataFrame):
         close = df['close']
@@ -32,10 +38,67 @@ class EmaTrend:
         ema_diff = ema.diff()
         self.trend = Trend.UP if ema_diff.iloc[-1] > 0 else Trend.DOWN
 
+    def update(self, candle: Candle):
+        # diff of two adjacent rolling means is (close[-1] - close[-1 - leng]) / leng
+        if candle.timestamp_ms == self._bar_ts:
+            self._closes[-1] = candle.close
+        else:
+            self._bar_ts = candle.timestamp_ms
+            self._closes.append(candle.close)
+        full = len(self._closes) == self._closes.maxlen
+        self.trend = Trend.UP if full and self._closes[-1] > self._closes[0] else Trend.DOWN
+
     def __repr__(self):
         return repr(self.trend)
 
 
+class AverageTrueRange:
+    """Rolling mean of the true range, updated one candle at a time."""
+
+    def __init__(self, period):
+        self.period = period
+        self.value = np.nan
+        self._tr = deque(maxlen=period)
+        self._tr_sum = 0.
+        self._bars_since_resum = 0
+        self._bar_ts = None
+        self._close = np.nan
+        self._prev_close = np.nan
+
+    def _true_range(self, candle):
+        if np.isnan(self._prev_close):
+            return abs(candle.high - candle.low)
+        return max(abs(candle.high - candle.low),
+                   abs(candle.high - self._prev_close),
+                   abs(self._prev_close - candle.low))
+
+    def update(self, candle: Candle) -> float:
+        if candle.timestamp_ms == self._bar_ts:
+            tr = self._true_range(candle)
+            self._tr_sum += tr - self._tr[-1]
+            self._tr[-1] = tr
+        else:
+            self._bar_ts = candle.timestamp_ms
+            self._prev_close = self._close
+            tr = self._true_range(candle)
+            if len(self._tr) == self.period:
+                self._tr_sum -= self._tr[0]
+            self._tr.append(tr)
+            self._tr_sum += tr
+            # running sum drifts by rounding, re-sum once per window
+            self._bars_since_resum += 1
+            if self._bars_since_resum >= self.period:
+                self._tr_sum = math.fsum(self._tr)
+                self._bars_since_resum = 0
+        self._close = candle.close
+        self.value = self._tr_sum / self.period if len(self._tr) == self.period else np.nan
+        return self.value
+
+    @property
+    def ready(self):
+        return len(self._tr) == self.period
+
+
 class SupertrendStatus:
     def __init__(self, period, mul):
         self.price_now = np.nan
@@ -48,18 +111,44 @@ class SupertrendStatus:
 
         self.mul = mul
         self.period = period
+        self._atr = AverageTrueRange(period)
+        self._candle = None
 
     def __repr__(self):
-        res = {}
-        for k, v in self.__dict__.items():
-            if isinstance(v, float):
-                v = np.round(v, 3)
-            res[k] = v
-        return repr(res)
+        return repr(self.to_dict())
 
     def trend_changed(self):
         return self.trend != self.trend_prev
 
+    def update_candle(self, candle: Candle):
+        self._atr.update(candle)
+        self._candle = candle
+
+    def evaluate(self):
+        if not self._atr.ready:
+            return
+        hl2 = (self._candle.high + self._candle.low) / 2
+        up = hl2 + (self.mul * self._atr.value)
+        low = hl2 - (self.mul * self._atr.value)
+        self._update_trend(float(self._candle.close), up, low)
+
+    def warm_start(self, candles: List[Candle]):
+        """Replays closed bars so that the bands and trend are where evaluate() would have left them."""
+        for candle in candles[-(self.period + 1):]:
+            self.update_candle(candle)
+        if not self._atr.ready:
+            return
+        high, low, close = (np.array([getattr(candle, name) for candle in candles], dtype=float)
+                            for name in ('high', 'low', 'close'))
+        series = supertrend_series(high, low, close, self.period, self.mul)
+        self.price_now = float(close[-1])
+        self.up = float(series['up'][-1])
+        self.low = float(series['low'][-1])
+        self.up_prev = float(series['up_prev'][-1])
+        self.low_prev = float(series['low_prev'][-1])
+        # the trend was already acted on when its bar was live
+        self.trend = self.trend_prev = TREND_CODES[int(series['trend'][-1])]
+
     def calc(self, row):
         if row.shape[0] < self.period:
             return
@@ -80,10 +169,12 @@ class SupertrendStatus:
 
         up = hl2 + (self.mul * atr)
         low = hl2 - (self.mul * atr)
+        self._update_trend(price_now, float(up.iloc[-1]), float(low.iloc[-1]))
 
+    def _update_trend(self, price_now, up, low):
         self.trend_prev = self.trend
-        self.up = float(up.iloc[-1])
-        self.low = float(low.iloc[-1])
+        self.up = up
+        self.low = low
         self.price_now = price_now
         if price_now > self.up_prev:
             if self.trend == Trend.DOWN:
@@ -112,12 +203,89 @@ class SupertrendStatus:
     def to_dict(self):
         res = {}
         for k, v in self.__dict__.items():
+            if k.startswith('_'):
+                continue
             if isinstance(v, float):
                 v = np.round(v, 3)
             res[k] = v
         return res
 
 
+TREND_CODES = {1: Trend.UP, -1: Trend.DOWN, 0: None}
+
+
+def ema_trend_series(close: np.ndarray, leng: int) -> np.ndarray:
+    """EmaTrend.trend after every bar, as 1 (UP) / -1 (DOWN)."""
+    close = np.asarray(close, dtype=float)
+    trend = np.full(len(close), -1, dtype=np.int8)
+    trend[leng:][close[leng:] > close[:-leng]] = 1
+    return trend
+
+
+def average_true_range_series(high: np.ndarray, low: np.ndarray, close: np.ndarray, period: int) -> np.ndarray:
+    """AverageTrueRange.value after every bar, NaN until `period` bars are in."""
+    high, low, close = (np.asarray(a, dtype=float) for a in (high, low, close))
+    true_range = high - low
+    if len(close) > 1:
+        true_range[1:] = np.maximum.reduce([np.abs(high[1:] - low[1:]),
+                                            np.abs(high[1:] - close[:-1]),
+                                            np.abs(close[:-1] - low[1:])])
+    atr = np.full(len(close), np.nan)
+    if len(close) >= period:
+        atr[period - 1:] = np.lib.stride_tricks.sliding_window_view(true_range, period).mean(axis=1)
+    return atr
+
+
+@njit(cache=True)
+def _supertrend_kernel(close, up, low, trend, up_prev, low_prev):
+    # SupertrendStatus._update_trend over a whole history, trend as 1 / -1 / 0 (None)
+    state = 0
+    up_p = np.nan
+    low_p = np.nan
+    for i in range(len(close)):
+        if up[i] == up[i]:
+            price = close[i]
+            if price > up_p:
+                state = 0 if state == -1 else 1
+            elif price < low_p:
+                state = 0 if state == 1 else -1
+            up_p = up[i] if up_p != up_p else min(up_p, up[i])
+            low_p = low[i] if low_p != low_p else max(low_p, low[i])
+            if state == 1:
+                up_p = np.nan
+            elif state == -1:
+                low_p = np.nan
+        trend[i] = state
+        up_prev[i] = up_p
+        low_prev[i] = low_p
+
+
+def supertrend_series(high: np.ndarray, low: np.ndarray, close: np.ndarray,
+                      period: int, mul: float) -> Dict[str, np.ndarray]:
+    """SupertrendStatus after update_candle + evaluate on every bar of a history.
+
+    Bands are vectorised, only the up_prev/low_prev ratchet runs as a loop (compiled when numba is installed).
+    """
+    high, low, close = (np.asarray(a, dtype=float) for a in (high, low, close))
+    atr = average_true_range_series(high, low, close, period)
+    hl2 = (high + low) / 2
+    up = hl2 + mul * atr
+    down = hl2 - mul * atr
+
+    n = len(close)
+    trend, up_prev, low_prev = np.zeros(n, dtype=np.int8), np.empty(n), np.empty(n)
+    args = kernel_args(close, up, down, trend, up_prev, low_prev)
+    _supertrend_kernel(*args)
+    return {
+        'atr': atr,
+        'up': up,
+        'low': down,
+        'trend': np.asarray(args[3], dtype=np.int8),
+        'up_prev': np.asarray(args[4], dtype=float),
+        'low_prev': np.asarray(args[5], dtype=float),
+    }
+
+
 class SupertrendStrategy(StrategyBase):
     def __init__(self, config, debug=True):
         super().__init__(config, __name__, debug)
@@ -132,21 +300,28 @@ class SupertrendStrategy(StrategyBase):
         self.mult = config['supertrend']['mult']
         self.ema_leng = config['supertrend']['ema_leng']
 
-        self.candle_history: deque[Candle] = deque()
         self.candle_history_length = max(self.atr_period, self.ema_leng) + 2
-        self.current_candle_start = None
+        # the up/low ratchet depends on every bar since the last trend change, not just the ATR window
+        self.warmup_bars = config['supertrend'].get('warmup_bars', 1000)
+        self.warmup_timeout = config['supertrend'].get('warmup_timeout', 10)
+        self.candle_history = self.candle_store.buffer(self.trade_ticker, self.trade_tf, self.candle_history_length)
+        self.ema_trend = EmaTrend(self.ema_leng)
+        self.supertrend_status = SupertrendStatus(self.atr_period, self.mult)
         self.add_sequent_task(self.set_candles_history)
+        self.subscribe(self.evaluate, on=(EventKind.UPDATE,), inst_ids=[self.trade_ticker],
+                       throttle=config['supertrend'].get('eval_throttle', 1))
 
     def candles_history_df(self):
-        return pd.DataFrame(self.candle_history)
+        return pd.DataFrame(self.candle_history.columns())
 
     async def set_candles_history(self):
-        self.candle_history = deque(
-            await self.connection.get_history_candles(
-                ticker=self.trade_ticker,
-                tf=self.trade_tf,
-                num_bars=self.candle_history_length)
-        )
+        candles = await self.fetch_warmup_history(self.trade_ticker, self.trade_tf, self.warmup_bars,
+                                                  self.candle_history_length, self.warmup_timeout)
+        for candle in candles[-self.candle_history_length:]:
+            self.candle_history.update(candle)
+            self.ema_trend.update(candle)
+        self.supertrend_status.warm_start(candles)
+        logger.info(f'Warmed up from {len(candles)} bars: {self.supertrend_status}, {self.ema_trend}')
 
     def _close_long_order(self):
         order = Order(
@@ -189,63 +364,53 @@ class SupertrendStrategy(StrategyBase):
         return order
 
     async def trader(self):
-        self.ema_trend = EmaTrend(self.ema_leng)
-        self.supertrend_status = SupertrendStatus(self.atr_period, self.mult)
         if self.active_position is not None:
-            self.supertrend_status.trend = Trend.UP if self.active_position.side == Side.LONG else Trend.DOWN
+            position_trend = Trend.UP if self.active_position.side == Side.LONG else Trend.DOWN
+            if position_trend != self.supertrend_status.trend:
+                logger.warning(f'Open {self.active_position.side} position against the replayed '
+                               f'{self.supertrend_status.trend} trend, following the position')
+            self.supertrend_status.trend = position_trend
         logger.warning(f'Trader started')
+        await super().trader()
+
+    async def evaluate(self, event: StrategyEvent):
+        self.supertrend_status.evaluate()
 
-        while True:
-            await asyncio.sleep(15)
-            candles_df = self.candles_history_df()
-            self.supertrend_status.calc(candles_df)
-            self.ema_trend.calculate(candles_df)
-
-            logger.info(f'{self.supertrend_status}, {self.ema_trend}')
-
-            if self.supertrend_status.trend_changed():
-                logger.warning(f'Trend changed. Global: {self.ema_trend}. Supertrend:{self.supertrend_status.trend}')
-                # close position
-                if self.active_position is not None:
-                    if self.active_position.side == Side.LONG and self.supertrend_status.trend != Trend.UP:
-                        order = self._close_long_order()
-                        resp = await self.connection.place_order(order)
-                        if resp.status != OrderStatus.OK:
-                            logger.error(f'Cant close long position: {order}, {resp}')
-
-                    elif self.active_position.side == Side.SHORT and self.supertrend_status.trend != Trend.DOWN:
-                        order = self._close_short_order()
-                        resp = await self.connection.place_order(order)
-                        if resp.status != OrderStatus.OK:
-                            logger.error(f'Cant close short position: {order}, {resp}')
-
-                # open if both trends in same direction
-                if self.supertrend_status.trend == Trend.UP:# and self.ema_trend.trend == Trend.UP:
-                    order = self._open_long_order()
+        logger.info('%s, %s', self.supertrend_status, self.ema_trend)
+
+        if self.supertrend_status.trend_changed():
+            logger.warning('Trend changed. Global: %s. Supertrend:%s', self.ema_trend, self.supertrend_status.trend)
+            # close position
+            if self.active_position is not None:
+                if self.active_position.side == Side.LONG and self.supertrend_status.trend != Trend.UP:
+                    order = self._close_long_order()
                     resp = await self.connection.place_order(order)
                     if resp.status != OrderStatus.OK:
-                        logger.error(f'Cant open long position: {order}, {resp}')
-                elif self.supertrend_status.trend == Trend.DOWN:# and self.ema_trend.trend == Trend.DOWN:
-                    order = self._open_short_order()
+                        logger.error(f'Cant close long position: {order}, {resp}')
+
+                elif self.active_position.side == Side.SHORT and self.supertrend_status.trend != Trend.DOWN:
+                    order = self._close_short_order()
                     resp = await self.connection.place_order(order)
                     if resp.status != OrderStatus.OK:
-                        logger.error(f'Cant open short position: {order}, {resp}')
-
-    async def update_candle_history(self, candle):
-        if self.candle_history is None:
-            raise RuntimeError(f'Empty candle history')
-
-        if self.candle_history[-1].datetime == candle.datetime:
-            self.candle_history[-1] = candle
-
-        elif self.candle_history[-1].datetime != candle.datetime:
-            self.candle_history.append(candle)
-            if len(self.candle_history) > self.candle_history_length:
-                self.candle_history.popleft()
+                        logger.error(f'Cant close short position: {order}, {resp}')
+
+            # open if both trends in same direction
+            if self.supertrend_status.trend == Trend.UP:# and self.ema_trend.trend == Trend.UP:
+                order = self._open_long_order()
+                resp = await self.connection.place_order(order)
+                if resp.status != OrderStatus.OK:
+                    logger.error(f'Cant open long position: {order}, {resp}')
+            elif self.supertrend_status.trend == Trend.DOWN:# and self.ema_trend.trend == Trend.DOWN:
+                order = self._open_short_order()
+                resp = await self.connection.place_order(order)
+                if resp.status != OrderStatus.OK:
+                    logger.error(f'Cant open short position: {order}, {resp}')
 
     async def candle_handler(self, candle: Candle):
         if candle.inst_id == self.trade_ticker:
-            await self.update_candle_history(candle)
+            self.candle_history.update(candle)
+            self.supertrend_status.update_candle(candle)
+            self.ema_trend.update(candle)
 
     async def account_handler(self, account: Account):
         self.account = account
@@ -257,9 +422,9 @@ class SupertrendStrategy(StrategyBase):
 
     async def order_response_handler(self, order_response: OrderResponse):
         self.alert_manager.send_message(order_response, title='order response')
-        logger.info(f'Gor order response: {order_response}')
+        logger.info('Gor order response: %s', order_response)
         pass
 
     async def fill_order_handler(self, fill_order: FillOrder):
         self.alert_manager.send_message(fill_order, title='fill order')
-        logger.info(f'Gor fill order: {fill_order}')
+        logger.info('Gor fill order: %s', fill_order)
@@ -1,16 +1,19 @@
 import asyncio
 import time
+from typing import Dict
 
-from Strategy.StrategyBase import StrategyBase
+from Strategy.StrategyBase import StrategyBase, EventKind, StrategyEvent
 from Structures.public import *
 from Structures.private import *
 from Structures.trade import *
 
 from collections import deque
 
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
 
+from Tools.jit import kernel_args, njit
 from Tools.logger import Logger
 
 logger = Logger(__name__).logger
@@ -48,6 +51,113 @@ def tutci_online(data: DataFrame, entr_length=20, exit_length=10):
     }
 
 
+class RollingExtremum:
+    """Max (or min) over the last `length` pushed values, kept in a monotonic deque."""
+
+    def __init__(self, length, is_max=True):
+        self.length = length
+        self.is_max = is_max
+        self._values = deque()
+        self._count = 0
+
+    def push(self, value):
+        if self.is_max:
+            while self._values and self._values[-1][1] <= value:
+                self._values.pop()
+        else:
+            while self._values and self._values[-1][1] >= value:
+                self._values.pop()
+        self._values.append((self._count, value))
+        self._count += 1
+        if self._values[0][0] <= self._count - 1 - self.length:
+            self._values.popleft()
+
+    @property
+    def value(self):
+        if self._count < self.length:
+            return np.nan
+        return self._values[0][1]
+
+
+class TutciChannels:
+    """Incremental tutci_online: channels span completed bars only, the forming bar just moves the close."""
+
+    def __init__(self, entr_length=20, exit_length=10):
+        self.up = RollingExtremum(entr_length, is_max=True)
+        self.down = RollingExtremum(entr_length, is_max=False)
+        self.sup = RollingExtremum(exit_length, is_max=True)
+        self.sdown = RollingExtremum(exit_length, is_max=False)
+        self._bar_ts = None
+        self._candle = None
+
+    def update(self, candle: Candle):
+        if self._candle is not None and candle.timestamp_ms != self._bar_ts:
+            self.up.push(self._candle.high)
+            self.down.push(self._candle.low)
+            self.sup.push(self._candle.high)
+            self.sdown.push(self._candle.low)
+        self._bar_ts = candle.timestamp_ms
+        self._candle = candle
+
+    def signals(self) -> Dict[str, bool]:
+        close = self._candle.close if self._candle is not None else np.nan
+        return {
+            'long_enter': bool(close >= self.up.value),
+            'short_enter': bool(close <= self.down.value),
+            'long_exit': bool(close <= self.sdown.value),
+            'short_exit': bool(close >= self.sup.value)
+        }
+
+
+def _channel(values: np.ndarray, length: int, is_max: bool) -> np.ndarray:
+    """Max (min) of the `length` bars before each bar, NaN while fewer than `length` bars are behind it."""
+    channel = np.full(len(values), np.nan)
+    if len(values) > length:
+        windows = np.lib.stride_tricks.sliding_window_view(values[:-1], length)
+        channel[length:] = windows.max(axis=1) if is_max else windows.min(axis=1)
+    return channel
+
+
+def tutci_series(high: np.ndarray, low: np.ndarray, close: np.ndarray,
+                 entr_length=20, exit_length=10) -> Dict[str, np.ndarray]:
+    """TutciChannels.signals after every bar of a history, one bool array per signal."""
+    high, low, close = (np.asarray(a, dtype=float) for a in (high, low, close))
+    # NaN channels compare False, as in the incremental version
+    with np.errstate(invalid='ignore'):
+        return {
+            'long_enter': close >= _channel(high, entr_length, True),
+            'short_enter': close <= _channel(low, entr_length, False),
+            'long_exit': close <= _channel(low, exit_length, False),
+            'short_exit': close >= _channel(high, exit_length, True),
+        }
+
+
+@njit(cache=True)
+def _positions_kernel(long_enter, short_enter, long_exit, short_exit, side):
+    # TutciStrategy.evaluate over a whole history, side as 1 / -1 / 0 (flat)
+    state = 0
+    for i in range(len(side)):
+        if state == 1 and long_exit[i]:
+            state = 0
+        elif state == -1 and short_exit[i]:
+            state = 0
+        if state == 0:
+            if long_enter[i]:
+                state = 1
+            elif short_enter[i]:
+                state = -1
+        side[i] = state
+
+
+def tutci_positions(signals: Dict[str, np.ndarray]) -> np.ndarray:
+    """Side held after evaluating every bar: 1 long, -1 short, 0 flat."""
+    side = np.zeros(len(signals['long_enter']), dtype=np.int8)
+    args = kernel_args(signals['long_enter'], signals['short_enter'], signals['long_exit'], signals['short_exit'],
+                       side)
+    _positions_kernel(*args)
+    return np.asarray(args[4], dtype=np.int8)
+
+
 class TutciStatus:
     def __init__(self):
         self._in_position: bool = False
@@ -60,6 +170,11 @@ class TutciStatus:
     def close(self):
         self._in_position = False
 
+    def restore(self, side: Optional[Side], size: float):
+        self._in_position = side is not None
+        self._side = side
+        self._size = size
+
     def open(self, order: Order):
         self._in_position = True
         self._side = Side.LONG if order.action == Action.BUY else Side.SHORT
@@ -88,23 +203,26 @@ class TutciStrategy(StrategyBase):
 
         self.positions = None
         self.account = None
-        self.tutci_status = None
         self.trade_amount = config['tutci']['trade_amount']
         self.trade_ticker = config['tutci']['trade_ticker']
         self.trade_tf = config['tutci']['timeframe']
         self.enter_length = config['tutci']['enter_length']
         self.exit_length = config['tutci']['exit_length']
 
-        self.candle_history: deque[Candle] = deque()
         self.candle_history_length = self.enter_length + 1
-        self.current_candle_start = None
+        # long enough for the replayed position to have gone through a few enter/exit cycles
+        self.warmup_bars = config['tutci'].get('warmup_bars', 1000)
+        self.warmup_timeout = config['tutci'].get('warmup_timeout', 10)
+        self.channels = TutciChannels(self.enter_length, self.exit_length)
+        self.tutci_status = TutciStatus()
+        # the replayed position is only trusted once an exchange positions snapshot has confirmed it
+        self.position_confirmed = False
 
-        self.add_parallel_task(self.trader)
+        self.add_sequent_task(self.set_candles_history)
+        self.subscribe(self.evaluate, on=(EventKind.UPDATE,), inst_ids=[self.trade_ticker],
+                       throttle=config['tutci'].get('eval_throttle', 0))
         # self.add_pretask(self.notifier)
 
-    def candles_history_df(self):
-        return pd.DataFrame(self.candle_history)
-
     async def notifier(self):
         while True:
             if self.account or self.positions:
@@ -154,73 +272,96 @@ class TutciStrategy(StrategyBase):
         return order
 
     async def trader(self):
-
-        while self.candle_history is None:
-            await asyncio.sleep(5)
-
-        self.tutci_status = TutciStatus()
         logger.warning(f'Trader started')
         self.alert_manager.send_message(f'Trader started')
+        await super().trader()
 
-        while True:
-            await asyncio.sleep(5)
-            candles_df = self.candles_history_df()
+    async def evaluate(self, event: StrategyEvent):
+        signals = self.channels.signals()
 
-            signals = tutci_online(candles_df, self.enter_length, self.exit_length)
+        if any(signals.values()):
+            _ = {k: v for k, v in signals.items() if v}
+            logger.info('Got signals: %s', _)
 
-            if any(signals.values()):
-                _ = {k: v for k, v in signals.items() if v}
-                logger.info(f'Got signals: {_}')
+        if not self.position_confirmed:
+            logger.debug('No positions snapshot yet, not trading')
+            return
 
-            if self.tutci_status.side == Side.LONG and signals['long_exit']:
-                order = self._close_long_order()
-                await self.connection.place_order(order)
-                self.tutci_status.close()
+        if self.tutci_status.side == Side.LONG and signals['long_exit']:
+            order = self._close_long_order()
+            await self.connection.place_order(order)
+            self.tutci_status.close()
+
+        elif self.tutci_status.side == Side.SHORT and signals['short_exit']:
+            order = self._close_short_order()
+            await self.connection.place_order(order)
+            self.tutci_status.close()
 
-            elif self.tutci_status.side == Side.SHORT and signals['short_exit']:
-                order = self._close_short_order()
+        if not self.tutci_status.in_position:
+            if signals['long_enter']:
+                order = self._open_long_order()
                 await self.connection.place_order(order)
-                self.tutci_status.close()
-
-            if not self.tutci_status.in_position:
-                if signals['long_enter']:
-                    order = self._open_long_order()
-                    await self.connection.place_order(order)
-                    self.tutci_status.open(order)
-                elif signals['short_enter']:
-                    order = self._open_short_order()
-                    await self.connection.place_order(order)
-                    self.tutci_status.open(order)
-
-    async def update_candle_history(self, candle):
-        if self.current_candle_start is None:
-            self.current_candle_start = candle.datetime
-            self.candle_history = deque(
-                await self.connection.get_history_candles(ticker=self.trade_ticker, tf=self.trade_tf,
-                                                          num_bars=self.candle_history_length - 1))
-            self.candle_history.append(candle)
-        if self.current_candle_start == candle.datetime:
-            self.candle_history[-1] = candle
-        elif self.current_candle_start != candle.datetime:
-            self.current_candle_start = candle.datetime
-            self.candle_history.append(candle)
-            if len(self.candle_history) > self.candle_history_length:
-                self.candle_history.popleft()
+                self.tutci_status.open(order)
+            elif signals['short_enter']:
+                order = self._open_short_order()
+                await self.connection.place_order(order)
+                self.tutci_status.open(order)
+
+    async def set_candles_history(self):
+        history = await self.fetch_warmup_history(self.trade_ticker, self.trade_tf, self.warmup_bars,
+                                                  self.candle_history_length - 1, self.warmup_timeout)
+        candle_history = self.candle_store.buffer(self.trade_ticker, self.trade_tf, self.candle_history_length)
+        for history_candle in history[-(self.candle_history_length - 1):]:
+            candle_history.update(history_candle)
+            self.channels.update(history_candle)
+        self.warm_start(history)
 
     async def candle_handler(self, candle: Candle):
-        await self.update_candle_history(candle)
+        candle_history = self.candle_store.get(candle.inst_id, candle.timeframe)
+        if candle_history is None:
+            return
+        candle_history.update(candle)
+        self.channels.update(candle)
+
+    def warm_start(self, history: List[Candle]):
+        """Restores the position evaluate() would be holding after `history`.
+        It stays provisional until an exchange positions snapshot confirms or replaces it."""
+        side = None
+        if len(history) > self.enter_length:
+            high, low, close = (np.array([getattr(candle, name) for candle in history], dtype=float)
+                                for name in ('high', 'low', 'close'))
+            signals = tutci_series(high, low, close, self.enter_length, self.exit_length)
+            side = {1: Side.LONG, -1: Side.SHORT, 0: None}[int(tutci_positions(signals)[-1])]
+        size = self.trade_amount if side is not None else 0
+        self.tutci_status.restore(side, size)
+        logger.info(f'Warmed up from {len(history)} bars: {self.tutci_status}')
+        if self.positions is not None:
+            self.reconcile(self.positions)
+
+    def reconcile(self, positions: Positions):
+        """Takes the side and size of the position the exchange holds."""
+        held = [position for position in positions if position.instrument_id == self.trade_ticker]
+        held_side = held[0].side if held and held[0].side in (Side.LONG, Side.SHORT) else None
+        if held_side != self.tutci_status.side:
+            logger.warning(f'Side {self.tutci_status.side} differs from the exchange position {held_side}, '
+                           f'using the latter')
+        self.tutci_status.restore(held_side, abs(held[0].pos_size) if held_side is not None else 0)
+        self.position_confirmed = True
 
     def account_handler(self, account: Account):
         self.account = account
 
     def positions_handler(self, positions: Positions):
         self.positions = positions
+        # later snapshots can predate the fill of an order evaluate() just placed, only the first one is taken
+        if not self.position_confirmed:
+            self.reconcile(positions)
 
     def order_response_handler(self, order_response: OrderResponse):
         self.alert_manager.send_message(order_response, title='order response')
-        logger.info(f'Gor order response: {order_response}')
+        logger.info('Gor order response: %s', order_response)
         pass
 
     def fill_order_handler(self, fill_order: FillOrder):
         self.alert_manager.send_message(fill_order, title='fill order')
-        logger.info(f'Gor fill order: {fill_order}')
+        logger.info('Gor fill order: %s', fill_order)
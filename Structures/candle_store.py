@@ -0,0 +1,149 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from Structures.public import Candle
+
+
+class CandleBuffer:
+    """Fixed-capacity OHLCV history of one (inst_id, timeframe).
+
+    Every bar is written twice, at `slot` and `slot + capacity`, so the last
+    `len(self)` bars always form one slice and the column properties return
+    chronologically ordered (strided) views without copying.
+    """
+    FIELDS = ('open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self, inst_id: str, timeframe: str, capacity: int):
+        self.inst_id = inst_id
+        self.timeframe = timeframe
+        self.capacity = capacity
+        self._timestamp_ms = np.zeros(2 * capacity, dtype=np.int64)
+        self._ohlcv = np.zeros((2 * capacity, len(self.FIELDS)), dtype=np.float64)
+        self._head = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __repr__(self):
+        return f'CandleBuffer({self.inst_id}, {self.timeframe}, {self._size}/{self.capacity})'
+
+    @property
+    def full(self) -> bool:
+        return self._size == self.capacity
+
+    @property
+    def last_timestamp(self) -> Optional[int]:
+        if not self._size:
+            return None
+        return int(self._timestamp_ms[self._head - 1 + self.capacity])
+
+    def update(self, candle: Candle) -> bool:
+        """Writes the candle in place of the forming bar or appends it; returns True on a new bar."""
+        return self.update_row(candle.timestamp_ms, candle.open, candle.high, candle.low, candle.close, candle.volume)
+
+    def update_row(self, ts: int, open: float, high: float, low: float, close: float, volume: float) -> bool:
+        last_ts = self.last_timestamp
+        if last_ts is not None and ts < last_ts:
+            return False
+
+        appended = last_ts is None or ts != last_ts
+        if appended:
+            slot = self._head
+            self._head = (self._head + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+        else:
+            slot = (self._head - 1) % self.capacity
+
+        values = (open, high, low, close, volume)
+        self._timestamp_ms[slot] = self._timestamp_ms[slot + self.capacity] = ts
+        self._ohlcv[slot] = self._ohlcv[slot + self.capacity] = values
+        return appended
+
+    def extend(self, candles: Iterable[Candle]):
+        for candle in candles:
+            self.update(candle)
+
+    def _window(self) -> slice:
+        start = self._head - self._size + self.capacity
+        return slice(start, start + self._size)
+
+    def _view(self, array: np.ndarray) -> np.ndarray:
+        view = array[self._window()]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def timestamp_ms(self) -> np.ndarray:
+        return self._view(self._timestamp_ms)
+
+    @property
+    def open(self) -> np.ndarray:
+        return self._view(self._ohlcv[:, 0])
+
+    @property
+    def high(self) -> np.ndarray:
+        return self._view(self._ohlcv[:, 1])
+
+    @property
+    def low(self) -> np.ndarray:
+        return self._view(self._ohlcv[:, 2])
+
+    @property
+    def close(self) -> np.ndarray:
+        return self._view(self._ohlcv[:, 3])
+
+    @property
+    def volume(self) -> np.ndarray:
+        return self._view(self._ohlcv[:, 4])
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        res = {'timestamp_ms': self.timestamp_ms}
+        for i, field in enumerate(self.FIELDS):
+            res[field] = self._view(self._ohlcv[:, i])
+        return res
+
+    def candle(self, i: int = -1) -> Candle:
+        if not -self._size <= i < self._size:
+            raise IndexError(f'Candle index out of range: {i}')
+        pos = self._window().start + (i % self._size)
+        return Candle(
+            inst_id=self.inst_id,
+            timeframe=self.timeframe,
+            timestamp_ms=int(self._timestamp_ms[pos]),
+            open=float(self._ohlcv[pos, 0]),
+            high=float(self._ohlcv[pos, 1]),
+            low=float(self._ohlcv[pos, 2]),
+            close=float(self._ohlcv[pos, 3]),
+            volume=float(self._ohlcv[pos, 4]),
+        )
+
+    def to_candles(self) -> List[Candle]:
+        return [self.candle(i) for i in range(self._size)]
+
+
+class CandleStore:
+    def __init__(self, capacity: int = 1000):
+        self.capacity = capacity
+        self._buffers: Dict[Tuple[str, str], CandleBuffer] = {}
+
+    def __contains__(self, key: Tuple[str, str]):
+        return key in self._buffers
+
+    def get(self, inst_id: str, timeframe: str) -> Optional[CandleBuffer]:
+        return self._buffers.get((inst_id, timeframe))
+
+    def buffer(self, inst_id: str, timeframe: str, capacity: int = None) -> CandleBuffer:
+        buffer = self._buffers.get((inst_id, timeframe))
+        if buffer is None:
+            buffer = CandleBuffer(inst_id, timeframe, capacity or self.capacity)
+            self._buffers[(inst_id, timeframe)] = buffer
+        return buffer
+
+    def update(self, candle: Candle) -> bool:
+        return self.buffer(candle.inst_id, candle.timeframe).update(candle)
+
+    def extend(self, candles: Iterable[Candle], capacity: int = None):
+        for candle in candles:
+            self.buffer(candle.inst_id, candle.timeframe, capacity).update(candle)
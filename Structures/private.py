@@ -20,6 +20,7 @@ class Account:
     in_coins_usd: float
     coins: Dict #= field(default_factory=lambda: {})
 
+@slotted
 @dataclass
 class Position:
     side: Side
@@ -32,7 +33,12 @@ class Position:
     upl: float
 
 
+class Positions(list):
+    # typed container so an empty positions snapshot can still be dispatched
+    pass
 
+
+@slotted
 @dataclass
 class FillOrder:
     id: str
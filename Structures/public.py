@@ -2,17 +2,52 @@ import json
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
-from typing import Optional
+from typing import NamedTuple, Optional
 
+from Structures.common import slotted
 
+
+@slotted
 @dataclass
 class Candle:
     inst_id: Optional[str] = None
     timestamp_ms: Optional[int] = None
-    datetime: Optional[datetime] = None
     timeframe: Optional[str] = None
     open: Optional[float] = None
     high: Optional[float] = None
     low: Optional[float] = None
     close: Optional[float] = None
-    volume: Optional[float] = None
\ No newline at end of file
+    volume: Optional[float] = None
+
+    @property
+    def datetime(self) -> Optional[datetime]:
+        if self.timestamp_ms is None:
+            return None
+        return datetime.fromtimestamp(self.timestamp_ms // 1000)
+
+class RawCandle(NamedTuple):
+    """Candle row as decoded from the public stream; the datetime and a full Candle are built on demand."""
+    inst_id: str
+    timeframe: str
+    timestamp_ms: int
+    open: float
+    high: float
+    low: float
+    close: float
+    volume: float
+
+    @property
+    def datetime(self) -> datetime:
+        return datetime.fromtimestamp(self.timestamp_ms // 1000)
+
+    def to_candle(self) -> Candle:
+        return Candle(
+            inst_id=self.inst_id,
+            timestamp_ms=self.timestamp_ms,
+            timeframe=self.timeframe,
+            open=self.open,
+            high=self.high,
+            low=self.low,
+            close=self.close,
+            volume=self.volume,
+        )
@@ -1,12 +1,17 @@
 from dataclasses import dataclass, field
-import random
+import itertools
+import time
 
 from Structures.common import *
 from Structures.private import FillOrder
 
 
+# starts at the current time in ms, so ids stay unique across restarts unless more than one is made per ms
+_ids = itertools.count(int(time.time() * 1000))
+
+
 def id_generator():
-    return str(int(random.random() * 1000000) % 1000000)
+    return str(next(_ids))
 
 
 class TargetCcy(Enum):
@@ -25,6 +30,8 @@ class OrderCancel:
 class OrderStatus(Enum):
     OK = 'OK'
     ERROR = "ERROR"
+    # no response in time: the order may still have been placed and filled
+    TIMEOUT = 'TIMEOUT'
 
     def __str__(self):
         return self.value
@@ -38,6 +45,7 @@ class OrderResponse:
     order_id: str = ''
     op: str = ''
     msg: str = ''
+@slotted
 @dataclass
 class Order:
     action: Action
@@ -1,19 +1,219 @@
+import asyncio
 import json
+import time
+from abc import abstractmethod
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from Tools.logger import Logger
+
+logger = Logger(__name__).logger
+
+
+class AlertTransport:
+    """Delivers one formatted alert message."""
+    max_chars = 4000
+
+    @abstractmethod
+    async def send(self, text: str):
+        pass
+
+    async def close(self):
+        pass
+
+
+class TelegramTransport(AlertTransport):
+    max_chars = 4096
+    API_URL = 'https://api.telegram.org'
+
+    def __init__(self, token: str, chat_id, timeout: float = 10.):
+        self.url = f'{self.API_URL}/bot{token}/sendMessage'
+        self.chat_id = chat_id
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def send(self, text: str):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+        async with self._session.post(self.url, json={'chat_id': self.chat_id, 'text': text}) as response:
+            if response.status != 200:
+                raise RuntimeError(f'Telegram responded {response.status}: {await response.text()}')
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class HttpTransport(AlertTransport):
+    """POSTs {"text": ...} to a url, e.g. a local stub in tests."""
+
+    def __init__(self, url: str, timeout: float = 10.):
+        self.url = url
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def send(self, text: str):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+        async with self._session.post(self.url, json={'text': text}) as response:
+            response.raise_for_status()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class FileTransport(AlertTransport):
+    """Appends every message to a local file."""
+    max_chars = 1 << 20
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _write(self, text: str):
+        with open(self.path, 'a') as file:
+            file.write(f'{time.strftime("%Y-%m-%d %H:%M:%S")}\n{text}\n\n')
+
+    async def send(self, text: str):
+        await asyncio.to_thread(self._write, text)
+
+
+def make_transport(config) -> AlertTransport:
+    alerts = config.get('alerts', {})
+    transport = alerts.get('transport', 'telegram')
+    if transport == 'file':
+        return FileTransport(alerts['path'])
+    if transport == 'http':
+        return HttpTransport(alerts['url'])
+    return TelegramTransport(config['telegram']['token'], config['telegram']['chat_id'])
 
-# from telebot import
-import telebot
 
 class AlertManager:
-    def __init__(self, config):
+    """Collects alerts without blocking the caller and delivers them from a background task.
+
+    send_message only appends to a bounded queue (the oldest alerts are dropped when it is full).
+    The worker sends at most one batch per `interval` seconds: everything queued meanwhile,
+    identical alerts coalesced, split to the transport's message size.
+    """
 
-        self.token = config['telegram']['token']
-        self.chat_id = config['telegram']['chat_id']
-        self.bot = telebot.TeleBot(self.token)
+    def __init__(self, config, transport: AlertTransport = None):
+        alerts = config.get('alerts', {})
+        self.transport = transport or make_transport(config)
+        self.interval = alerts.get('interval', 5.)
+        self.queue_size = alerts.get('queue_size', 1000)
+
+        self.queued = 0
+        self.dropped = 0
+        self.sent = 0
+        self.errors = 0
+        self._queue: Deque[Tuple[Optional[str], object]] = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._last_send = float('-inf')
 
     def send_message(self, msg, title=None):
+        if len(self._queue) >= self.queue_size:
+            self._queue.popleft()
+            self.dropped += 1
+        # formatting is left to the worker
+        self._queue.append((title, msg))
+        self.queued += 1
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        if self._worker is not None and not self._worker.done():
+            self._wakeup.set()
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # not in a loop yet, the first call from one starts the worker
+            return
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        self._worker = loop.create_task(self._run())
+
+    @staticmethod
+    def format(title: Optional[str], msg) -> str:
         if isinstance(msg, dict):
-            msg = json.dumps(msg, indent=4)
+            msg = json.dumps(msg, indent=4, default=str)
         if title:
-            msg = f'{title.upper()}\n{msg}'
-        self.bot.send_message(self.chat_id, msg)
+            return f'{title.upper()}\n{msg}'
+        return str(msg)
+
+    def _take_batch(self) -> List[str]:
+        counts: Dict[str, int] = {}
+        while self._queue:
+            text = self.format(*self._queue.popleft())
+            counts[text] = counts.get(text, 0) + 1
+        return [text if count == 1 else f'{text}\n(x{count})' for text, count in counts.items()]
+
+    def _split(self, texts: List[str]) -> List[str]:
+        limit = self.transport.max_chars
+        messages, current = [], ''
+        for text in texts:
+            while len(text) > limit:
+                messages.append(text[:limit])
+                text = text[limit:]
+            if current and len(current) + 2 + len(text) > limit:
+                messages.append(current)
+                current = ''
+            current = f'{current}\n\n{text}' if current else text
+        if current:
+            messages.append(current)
+        return messages
+
+    async def _flush(self):
+        for message in self._split(self._take_batch()):
+            try:
+                await self.transport.send(message)
+                self.sent += 1
+            except Exception as e:
+                self.errors += 1
+                logger.error(f'Alert delivery failed: {e!r}')
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            wait = self._last_send + self.interval - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if not self._queue:
+                continue
+            self._last_send = loop.time()
+            try:
+                await self._flush()
+            except Exception as e:
+                logger.exception(f'Alert worker error: {e}')
+
+    async def close(self):
+        """Sends whatever is still queued and stops the worker."""
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+        await self._flush()
+        await self.transport.close()
+
+    def metrics(self) -> Dict[str, int]:
+        return {'queued': self.queued, 'pending': len(self._queue), 'dropped': self.dropped,
+                'sent': self.sent, 'errors': self.errors}
+
+
+class NullAlertManager:
+    """Drops every alert, for backtests and benchmarks."""
+
+    def send_message(self, msg, title=None):
+        pass
+
+    async def close(self):
+        pass
 
+    def metrics(self) -> Dict[str, int]:
+        return {}
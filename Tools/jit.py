@@ -0,0 +1,23 @@
+from typing import List, Union
+
+import numpy as np
+
+try:
+    from numba import njit
+
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        """Stand-in for numba.njit when numba is not installed: the function runs as plain Python."""
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda function: function
+
+
+def kernel_args(*arrays: np.ndarray) -> List[Union[np.ndarray, list]]:
+    """Arguments for an @njit loop: arrays for numba, lists otherwise (plain-Python indexing is faster on lists)."""
+    if NUMBA_AVAILABLE:
+        return list(arrays)
+    return [array.tolist() for array in arrays]
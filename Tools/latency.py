@@ -0,0 +1,199 @@
+"""Tick-to-order latency of the live pipeline, stage by stage.
+
+Every public frame is stamped (perf_counter_ns) when it is received, decoded and queued, and
+the latest stamps of each instrument are carried through dequeue, candle handler, strategy
+signal, order send and exchange ack. Each step between two stamps lands in a log-linear
+histogram, once overall and once per instrument:
+
+    decode   received -> decoded            queue    enqueued -> dequeued
+    enqueue  decoded -> enqueued            handler  dequeued -> handled
+    signal   handled -> subscription callback started
+    send     callback started -> order frame written
+    ack      order frame written -> exchange response
+    tick_to_send, tick_to_ack  received -> send / ack
+
+    from Tools.latency import tracer
+    tracer.summary()   # {stage: {count, min_us, p50_us, ..., max_us}}
+"""
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+STAGES = ('decode', 'enqueue', 'queue', 'handler', 'signal', 'send', 'ack', 'tick_to_send', 'tick_to_ack')
+
+# positions in a trace
+RECEIVED, DECODED, ENQUEUED, DEQUEUED, HANDLED, SIGNALLED = range(6)
+
+
+class LatencyHistogram:
+    """HDR-style histogram of integer nanoseconds: exact below 2**sub_bits, then 2**(sub_bits - 1)
+    buckets per power of two, i.e. better than 2**(1 - sub_bits) relative error at any magnitude."""
+
+    def __init__(self, sub_bits: int = 7, max_ns: int = 60 * 10 ** 9):
+        self.sub_bits = sub_bits
+        self._half = 1 << (sub_bits - 1)
+        self._sub_count = 1 << sub_bits
+        self.max_ns = max_ns
+        self.counts: List[int] = [0] * (self._index(max_ns) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = max_ns
+        self.max = 0
+
+    def _index(self, value: int) -> int:
+        if value < self._sub_count:
+            return value
+        shift = value.bit_length() - self.sub_bits
+        return (shift << (self.sub_bits - 1)) + (value >> shift)
+
+    def _bucket_value(self, index: int) -> int:
+        """Upper edge of a bucket."""
+        if index < self._sub_count:
+            return index
+        shift = index // self._half - 1
+        return ((index - shift * self._half + 1) << shift) - 1
+
+    def record(self, value: int):
+        # _index inlined, this runs several times per tick
+        if value < self._sub_count:
+            if value < 0:
+                value = 0
+            index = value
+        else:
+            if value > self.max_ns:
+                value = self.max_ns
+            shift = value.bit_length() - self.sub_bits
+            index = (shift << (self.sub_bits - 1)) + (value >> shift)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> int:
+        if not self.count:
+            return 0
+        rank = max(1, round(q / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._bucket_value(index), self.max)
+        return self.max
+
+    def merge(self, other: 'LatencyHistogram'):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0
+        self.min = self.max_ns
+        self.max = 0
+
+    def summary(self) -> Dict[str, float]:
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'min_us': round(self.min / 1000, 1),
+            'mean_us': round(self.total / self.count / 1000, 1),
+            'p50_us': round(self.percentile(50) / 1000, 1),
+            'p90_us': round(self.percentile(90) / 1000, 1),
+            'p99_us': round(self.percentile(99) / 1000, 1),
+            'p999_us': round(self.percentile(99.9) / 1000, 1),
+            'max_us': round(self.max / 1000, 1),
+        }
+
+
+class LatencyTracer:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.stages: Dict[str, LatencyHistogram] = {stage: LatencyHistogram() for stage in STAGES}
+        self.by_instrument: Dict[str, Dict[str, LatencyHistogram]] = {}
+        # latest frame of every instrument: stamps by position, None until reached
+        self._traces: Dict[str, List[Optional[int]]] = {}
+        self._sent: Dict[str, Tuple[int, Dict[str, List[Optional[int]]]]] = {}
+
+    def _record(self, stage: str, inst_id: str, value: int):
+        self.stages[stage].record(value)
+        stages = self.by_instrument.get(inst_id)
+        if stages is None:
+            stages = self.by_instrument[inst_id] = {stage: LatencyHistogram() for stage in STAGES}
+        stages[stage].record(value)
+
+    def on_public(self, candles: Iterable, received: int, decoded: int, enqueued: int):
+        for candle in candles:
+            inst_id = candle.inst_id
+            self._traces[inst_id] = [received, decoded, enqueued, None, None, None]
+            self._record('decode', inst_id, decoded - received)
+            self._record('enqueue', inst_id, enqueued - decoded)
+
+    def on_handled(self, inst_id: str, dequeued: int, handled: int):
+        trace = self._traces.get(inst_id)
+        if trace is None or trace[DEQUEUED] is not None:
+            return
+        trace[DEQUEUED] = dequeued
+        trace[HANDLED] = handled
+        self._record('queue', inst_id, dequeued - trace[ENQUEUED])
+        self._record('handler', inst_id, handled - dequeued)
+
+    def on_signal(self, inst_ids: Iterable[str]):
+        now = time.perf_counter_ns()
+        for inst_id in inst_ids:
+            trace = self._traces.get(inst_id)
+            if trace is None or trace[HANDLED] is None or trace[SIGNALLED] is not None:
+                continue
+            trace[SIGNALLED] = now
+            self._record('signal', inst_id, now - trace[HANDLED])
+
+    def on_send(self, msg_id: str, inst_ids: Iterable[str]):
+        """Order frame `msg_id` is about to be written; only orders following a traced signal count."""
+        now = time.perf_counter_ns()
+        traces = {}
+        for inst_id in inst_ids:
+            trace = self._traces.get(inst_id)
+            if trace is None or trace[SIGNALLED] is None:
+                continue
+            self._record('send', inst_id, now - trace[SIGNALLED])
+            self._record('tick_to_send', inst_id, now - trace[RECEIVED])
+            traces[inst_id] = trace
+        if traces:
+            self._sent[msg_id] = (now, traces)
+
+    def on_ack(self, msg_id: str):
+        sent = self._sent.pop(msg_id, None)
+        if sent is None:
+            return
+        sent_ns, traces = sent
+        now = time.perf_counter_ns()
+        for inst_id, trace in traces.items():
+            self._record('ack', inst_id, now - sent_ns)
+            self._record('tick_to_ack', inst_id, now - trace[RECEIVED])
+
+    def discard(self, msg_id: str):
+        """Forgets order frame `msg_id` when no response came back, so it does not count as acknowledged."""
+        self._sent.pop(msg_id, None)
+
+    def summary(self, per_instrument: bool = False) -> Dict:
+        summary = {stage: histogram.summary() for stage, histogram in self.stages.items() if histogram.count}
+        if per_instrument:
+            instruments = {inst_id: {stage: histogram.summary() for stage, histogram in stages.items() if histogram.count}
+                           for inst_id, stages in self.by_instrument.items()}
+            summary = {'stages': summary, 'instruments': instruments}
+        return summary
+
+    def reset(self):
+        for histogram in self.stages.values():
+            histogram.reset()
+        self.by_instrument.clear()
+
+
+tracer = LatencyTracer()
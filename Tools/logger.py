@@ -1,4 +1,13 @@
+import atexit
+import dataclasses
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import threading
+from collections import defaultdict
+from typing import Dict, Optional
 
 
 class CustomFormatter(logging.Formatter):
@@ -18,25 +27,144 @@ class CustomFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format + reset
     }
 
+    def __init__(self):
+        super().__init__()
+        self._formatters = {level: logging.Formatter(fmt) for level, fmt in self.FORMATS.items()}
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        return self._formatters.get(record.levelno, self._formatters[logging.DEBUG]).format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'file': record.filename,
+            'line': record.lineno,
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def _snapshot(arg):
+    if isinstance(arg, (list, dict, set)):
+        return arg.copy()
+    # mutable objects that usually change after being logged (orders, fills, frames, arrays)
+    # are rendered now, as %s would render them
+    if dataclasses.is_dataclass(arg) and not isinstance(arg, type):
+        return str(arg)
+    if type(arg).__module__.partition('.')[0] in ('pandas', 'numpy') and getattr(arg, 'ndim', 0):
+        return str(arg)
+    return arg
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread unformatted, unlike QueueHandler, which merges the
+    message and its args on the calling thread. Containers are copied and dataclasses, pandas
+    and numpy objects are turned into strings, so that the line shows them as they were when
+    logged; other mutable args are formatted late and should not be changed after logging."""
+
+    def prepare(self, record):
+        if record.args and isinstance(record.args, tuple):
+            record.args = tuple(_snapshot(arg) for arg in record.args)
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through one in `every` records of each message template at or below `level`."""
+
+    def __init__(self, every: int, level: int = logging.INFO):
+        super().__init__()
+        self.every = every
+        self.level = level
+        self._counts: Dict[str, int] = defaultdict(int)
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+        count = self._counts[record.msg]
+        self._counts[record.msg] = count + 1
+        return count % self.every == 0
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_setup_lock = threading.Lock()
+
+
+def setup_logging(path: str = None, json_lines: bool = None, console: bool = True):
+    """Routes every logger through one queue to a background thread that formats and writes.
+
+    Defaults come from TRADEBOT_LOG_FILE (../log.txt) and TRADEBOT_LOG_JSON; calling it again
+    replaces the writer thread's handlers.
+    """
+    global _listener
+    path = path if path is not None else os.environ.get('TRADEBOT_LOG_FILE', '../log.txt')
+    if json_lines is None:
+        json_lines = os.environ.get('TRADEBOT_LOG_JSON', '') not in ('', '0')
+
+    with _setup_lock:
+        handlers = []
+        if console:
+            console_handler = logging.StreamHandler()
+            console_handler.setFormatter(CustomFormatter())
+            handlers.append(console_handler)
+        if path:
+            try:
+                file_handler = logging.FileHandler(path)
+            except OSError:
+                file_handler = None
+            if file_handler is not None:
+                file_handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter(
+                    "%(asctime)s - %(name)s - %(levelname)s - %(message)s (%(filename)s:%(lineno)d)"))
+                handlers.append(file_handler)
+
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+        root = logging.getLogger()
+        queue_handler = next((handler for handler in root.handlers if isinstance(handler, LazyQueueHandler)), None)
+        if queue_handler is None:
+            queue_handler = LazyQueueHandler(queue.SimpleQueue())
+            root.addHandler(queue_handler)
+            atexit.register(shutdown_logging)
+        _listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+
+
+def shutdown_logging():
+    """Writes out everything still queued."""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+            _listener = None
+
+
+def sample(name: str, every: int, level: int = logging.INFO):
+    """Keeps one in `every` records per message of logger `name` at or below `level`, for
+    messages logged on every tick. Warnings and errors are never sampled by default."""
+    logger = logging.getLogger(name)
+    for existing in [f for f in logger.filters if isinstance(f, SamplingFilter)]:
+        logger.removeFilter(existing)
+    logger.addFilter(SamplingFilter(every, level))
 
 
 class Logger:
 
     def __init__(self, name):
-        logging.basicConfig(filename='../log.txt', format="%(asctime)s - %(name)s - %(levelname)s - %(message)s (%(filename)s:%(lineno)d)")
+        if _listener is None:
+            setup_logging()
 
         logger = logging.getLogger(name)
         logger.setLevel(logging.DEBUG)
-
-        logger_handler = logging.StreamHandler()
-        logger_handler.setLevel(logging.DEBUG)
-
-        logger_handler.setFormatter(CustomFormatter())
-
-        logger.addHandler(logger_handler)
         self.logger = logger
         self.logger.info('Logging set up finnished')
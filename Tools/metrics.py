@@ -0,0 +1,347 @@
+"""In-process counters, gauges and histograms, served in the Prometheus text format.
+
+    from Tools.metrics import registry
+    ORDERS = registry.counter('tradebot_orders_total', 'Orders sent', ('op',))
+    ORDERS.labels('order').inc()
+
+An update is a dict lookup and an addition (keep the `labels(...)` child around on hot paths
+to skip the lookup); nothing is formatted until /metrics is scraped. Values kept elsewhere,
+such as queue and rate-limit counters or the latency tracer, are read at scrape time through
+collectors registered with `registry.register_collector`.
+"""
+import asyncio
+import bisect
+import math
+from abc import abstractmethod
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qsl
+
+from Tools.logger import Logger
+
+logger = Logger(__name__).logger
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+# (name suffix, labels, value)
+Sample = Tuple[str, Dict[str, str], float]
+# (name, type, help, samples)
+Family = Tuple[str, str, str, List[Sample]]
+
+
+class CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.
+
+    def inc(self, amount: float = 1.):
+        self.value += amount
+
+
+class GaugeValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.):
+        self.value += amount
+
+    def dec(self, amount: float = 1.):
+        self.value -= amount
+
+
+class HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # the last bucket is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple, object] = {}
+        self._default = None if self.labelnames else self.labels()
+
+    @abstractmethod
+    def _new_child(self):
+        pass
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'{self.name} takes labels {self.labelnames}, got {values}')
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _samples(self, labels: Dict[str, str], child) -> List[Sample]:
+        return [('', labels, child.value)]
+
+    def collect(self) -> Family:
+        samples = []
+        for values, child in list(self._children.items()):
+            samples.extend(self._samples(dict(zip(self.labelnames, map(str, values))), child))
+        return self.name, self.kind, self.help, samples
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return CounterValue()
+
+    def inc(self, amount: float = 1.):
+        self._default.inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return GaugeValue()
+
+    def set(self, value: float):
+        self._default.set(value)
+
+    def inc(self, amount: float = 1.):
+        self._default.inc(amount)
+
+    def dec(self, amount: float = 1.):
+        self._default.dec(amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(float(bound) for bound in buckets if not math.isinf(bound)))
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self):
+        return HistogramValue(self.bounds)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def _samples(self, labels: Dict[str, str], child: HistogramValue) -> List[Sample]:
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (math.inf,), child.counts):
+            cumulative += count
+            samples.append(('_bucket', {**labels, 'le': format_value(bound)}, cumulative))
+        samples.append(('_sum', labels, child.sum))
+        samples.append(('_count', labels, child.count))
+        return samples
+
+
+def format_value(value: float) -> str:
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: Dict[str, Callable[[], Iterable[Family]]] = {}
+
+    def _add(self, metric: Metric) -> Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is None:
+            self._metrics[metric.name] = metric
+            return metric
+        if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+            raise ValueError(f'Metric {metric.name} is already registered as {existing.kind} {existing.labelnames}')
+        return existing
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def register_collector(self, key: str, collector: Callable[[], Iterable[Family]]):
+        """`collector()` is called on every scrape; registering the same key again replaces it."""
+        self._collectors[key] = collector
+
+    def unregister_collector(self, key: str):
+        self._collectors.pop(key, None)
+
+    def collect(self) -> List[Family]:
+        families: Dict[str, Family] = {}
+        for metric in list(self._metrics.values()):
+            families[metric.name] = metric.collect()
+        for key, collector in list(self._collectors.items()):
+            try:
+                collected = list(collector())
+            except Exception as e:
+                logger.error(f'Metrics collector {key} failed: {e!r}')
+                continue
+            # several strategies report the same families under different labels
+            for name, kind, help, samples in collected:
+                if name in families:
+                    families[name][3].extend(samples)
+                else:
+                    families[name] = (name, kind, help, list(samples))
+        return list(families.values())
+
+    def expose(self) -> str:
+        lines = []
+        for name, kind, help, samples in self.collect():
+            lines.append(f'# HELP {name} {_escape(help)}')
+            lines.append(f'# TYPE {name} {kind}')
+            for suffix, labels, value in samples:
+                if labels:
+                    label_text = ','.join(f'{key}="{_escape(str(label))}"' for key, label in labels.items())
+                    lines.append(f'{name}{suffix}{{{label_text}}} {format_value(value)}')
+                else:
+                    lines.append(f'{name}{suffix} {format_value(value)}')
+        lines.append('')
+        return '\n'.join(lines)
+
+
+registry = Registry()
+
+LOOP_LAG = registry.histogram('tradebot_event_loop_lag_seconds', 'Delay of a periodic timer past its deadline',
+                              buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5.))
+LOOP_LAG_LAST = registry.gauge('tradebot_event_loop_lag_last_seconds', 'Latest event-loop lag measurement')
+
+
+async def monitor_loop_lag(interval: float = .5):
+    """Sleeps `interval` seconds over and over; oversleeping is time the loop spent on something else."""
+    loop = asyncio.get_running_loop()
+    while True:
+        deadline = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - deadline, 0.)
+        LOOP_LAG.observe(lag)
+        LOOP_LAG_LAST.set(lag)
+
+
+_lag_monitor: Optional[asyncio.Task] = None
+
+
+def start_loop_lag_monitor(interval: float = .5) -> asyncio.Task:
+    """One monitor per running loop; strategies sharing a loop share it and its interval."""
+    global _lag_monitor
+    loop = asyncio.get_running_loop()
+    if _lag_monitor is None or _lag_monitor.done() or _lag_monitor.get_loop() is not loop:
+        _lag_monitor = loop.create_task(monitor_loop_lag(interval), name='loop_lag')
+    return _lag_monitor
+
+
+# extra GET endpoints of the metrics server: path -> async handler(query) returning a text body
+ROUTES: Dict[str, Callable[[Dict[str, str]], Awaitable[str]]] = {}
+
+
+class MetricsServer:
+    """Answers GET /metrics with `registry.expose()` and the paths in ROUTES; anything else is a 404."""
+
+    def __init__(self, registry: Registry, host: str = '127.0.0.1', port: int = 9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f'Metrics served on http://{self.host}:{self.port}/metrics')
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            method, target = request.split(b' ', 2)[:2]
+            path, _, query = target.decode().partition('?')
+            route = ROUTES.get(path)
+            if method != b'GET':
+                status, content_type, body = '405 Method Not Allowed', 'text/plain', b'GET only\n'
+            elif path == '/metrics':
+                status, content_type, body = '200 OK', 'text/plain; version=0.0.4', self.registry.expose().encode()
+            elif route is not None:
+                try:
+                    status, content_type, body = '200 OK', 'text/plain', (await route(dict(parse_qsl(query)))).encode()
+                except ValueError as e:
+                    status, content_type, body = '400 Bad Request', 'text/plain', f'{e}\n'.encode()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', b'Not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {content_type}; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError,
+                ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+_server: Optional[MetricsServer] = None
+# the start in progress, awaited by every strategy that asks for the endpoint meanwhile
+_starting: Optional[asyncio.Task] = None
+
+
+async def _start(host: str, port: int) -> Optional[MetricsServer]:
+    global _server, _starting
+    server = MetricsServer(registry, host, port)
+    try:
+        await server.start()
+    except OSError as e:
+        logger.warning(f'Metrics endpoint {host}:{port} not started: {e}')
+        _starting = None
+        return None
+    _server = server
+    return server
+
+
+async def serve(host: str = '127.0.0.1', port: int = 9108) -> Optional[MetricsServer]:
+    """Starts the process-wide endpoint once; strategies sharing a process share the registry and the port."""
+    global _starting
+    if _server is not None:
+        return _server
+    if _starting is None or _starting.get_loop() is not asyncio.get_running_loop():
+        _starting = asyncio.create_task(_start(host, port), name='metrics_serve')
+    return await asyncio.shield(_starting)
+
+
+async def stop_serving():
+    global _server, _starting
+    _starting = None
+    if _server is not None:
+        await _server.close()
+        _server = None
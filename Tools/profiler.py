@@ -0,0 +1,231 @@
+"""Finds synchronous work that stalls the event loop.
+
+LoopWatchdog runs in its own thread and expects a heartbeat from the loop every `threshold / 4`
+seconds. When the heartbeat is late by more than `threshold` it takes the loop thread's stack
+and the name of the running task there and then, while the stall is still going on, and logs
+both once the loop is back.
+
+StrategyBase.dispatch and the subscription workers record in `handlers` which handler or callback
+their task is running, so a stall inside one is reported with its name as well as the task's.
+
+SamplingProfiler samples the loop thread's stack every few milliseconds over a time window and
+writes the collapsed stacks that flamegraph.pl, speedscope and similar tools read:
+
+    await profile(30, path='loop.folded')
+    curl 'http://127.0.0.1:9108/profile?seconds=30' > loop.folded   # with the metrics server up
+"""
+import asyncio
+import functools
+import os
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional
+
+from Tools.logger import Logger
+from Tools.metrics import ROUTES, registry
+
+logger = Logger(__name__).logger
+
+STALLS = registry.counter('tradebot_loop_stalls_total', 'Event-loop stalls longer than the watchdog threshold',
+                          ('task',))
+STALL_SECONDS = registry.histogram('tradebot_loop_stall_seconds', 'Duration of event-loop stalls',
+                                   buckets=(.05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.))
+
+MAX_PROFILE_SECONDS = 600
+
+# the strategy handler or callback each task is running, e.g. 'supertrend.RawCandle'; keyed by task
+# because other tasks run while a handler awaits
+handlers: 'weakref.WeakKeyDictionary[asyncio.Task, str]' = weakref.WeakKeyDictionary()
+
+
+def _task_name(task: Optional[asyncio.Task]) -> str:
+    return task.get_name() if task is not None else '<callback>'
+
+
+@dataclass
+class StallRecord:
+    started: float  # time.time() of the last heartbeat before the stall
+    duration_s: float
+    task: str
+    stack: List[str]
+    handler: Optional[str] = None
+
+    def __str__(self):
+        where = self.task if self.handler is None else f'{self.task} (handler {self.handler})'
+        return f'Event loop stalled {self.duration_s:.3f}s in {where}:\n{"".join(self.stack)}'
+
+
+class LoopWatchdog:
+    def __init__(self, threshold: float = .1, max_records: int = 100, stack_depth: int = 40):
+        self.threshold = threshold
+        self.stack_depth = stack_depth
+        self.records: Deque[StallRecord] = deque(maxlen=max_records)
+        self.stalls = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._period = threshold / 4
+        self._beat = time.perf_counter()
+        self._loop_thread: Optional[int] = None
+        self._heartbeat_handle: Optional[asyncio.TimerHandle] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self, loop: asyncio.AbstractEventLoop = None):
+        """Must be called from the loop's thread."""
+        self.loop = loop or asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        self._heartbeat()
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._heartbeat_handle is not None:
+            self._heartbeat_handle.cancel()
+            self._heartbeat_handle = None
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _heartbeat(self):
+        self._beat = time.perf_counter()
+        self._heartbeat_handle = self.loop.call_later(self._period, self._heartbeat)
+
+    def _watch(self):
+        stall: Optional[StallRecord] = None
+        stall_beat = None
+        while not self._stop.wait(self._period):
+            if self.loop.is_closed():
+                return
+            beat = self._beat
+            if stall is not None and beat != stall_beat:
+                stall.duration_s = beat - stall_beat - self._period
+                self._record(stall)
+                stall = None
+            elif stall is None and self.loop.is_running() and time.perf_counter() - beat > self._period + self.threshold:
+                stall_beat = beat
+                # read from another thread: the task may finish meanwhile, its names are only a hint
+                task = asyncio.current_task(self.loop)
+                stall = StallRecord(started=time.time() - (time.perf_counter() - beat), duration_s=0.,
+                                    task=_task_name(task), stack=self._loop_stack(),
+                                    handler=handlers.get(task) if task is not None else None)
+
+    def _loop_stack(self) -> List[str]:
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            return []
+        return traceback.format_stack(frame)[-self.stack_depth:]
+
+    def _record(self, stall: StallRecord):
+        self.stalls += 1
+        self.records.append(stall)
+        STALLS.labels(stall.task).inc()
+        STALL_SECONDS.observe(stall.duration_s)
+        logger.warning('%s', stall)
+
+
+_watchdog: Optional[LoopWatchdog] = None
+
+
+def start_watchdog(threshold: float = .1) -> LoopWatchdog:
+    """One watchdog per running loop; strategies sharing a loop share it."""
+    global _watchdog
+    loop = asyncio.get_running_loop()
+    if _watchdog is not None and _watchdog.running and _watchdog.loop is loop:
+        return _watchdog
+    if _watchdog is not None:
+        _watchdog.stop()
+    _watchdog = LoopWatchdog(threshold)
+    _watchdog.start(loop)
+    return _watchdog
+
+
+@functools.lru_cache(maxsize=None)
+def _frame_name(code) -> str:
+    filename = code.co_filename
+    for path in sorted(sys.path, key=len, reverse=True):
+        if path and filename.startswith(path + os.sep):
+            filename = filename[len(path) + 1:]
+            break
+    return f'{code.co_name} ({filename}:{code.co_firstlineno})'.replace(';', ':')
+
+
+class SamplingProfiler:
+    """Counts the distinct stacks of one thread (by default the caller's) from a background thread."""
+
+    def __init__(self, interval: float = .005, thread_id: int = None, loop: asyncio.AbstractEventLoop = None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.loop = loop
+        self.samples = 0
+        self.counts: Dict[str, int] = defaultdict(int)
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if self.loop is not None:
+                names.append(f'[{_task_name(asyncio.current_task(self.loop))}]')
+            names.reverse()
+            self.counts[';'.join(names)] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        """`frame;frame;frame count` per line, outermost frame first."""
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(self.counts.items()))
+
+    def dump(self, path: str):
+        with open(path, 'w') as file:
+            file.write(self.collapsed())
+
+
+async def profile(seconds: float, interval: float = .005, path: str = None) -> SamplingProfiler:
+    """Samples the running loop's thread for `seconds`, rooted at the running task's name."""
+    profiler = SamplingProfiler(interval, loop=asyncio.get_running_loop())
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+    logger.info(f'Profiled the event loop for {seconds}s: {profiler.samples} samples, {len(profiler.counts)} stacks')
+    if path:
+        await asyncio.to_thread(profiler.dump, path)
+    return profiler
+
+
+async def _profile_route(query: Dict[str, str]) -> str:
+    seconds = float(query.get('seconds', 10))
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise ValueError(f'seconds must be in (0, {MAX_PROFILE_SECONDS}]')
+    profiler = await profile(seconds, max(float(query.get('interval', .005)), .001))
+    return profiler.collapsed()
+
+
+ROUTES['/profile'] = _profile_route
@@ -0,0 +1,138 @@
+import asyncio
+import itertools
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+
+def candle_key(obj) -> Optional[Hashable]:
+    timestamp_ms = getattr(obj, 'timestamp_ms', None)
+    if timestamp_ms is None:
+        return None
+    return obj.inst_id, obj.timeframe, timestamp_ms
+
+
+class ConflatingQueue:
+    """Bounded market-data queue that keeps only the latest update per key.
+
+    An update whose key is already queued replaces the queued object in place.
+    When the queue is full of distinct keys the oldest entry is dropped.
+    """
+
+    def __init__(self, key: Callable[[Any], Optional[Hashable]], maxsize: int, ready: asyncio.Event):
+        self.maxsize = maxsize
+        self._key = key
+        self._ready = ready
+        self._items: OrderedDict = OrderedDict()
+        self._unkeyed = itertools.count()
+
+        self.put_count = 0
+        self.conflated = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def empty(self) -> bool:
+        return not self._items
+
+    def put_nowait(self, obj):
+        key = self._key(obj)
+        if key is None:
+            key = ('unkeyed', next(self._unkeyed))
+
+        self.put_count += 1
+        if key in self._items:
+            self._items[key] = obj
+            self.conflated += 1
+        else:
+            if len(self._items) >= self.maxsize:
+                self._items.popitem(last=False)
+                self.dropped += 1
+            self._items[key] = obj
+            self.max_depth = max(self.max_depth, len(self._items))
+        self._ready.set()
+
+    def drain(self) -> List:
+        items = list(self._items.values())
+        self._items.clear()
+        return items
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            'depth': self.qsize(),
+            'max_depth': self.max_depth,
+            'put': self.put_count,
+            'conflated': self.conflated,
+            'dropped': self.dropped,
+        }
+
+
+class EventQueue:
+    """Bounded FIFO that never drops: producers wait while it is full."""
+
+    def __init__(self, maxsize: int, ready: asyncio.Event):
+        self.maxsize = maxsize
+        self._queue = asyncio.Queue(maxsize)
+        self._ready = ready
+
+        self.put_count = 0
+        self.blocked = 0
+        self.max_depth = 0
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def empty(self) -> bool:
+        return self._queue.empty()
+
+    async def put(self, obj):
+        if self._queue.full():
+            self.blocked += 1
+        await self._queue.put(obj)
+        self.put_count += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        self._ready.set()
+
+    def drain(self) -> List:
+        items = []
+        while not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        return items
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            'depth': self.qsize(),
+            'max_depth': self.max_depth,
+            'put': self.put_count,
+            'blocked': self.blocked,
+        }
+
+
+class ChannelQueues:
+    """Public market data and private account/order events, consumed together."""
+
+    def __init__(self, public_maxsize: int = 1000, private_maxsize: int = 1000):
+        self.ready = asyncio.Event()
+        self.public = ConflatingQueue(candle_key, public_maxsize, self.ready)
+        self.private = EventQueue(private_maxsize, self.ready)
+
+    def qsize(self) -> int:
+        return self.public.qsize() + self.private.qsize()
+
+    def empty(self) -> bool:
+        return self.public.empty() and self.private.empty()
+
+    async def get_batch(self) -> List:
+        while True:
+            batch = self.private.drain() + self.public.drain()
+            if batch:
+                return batch
+            self.ready.clear()
+            await self.ready.wait()
+
+    def metrics(self) -> Dict[str, Dict[str, int]]:
+        return {
+            'public': self.public.metrics(),
+            'private': self.private.metrics(),
+        }